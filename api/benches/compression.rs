@@ -0,0 +1,153 @@
+// Compressed size and time for /api/query results of typical sizes
+//
+// Builds JSON responses in the rows and columnar formats from the mtcars rows,
+// repeated up to each result size, and compresses them with gzip, brotli and
+// zstd at their fastest, default and best levels. The transfer column
+// estimates the time to send the compressed body at BENCH_BANDWIDTH_MBPS
+// (default 100), so compression time and bytes saved can be compared directly.
+//
+//     cargo bench --bench compression
+
+use std::io::Write;
+use std::time::{Duration, Instant};
+
+use serde_json::{json, Map, Value};
+
+const MTCARS: &str = include_str!("../../database/mtcars.csv");
+const ROW_COUNTS: [usize; 4] = [32, 1_000, 10_000, 100_000];
+
+fn main() {
+    let bandwidth_mbps: f64 = std::env::var("BENCH_BANDWIDTH_MBPS")
+        .ok()
+        .and_then(|b| b.parse().ok())
+        .unwrap_or(100.0);
+
+    println!(
+        "{:<9} {:>7} {:<8} {:<8} {:>11} {:>11} {:>7} {:>12} {:>12}",
+        "format", "rows", "codec", "level", "bytes", "compressed", "ratio", "compress_ms", "transfer_ms"
+    );
+    for rows in ROW_COUNTS {
+        for (format, body) in [("rows", rows_body(rows)), ("columnar", columnar_body(rows))] {
+            let transfer = |bytes: usize| bytes as f64 * 8.0 / (bandwidth_mbps * 1000.0);
+            println!(
+                "{:<9} {:>7} {:<8} {:<8} {:>11} {:>11} {:>7.2} {:>12.2} {:>12.2}",
+                format, rows, "identity", "-", body.len(), body.len(), 1.0, 0.0, transfer(body.len())
+            );
+            for (codec, level, compress) in codecs() {
+                let (compressed, elapsed) = measure(&body, compress);
+                println!(
+                    "{:<9} {:>7} {:<8} {:<8} {:>11} {:>11} {:>7.2} {:>12.2} {:>12.2}",
+                    format,
+                    rows,
+                    codec,
+                    level,
+                    body.len(),
+                    compressed,
+                    body.len() as f64 / compressed as f64,
+                    elapsed.as_secs_f64() * 1000.0,
+                    transfer(compressed)
+                );
+            }
+        }
+    }
+}
+
+type Compress = fn(&[u8]) -> Vec<u8>;
+
+fn codecs() -> [(&'static str, &'static str, Compress); 9] {
+    [
+        ("gzip", "fastest", |body| gzip(body, 1)),
+        ("gzip", "default", |body| gzip(body, 6)),
+        ("gzip", "best", |body| gzip(body, 9)),
+        ("br", "fastest", |body| brotli(body, 0)),
+        ("br", "default", |body| brotli(body, 4)),
+        ("br", "best", |body| brotli(body, 11)),
+        ("zstd", "fastest", |body| zstd(body, 1)),
+        ("zstd", "default", |body| zstd(body, 3)),
+        ("zstd", "best", |body| zstd(body, 19)),
+    ]
+}
+
+// Best of three runs, to keep one-off stalls out of the numbers
+fn measure(body: &[u8], compress: Compress) -> (usize, Duration) {
+    (0..3)
+        .map(|_| {
+            let start = Instant::now();
+            let compressed = compress(body);
+            (compressed.len(), start.elapsed())
+        })
+        .min_by_key(|(_, elapsed)| *elapsed)
+        .unwrap()
+}
+
+fn gzip(body: &[u8], level: u32) -> Vec<u8> {
+    let mut encoder = flate2::write::GzEncoder::new(Vec::new(), flate2::Compression::new(level));
+    encoder.write_all(body).unwrap();
+    encoder.finish().unwrap()
+}
+
+fn brotli(body: &[u8], quality: u32) -> Vec<u8> {
+    let mut out = Vec::new();
+    let mut encoder = brotli::CompressorWriter::new(&mut out, 4096, quality, 22);
+    encoder.write_all(body).unwrap();
+    drop(encoder);
+    out
+}
+
+fn zstd(body: &[u8], level: i32) -> Vec<u8> {
+    zstd::stream::encode_all(body, level).unwrap()
+}
+
+// The mtcars rows as JSON objects, with ids like the cars table
+fn cars(count: usize) -> Vec<Map<String, Value>> {
+    let mut lines = MTCARS.lines();
+    let header: Vec<&str> = lines.next().unwrap().split(',').collect();
+    let rows: Vec<Vec<&str>> = lines.map(|line| line.split(',').collect()).collect();
+
+    (0..count)
+        .map(|i| {
+            let mut car = Map::new();
+            car.insert("id".to_string(), json!(i + 1));
+            for (name, value) in header.iter().zip(&rows[i % rows.len()]) {
+                let value = match value.parse::<f64>() {
+                    Ok(number) => json!(number),
+                    Err(_) => json!(value),
+                };
+                car.insert(name.to_string(), value);
+            }
+            car
+        })
+        .collect()
+}
+
+fn rows_body(count: usize) -> Vec<u8> {
+    let result: Vec<Value> = cars(count).into_iter().map(Value::Object).collect();
+    response(json!(result), count)
+}
+
+fn columnar_body(count: usize) -> Vec<u8> {
+    let cars = cars(count);
+    let names: Vec<String> = cars[0].keys().cloned().collect();
+    let columns: Vec<Value> = names
+        .iter()
+        .map(|name| {
+            let type_name = if cars[0][name].is_string() { "VARCHAR" } else { "FLOAT8" };
+            json!({ "name": name, "type": type_name })
+        })
+        .collect();
+    let data: Vec<Value> = names
+        .iter()
+        .map(|name| json!(cars.iter().map(|car| &car[name]).collect::<Vec<_>>()))
+        .collect();
+    response(json!({ "columns": columns, "data": data }), count)
+}
+
+fn response(result: Value, count: usize) -> Vec<u8> {
+    let response = json!({
+        "result": result,
+        "executed_query": "SELECT * FROM cars",
+        "truncated": false,
+        "row_count": count,
+    });
+    serde_json::to_vec(&response).unwrap()
+}
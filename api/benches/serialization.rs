@@ -0,0 +1,183 @@
+// Time and peak memory to serialize /api/query results of large sizes
+//
+// Compares building a Value per row with `ResultPlan::decode_value`,
+// collecting the rows and serializing the response, with the `ResultWriter`
+// the API uses, which writes each row straight into the output buffer as it is
+// decoded. Both read the same rows, fetched once from the cars table in
+// DATABASE_URL and repeated up to each result size. Peak memory is measured
+// with a counting allocator, above what the fetched rows already take.
+//
+//     DATABASE_URL=postgres://... cargo bench --bench serialization
+
+use std::alloc::{GlobalAlloc, Layout, System};
+use std::io;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::time::{Duration, Instant};
+
+use lucidata_api::budget::ResultWriter;
+use lucidata_api::decode::ResultPlan;
+use lucidata_api::models::ResultFormat;
+use serde::Serialize;
+use serde_json::{Map, Value};
+use sqlx::postgres::{PgPoolOptions, PgRow};
+use sqlx::Row;
+
+const ROW_COUNTS: [usize; 3] = [10_000, 100_000, 1_000_000];
+
+// Tracks the bytes allocated now and the most allocated at once
+struct CountingAllocator;
+
+static ALLOCATED: AtomicUsize = AtomicUsize::new(0);
+static PEAK: AtomicUsize = AtomicUsize::new(0);
+
+unsafe impl GlobalAlloc for CountingAllocator {
+    unsafe fn alloc(&self, layout: Layout) -> *mut u8 {
+        let ptr = System.alloc(layout);
+        if !ptr.is_null() {
+            let now = ALLOCATED.fetch_add(layout.size(), Ordering::Relaxed) + layout.size();
+            PEAK.fetch_max(now, Ordering::Relaxed);
+        }
+        ptr
+    }
+
+    unsafe fn dealloc(&self, ptr: *mut u8, layout: Layout) {
+        System.dealloc(ptr, layout);
+        ALLOCATED.fetch_sub(layout.size(), Ordering::Relaxed);
+    }
+}
+
+#[global_allocator]
+static GLOBAL: CountingAllocator = CountingAllocator;
+
+#[tokio::main]
+async fn main() {
+    let database_url = std::env::var("DATABASE_URL").expect("DATABASE_URL must be set");
+    let pool = PgPoolOptions::new()
+        .max_connections(1)
+        .connect(&database_url)
+        .await
+        .expect("could not connect to DATABASE_URL");
+    let cars: i64 = sqlx::query_scalar("SELECT count(*) FROM cars")
+        .fetch_one(&pool)
+        .await
+        .expect("could not count the cars");
+
+    println!(
+        "{:<9} {:>9} {:>12} {:>10} {:>10}",
+        "path", "rows", "bytes", "ms", "peak_mb"
+    );
+    for count in ROW_COUNTS {
+        let rows = sqlx::query("SELECT cars.* FROM generate_series(1, $1), cars LIMIT $2")
+            .bind(count as i64 / cars.max(1) + 1)
+            .bind(count as i64)
+            .fetch_all(&pool)
+            .await
+            .expect("could not fetch the cars");
+        for (path, serialize) in [
+            ("value", by_value as Body),
+            ("rows", rows_writer),
+            ("columnar", columnar_writer),
+        ] {
+            let (bytes, elapsed, peak) = measure(&rows, serialize);
+            println!(
+                "{:<9} {:>9} {:>12} {:>10.1} {:>10.1}",
+                path,
+                rows.len(),
+                bytes,
+                elapsed.as_secs_f64() * 1000.0,
+                peak as f64 / (1024.0 * 1024.0)
+            );
+        }
+    }
+}
+
+type Body = fn(&[PgRow]) -> Vec<u8>;
+
+// Best of three runs for the time, and the highest peak of the three
+fn measure(rows: &[PgRow], serialize: Body) -> (usize, Duration, usize) {
+    let mut best = Duration::MAX;
+    let (mut bytes, mut peak) = (0, 0);
+    for _ in 0..3 {
+        let baseline = ALLOCATED.load(Ordering::Relaxed);
+        PEAK.store(baseline, Ordering::Relaxed);
+        let start = Instant::now();
+        let body = serialize(rows);
+        best = best.min(start.elapsed());
+        bytes = body.len();
+        drop(body);
+        peak = peak.max(PEAK.load(Ordering::Relaxed) - baseline);
+    }
+    (bytes, best, peak)
+}
+
+// One Value per row, sized for the budget, collected and then serialized
+fn by_value(rows: &[PgRow]) -> Vec<u8> {
+    let Some(first) = rows.first() else {
+        return response(&Vec::<Value>::new(), 2);
+    };
+    let plan = ResultPlan::new(first.columns());
+    let mut values = Vec::with_capacity(rows.len());
+    let mut byte_count = 0;
+    for row in rows {
+        let mut map = Map::with_capacity(plan.columns.len());
+        for (i, column) in plan.columns.iter().enumerate() {
+            map.insert(column.name.clone(), plan.decode_value(row, i));
+        }
+        let value = Value::Object(map);
+        let mut counter = ByteCounter(0);
+        serde_json::to_writer(&mut counter, &value).unwrap();
+        byte_count += counter.0 + 1;
+        values.push(value);
+    }
+    response(&values, byte_count)
+}
+
+// Counts the bytes written to it without keeping them
+struct ByteCounter(usize);
+
+impl io::Write for ByteCounter {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        self.0 += buf.len();
+        Ok(buf.len())
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        Ok(())
+    }
+}
+
+// Each row serialized into the result as it is decoded, as /api/query does
+fn rows_writer(rows: &[PgRow]) -> Vec<u8> {
+    write(rows, ResultFormat::Rows)
+}
+
+fn columnar_writer(rows: &[PgRow]) -> Vec<u8> {
+    write(rows, ResultFormat::Columnar)
+}
+
+fn write(rows: &[PgRow], format: ResultFormat) -> Vec<u8> {
+    let mut writer = ResultWriter::new(format);
+    let mut byte_count = 0;
+    for row in rows {
+        byte_count += writer.push(row, usize::MAX).unwrap().unwrap();
+    }
+    let result = writer.finish().unwrap();
+    response(&result, byte_count)
+}
+
+fn response<T: Serialize>(result: &T, byte_count: usize) -> Vec<u8> {
+    #[derive(Serialize)]
+    struct Response<'a, T> {
+        result: &'a T,
+        executed_query: &'static str,
+        truncated: bool,
+        byte_count: usize,
+    }
+    serde_json::to_vec(&Response {
+        result,
+        executed_query: "SELECT * FROM cars",
+        truncated: false,
+        byte_count,
+    })
+    .unwrap()
+}
@@ -0,0 +1,1082 @@
+use std::collections::{BTreeMap, BTreeSet, HashMap};
+use std::ops::ControlFlow;
+use std::sync::{Arc, Mutex};
+use std::time::Duration;
+
+use serde::Serialize;
+use sqlparser::ast::{
+    visit_expressions, visit_expressions_mut, BinaryOperator, Expr, Ident, JoinConstraint,
+    JoinOperator, Query, Select, SelectItem, SetExpr, Statement, TableFactor, UnaryOperator, Value,
+};
+use sqlparser::dialect::PostgreSqlDialect;
+use sqlparser::parser::Parser;
+use sqlx::{PgConnection, PgPool};
+
+use crate::sql;
+use crate::workload;
+
+// Prefix of the indexes the advisor creates itself
+const INDEX_PREFIX: &str = "lucidata_idx_";
+
+// Query shapes remembered before the ones seen only once are forgotten
+const MAX_SHAPES: usize = 5_000;
+
+// Statements read from pg_stat_statements, by total execution time
+const MAX_STATEMENTS: i64 = 500;
+
+// Candidates whose benefit is estimated with hypothetical indexes, and example
+// queries explained for each
+const MAX_EVALUATED: usize = 20;
+const MAX_EXAMPLES: usize = 3;
+
+// Columns added with INCLUDE so a query can be answered from the index alone
+const MAX_INCLUDE: usize = 4;
+
+// Hypothetical plans must be at least this much cheaper for a candidate to
+// be recommended
+const MIN_BENEFIT: f64 = 0.01;
+
+// Whether and how often the advisor creates indexes itself, from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct AdvisorConfig {
+    pub auto_create: bool,
+    pub interval: Duration,
+    // Share of the estimated cost of its queries an index must save before it
+    // is created automatically
+    pub min_benefit: f64,
+}
+
+impl AdvisorConfig {
+    pub fn from_env() -> Self {
+        AdvisorConfig {
+            auto_create: crate::env_var("INDEX_ADVISOR_AUTO_CREATE", false),
+            interval: Duration::from_secs(crate::env_var("INDEX_ADVISOR_INTERVAL_SECS", 3600)),
+            min_benefit: crate::env_var("INDEX_ADVISOR_MIN_BENEFIT", 0.2),
+        }
+    }
+}
+
+// What the observed workload does with each table, and the indexes that
+// would serve it best
+#[derive(Serialize)]
+pub struct AdvisorReport {
+    // Whether weights are execution times from pg_stat_statements, rather
+    // than run counts
+    pub pg_stat_statements: bool,
+    // Whether benefits were estimated from hypothetical indexes (HypoPG)
+    pub hypothetical_plans: bool,
+    pub query_shapes: usize,
+    pub tables: Vec<TableUsage>,
+    pub recommendations: Vec<Recommendation>,
+}
+
+// Keys of one table used by the workload, with the weight of the queries
+// using them: milliseconds of execution time, or runs for queries without
+// timings
+#[derive(Serialize, Default)]
+pub struct TableUsage {
+    pub table: String,
+    pub weight: f64,
+    pub equality: BTreeMap<String, f64>,
+    pub range: BTreeMap<String, f64>,
+    pub joins: BTreeMap<String, f64>,
+    pub order_by: BTreeMap<String, f64>,
+    // Weight of the queries with a LIMIT
+    pub limited: f64,
+}
+
+#[derive(Serialize)]
+pub struct Recommendation {
+    pub table: String,
+    pub keys: Vec<String>,
+    pub include: Vec<String>,
+    // filter, sort or join
+    pub kind: &'static str,
+    pub statement: String,
+    pub query_shapes: usize,
+    pub weight: f64,
+    // Planner cost of the example queries without and with the index, and the
+    // share saved; absent without HypoPG or example queries
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub cost_before: Option<f64>,
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub cost_after: Option<f64>,
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub estimated_benefit: Option<f64>,
+    // Weight times benefit where it was estimated, otherwise the weight;
+    // recommendations are ordered by it
+    pub score: f64,
+}
+
+// A query with its literals replaced, as pg_stat_statements groups them
+struct Shape {
+    // The last query run with this shape, for explaining
+    example: Option<String>,
+    // The statement as pg_stat_statements has it, with parameters in place of
+    // literals, for shapes the service did not run itself
+    normalized: Option<String>,
+    runs: u64,
+    total_time_ms: Option<f64>,
+}
+
+// How one query uses one table
+#[derive(Default)]
+struct TableAccess {
+    equality: Vec<String>,
+    range: Vec<String>,
+    joins: Vec<String>,
+    order_by: Vec<String>,
+    // Columns read from the table, or None if they are not all known
+    columns: Option<BTreeSet<String>>,
+}
+
+struct Candidate {
+    table: String,
+    keys: Vec<String>,
+    include: Option<BTreeSet<String>>,
+    kind: &'static str,
+    shapes: usize,
+    weight: f64,
+    examples: Vec<String>,
+}
+
+// Suggests indexes from the filters, join keys and sort keys of the queries
+// the service runs
+//
+// Every query is counted by shape. Reports combine those counts with
+// execution times from pg_stat_statements when the extension is installed,
+// and estimate the benefit of each candidate index by explaining example
+// queries with and without it as a hypothetical index when HypoPG is.
+pub struct IndexAdvisor {
+    config: AdvisorConfig,
+    pool: PgPool,
+    // By shape
+    shapes: Mutex<HashMap<String, Shape>>,
+}
+
+impl IndexAdvisor {
+    pub fn new(config: AdvisorConfig, pool: PgPool) -> Self {
+        IndexAdvisor {
+            config,
+            pool,
+            shapes: Mutex::new(HashMap::new()),
+        }
+    }
+
+    // Count a run of `query`
+    pub fn record(&self, query: &str) {
+        if sql::read_only_statement(query).is_err() {
+            return;
+        }
+        let shape = match shape(query) {
+            Some(shape) => shape,
+            None => return,
+        };
+
+        let mut shapes = self.shapes.lock().unwrap();
+        if shapes.len() >= MAX_SHAPES && !shapes.contains_key(&shape) {
+            shapes.retain(|_, shape| shape.runs > 1);
+            if shapes.len() >= MAX_SHAPES {
+                return;
+            }
+        }
+        let entry = shapes.entry(shape).or_insert(Shape {
+            example: None,
+            normalized: None,
+            runs: 0,
+            total_time_ms: None,
+        });
+        entry.runs += 1;
+        entry.example = Some(query.to_string());
+    }
+
+    // Analyze the workload and rank the indexes it is missing
+    pub async fn recommend(&self) -> Result<AdvisorReport, sqlx::Error> {
+        let (shapes, timed) = self.workload().await;
+
+        let mut usage: BTreeMap<String, TableUsage> = BTreeMap::new();
+        let mut candidates: BTreeMap<(String, Vec<String>), Candidate> = BTreeMap::new();
+        for shape in &shapes {
+            let Some(text) = shape.example.as_ref().or(shape.normalized.as_ref()) else {
+                continue;
+            };
+            let (tables, limited) = match analyze(text) {
+                Some(analysis) => analysis,
+                None => continue,
+            };
+            let weight = shape.total_time_ms.unwrap_or(shape.runs as f64);
+
+            for (table, access) in tables {
+                // System catalogs
+                if table.starts_with("pg_") {
+                    continue;
+                }
+                let entry = usage.entry(table.clone()).or_insert_with(|| TableUsage {
+                    table: table.clone(),
+                    ..Default::default()
+                });
+                entry.weight += weight;
+                for (keys, map) in [
+                    (&access.equality, &mut entry.equality),
+                    (&access.range, &mut entry.range),
+                    (&access.joins, &mut entry.joins),
+                    (&access.order_by, &mut entry.order_by),
+                ] {
+                    for key in keys {
+                        *map.entry(key.clone()).or_insert(0.0) += weight;
+                    }
+                }
+                if limited {
+                    entry.limited += weight;
+                }
+
+                for (kind, keys) in candidate_keys(&access) {
+                    let include = access.columns.as_ref().map(|columns| {
+                        columns
+                            .iter()
+                            .filter(|column| !keys.contains(column))
+                            .cloned()
+                            .collect::<BTreeSet<_>>()
+                    });
+                    let candidate = candidates
+                        .entry((table.clone(), keys.clone()))
+                        .or_insert_with(|| Candidate {
+                            table: table.clone(),
+                            keys,
+                            include: Some(BTreeSet::new()),
+                            kind,
+                            shapes: 0,
+                            weight: 0.0,
+                            examples: Vec::new(),
+                        });
+                    candidate.shapes += 1;
+                    candidate.weight += weight;
+                    // Covering only pays off if it covers every query using
+                    // the index
+                    candidate.include = match (candidate.include.take(), include) {
+                        (Some(mut all), Some(columns)) => {
+                            all.extend(columns);
+                            (all.len() <= MAX_INCLUDE).then_some(all)
+                        }
+                        _ => None,
+                    };
+                    if let Some(example) = &shape.example {
+                        if candidate.examples.len() < MAX_EXAMPLES {
+                            candidate.examples.push(example.clone());
+                        }
+                    }
+                }
+            }
+        }
+
+        // Leave out what existing indexes already serve
+        let mut existing: HashMap<String, Option<Vec<Vec<String>>>> = HashMap::new();
+        for table in usage.keys() {
+            existing.insert(table.clone(), self.index_keys(table).await?);
+        }
+        let mut candidates: Vec<Candidate> = candidates
+            .into_values()
+            .filter(|candidate| match &existing[&candidate.table] {
+                Some(indexes) => !indexes.iter().any(|index| covers(index, &candidate.keys)),
+                // Not a table
+                None => false,
+            })
+            .collect();
+        candidates.sort_by(|a, b| b.weight.total_cmp(&a.weight));
+
+        let hypothetical = self.has_hypopg().await?;
+        let mut recommendations: Vec<Recommendation> =
+            candidates.iter().map(recommendation).collect();
+        if hypothetical {
+            let evaluated = MAX_EVALUATED.min(candidates.len());
+            let benefits = self.hypothetical_costs(&candidates[..evaluated]).await?;
+            for (recommendation, costs) in recommendations.iter_mut().zip(benefits) {
+                if let Some((before, after)) = costs {
+                    let benefit = (1.0 - after / before).max(0.0);
+                    recommendation.cost_before = Some(before);
+                    recommendation.cost_after = Some(after);
+                    recommendation.estimated_benefit = Some(benefit);
+                    recommendation.score = recommendation.weight * benefit;
+                }
+            }
+            // The planner would not use these
+            recommendations.retain(|recommendation| {
+                recommendation
+                    .estimated_benefit
+                    .map_or(true, |benefit| benefit >= MIN_BENEFIT)
+            });
+        }
+        recommendations.sort_by(|a, b| b.score.total_cmp(&a.score));
+
+        let mut tables: Vec<TableUsage> = usage.into_values().collect();
+        tables.sort_by(|a, b| b.weight.total_cmp(&a.weight));
+        Ok(AdvisorReport {
+            pg_stat_statements: timed,
+            hypothetical_plans: hypothetical,
+            query_shapes: shapes.len(),
+            tables,
+            recommendations,
+        })
+    }
+
+    // The summed planner cost of the example queries of each candidate without
+    // and with it as a hypothetical index, or None if none could be explained
+    //
+    // Hypothetical indexes only exist on the connection that created them and
+    // are only seen by EXPLAIN, but the connection goes back to the pool, so
+    // they are always removed again.
+    async fn hypothetical_costs(
+        &self,
+        candidates: &[Candidate],
+    ) -> Result<Vec<Option<(f64, f64)>>, sqlx::Error> {
+        let mut conn = self.pool.acquire().await?;
+        let mut before: HashMap<&str, Option<f64>> = HashMap::new();
+        for candidate in candidates {
+            for example in &candidate.examples {
+                if !before.contains_key(example.as_str()) {
+                    before.insert(example.as_str(), explain(&mut conn, example).await);
+                }
+            }
+        }
+
+        let mut costs = Vec::with_capacity(candidates.len());
+        let mut result = Ok(());
+        for candidate in candidates {
+            result = sqlx::query("SELECT * FROM hypopg_create_index($1)")
+                .bind(create_statement(candidate, None))
+                .execute(&mut *conn)
+                .await
+                .map(|_| ());
+            if result.is_err() {
+                break;
+            }
+
+            let (mut total_before, mut total_after) = (0.0, 0.0);
+            for example in &candidate.examples {
+                if let (Some(cost), Some(hypothetical)) =
+                    (before[example.as_str()], explain(&mut conn, example).await)
+                {
+                    total_before += cost;
+                    total_after += hypothetical;
+                }
+            }
+            costs.push((total_before > 0.0).then_some((total_before, total_after)));
+
+            result = sqlx::query("SELECT hypopg_reset()")
+                .execute(&mut *conn)
+                .await
+                .map(|_| ());
+            if result.is_err() {
+                break;
+            }
+        }
+
+        if result.is_err() {
+            // Close the connection rather than return it to the pool with
+            // hypothetical indexes the cost guard's plans would see
+            let _ = sqlx::query("SELECT hypopg_reset()")
+                .execute(&mut *conn)
+                .await;
+            drop(conn.detach());
+        }
+        result.map(|_| costs)
+    }
+
+    // The recorded shapes, merged with the statements in pg_stat_statements
+    // and their execution times when it is installed
+    async fn workload(&self) -> (Vec<Shape>, bool) {
+        let mut shapes: HashMap<String, Shape> = self
+            .shapes
+            .lock()
+            .unwrap()
+            .iter()
+            .map(|(text, shape)| {
+                let copy = Shape {
+                    example: shape.example.clone(),
+                    normalized: None,
+                    runs: shape.runs,
+                    total_time_ms: None,
+                };
+                (text.clone(), copy)
+            })
+            .collect();
+
+        let statements: Vec<(String, i64, f64)> = match sqlx::query_as(
+            "SELECT query, calls, total_exec_time FROM pg_stat_statements \
+             WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) \
+             ORDER BY total_exec_time DESC LIMIT $1",
+        )
+        .bind(MAX_STATEMENTS)
+        .fetch_all(&self.pool)
+        .await
+        {
+            Ok(statements) => statements,
+            Err(e) => {
+                tracing::debug!("pg_stat_statements is not available: {}", e);
+                return (shapes.into_values().collect(), false);
+            }
+        };
+
+        // Statements that differ only in their literals share an entry
+        for (query, calls, total_time_ms) in statements {
+            let Some(text) = shape(&query) else {
+                continue;
+            };
+            let entry = shapes.entry(text).or_insert(Shape {
+                example: None,
+                normalized: None,
+                runs: 0,
+                total_time_ms: None,
+            });
+            entry.runs = entry.runs.max(calls as u64);
+            entry.normalized.get_or_insert(query);
+            *entry.total_time_ms.get_or_insert(0.0) += total_time_ms;
+        }
+        (shapes.into_values().collect(), true)
+    }
+
+    // The key columns of each index on `table`, as Postgres prints them, or
+    // None if it is not a table
+    async fn index_keys(&self, table: &str) -> Result<Option<Vec<Vec<String>>>, sqlx::Error> {
+        let kind: Option<String> =
+            sqlx::query_scalar("SELECT relkind::text FROM pg_class WHERE oid = to_regclass($1)")
+                .bind(table)
+                .fetch_optional(&self.pool)
+                .await?;
+        if !matches!(kind.as_deref(), Some("r") | Some("p")) {
+            return Ok(None);
+        }
+
+        let keys: Vec<(i64, String)> = sqlx::query_as(
+            "SELECT i.indexrelid::bigint, pg_get_indexdef(i.indexrelid, k, true) \
+             FROM pg_index i, generate_series(1, i.indnkeyatts) k \
+             WHERE i.indrelid = to_regclass($1) AND i.indisvalid \
+             ORDER BY 1, k",
+        )
+        .bind(table)
+        .fetch_all(&self.pool)
+        .await?;
+
+        let mut indexes: Vec<(i64, Vec<String>)> = Vec::new();
+        for (index, key) in keys {
+            match indexes.last_mut() {
+                Some((last, columns)) if *last == index => columns.push(key),
+                _ => indexes.push((index, vec![key])),
+            }
+        }
+        Ok(Some(
+            indexes.into_iter().map(|(_, columns)| columns).collect(),
+        ))
+    }
+
+    async fn has_hypopg(&self) -> Result<bool, sqlx::Error> {
+        sqlx::query_scalar("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hypopg')")
+            .fetch_one(&self.pool)
+            .await
+    }
+
+    // Create the best recommendation every `interval`, if auto-creation is
+    // enabled and its estimated benefit is large enough
+    //
+    // Only recommendations with a benefit estimated from hypothetical plans
+    // are considered, so nothing is created without HypoPG.
+    pub fn spawn_auto_create(self: &Arc<Self>) {
+        if !self.config.auto_create {
+            return;
+        }
+
+        let advisor = Arc::clone(self);
+        tokio::spawn(async move {
+            let mut interval = tokio::time::interval(advisor.config.interval);
+            // The first tick completes immediately, before any queries ran
+            interval.tick().await;
+            loop {
+                interval.tick().await;
+                if let Err(e) = advisor.create_best().await {
+                    tracing::warn!("Index advisor failed: {}", e);
+                }
+            }
+        });
+    }
+
+    async fn create_best(&self) -> Result<(), sqlx::Error> {
+        let report = self.recommend().await?;
+        let best = report.recommendations.into_iter().find(|recommendation| {
+            recommendation
+                .estimated_benefit
+                .map_or(false, |benefit| benefit >= self.config.min_benefit)
+        });
+        let Some(best) = best else {
+            return Ok(());
+        };
+
+        let name = format!("{}{:016x}", INDEX_PREFIX, sql::stable_hash(&best.statement));
+        let statement = best.statement.replacen(
+            "CREATE INDEX CONCURRENTLY ON",
+            &format!("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON", name),
+            1,
+        );
+        tracing::info!("Creating index: {}", statement);
+
+        // Building an index can take longer than any query may, and
+        // CONCURRENTLY cannot run inside a transaction, so the connection's
+        // own timeout is lifted for the build and restored after
+        let mut conn = self.pool.acquire().await?;
+        let timeout: String = sqlx::query_scalar("SHOW statement_timeout")
+            .fetch_one(&mut *conn)
+            .await?;
+        sqlx::query("SET statement_timeout = 0")
+            .execute(&mut *conn)
+            .await?;
+        let created = sqlx::query(&statement).execute(&mut *conn).await;
+        if created.is_err() {
+            // A failed concurrent build leaves an invalid index behind
+            let _ = sqlx::query(&format!("DROP INDEX CONCURRENTLY IF EXISTS {}", name))
+                .execute(&mut *conn)
+                .await;
+        }
+        sqlx::query("SELECT set_config('statement_timeout', $1, false)")
+            .bind(timeout)
+            .execute(&mut *conn)
+            .await?;
+        created?;
+
+        tracing::info!("Created index {}", name);
+        Ok(())
+    }
+}
+
+// The estimated cost of `query`, or None if it cannot be explained
+async fn explain(conn: &mut PgConnection, query: &str) -> Option<f64> {
+    let statement = sql::read_only_statement(query).ok()?;
+    workload::explain(conn, &statement)
+        .await
+        .ok()
+        .map(|estimate| estimate.cost)
+}
+
+fn recommendation(candidate: &Candidate) -> Recommendation {
+    let include: Vec<String> = candidate.include.iter().flatten().cloned().collect();
+    Recommendation {
+        table: candidate.table.clone(),
+        keys: candidate.keys.clone(),
+        statement: create_statement(candidate, Some("CONCURRENTLY")),
+        include,
+        kind: candidate.kind,
+        query_shapes: candidate.shapes,
+        weight: candidate.weight,
+        cost_before: None,
+        cost_after: None,
+        estimated_benefit: None,
+        score: candidate.weight,
+    }
+}
+
+fn create_statement(candidate: &Candidate, option: Option<&str>) -> String {
+    let mut statement = format!(
+        "CREATE INDEX {}ON {} ({})",
+        option
+            .map(|option| format!("{} ", option))
+            .unwrap_or_default(),
+        quote_ident(&candidate.table),
+        candidate.keys.join(", ")
+    );
+    if let Some(include) = candidate
+        .include
+        .as_ref()
+        .filter(|include| !include.is_empty())
+    {
+        let include: Vec<String> = include.iter().map(|column| quote_ident(column)).collect();
+        statement.push_str(&format!(" INCLUDE ({})", include.join(", ")));
+    }
+    statement
+}
+
+// The indexes worth having for one query on one table: its equality keys
+// followed by its first range key, its equality keys followed by its sort
+// keys, and each join key
+fn candidate_keys(access: &TableAccess) -> Vec<(&'static str, Vec<String>)> {
+    let mut candidates = Vec::new();
+    let mut filter = access.equality.clone();
+    filter.extend(access.range.first().cloned());
+    if !filter.is_empty() {
+        candidates.push(("filter", filter));
+    }
+    if !access.order_by.is_empty() {
+        let mut sort = access.equality.clone();
+        sort.extend(access.order_by.iter().cloned());
+        candidates.push(("sort", sort));
+    }
+    for key in &access.joins {
+        candidates.push(("join", vec![key.clone()]));
+    }
+    candidates.dedup_by(|a, b| a.1 == b.1);
+    candidates
+}
+
+// Whether an index on `index` can serve lookups on `keys`, i.e. starts with them
+fn covers(index: &[String], keys: &[String]) -> bool {
+    let normalize = |key: &String| {
+        let key: String = key
+            .chars()
+            .filter(|c| !c.is_whitespace())
+            .collect::<String>()
+            .to_lowercase();
+        key.trim_start_matches('(')
+            .trim_end_matches(')')
+            .to_string()
+    };
+    index.len() >= keys.len()
+        && index
+            .iter()
+            .zip(keys)
+            .all(|(indexed, key)| normalize(indexed) == normalize(key))
+}
+
+// `query` with every literal replaced by `?`, lowercased, so queries that
+// differ only in their constants map to the same text. pg_stat_statements
+// replaces literals with $1, $2, ... which map to the same text too.
+fn shape(query: &str) -> Option<String> {
+    let mut statements = Parser::parse_sql(&PostgreSqlDialect {}, query).ok()?;
+    if statements.len() != 1 {
+        return None;
+    }
+    let mut statement = statements.pop()?;
+    if !matches!(statement, Statement::Query(_)) {
+        return None;
+    }
+
+    let placeholder = || Expr::Value(Value::Placeholder("?".to_string()));
+    let _ = visit_expressions_mut(&mut statement, |expr| {
+        let literal = match expr {
+            Expr::Value(_) => true,
+            Expr::UnaryOp {
+                op: UnaryOperator::Minus,
+                expr: inner,
+            } => matches!(inner.as_ref(), Expr::Value(_)),
+            _ => false,
+        };
+        if literal {
+            *expr = placeholder();
+        }
+        ControlFlow::<()>::Continue(())
+    });
+    Some(statement.to_string().to_lowercase())
+}
+
+// The tables a SELECT reads and how it uses each of them, and whether it has a
+// LIMIT
+//
+// Only the outermost SELECT is analyzed. Unqualified columns are attributed
+// to the table only when there is a single one, since the catalog is not
+// consulted.
+fn analyze(query: &str) -> Option<(BTreeMap<String, TableAccess>, bool)> {
+    let statements = Parser::parse_sql(&PostgreSqlDialect {}, query).ok()?;
+    let [Statement::Query(query)] = statements.as_slice() else {
+        return None;
+    };
+    let SetExpr::Select(select) = query.body.as_ref() else {
+        return None;
+    };
+
+    // Tables by the name they are referred to with; None for subqueries and
+    // other relations that are not tables
+    let mut relations: Vec<(String, Option<String>)> = Vec::new();
+    let mut join_conditions = Vec::new();
+    let mut using = Vec::new();
+    for from in &select.from {
+        relations.push(relation(&from.relation));
+        for join in &from.joins {
+            let (name, table) = relation(&join.relation);
+            match &join.join_operator {
+                JoinOperator::Inner(constraint)
+                | JoinOperator::LeftOuter(constraint)
+                | JoinOperator::RightOuter(constraint)
+                | JoinOperator::FullOuter(constraint) => match constraint {
+                    JoinConstraint::On(condition) => join_conditions.push(condition),
+                    // Only the joined table is known to have the columns
+                    // without the catalog
+                    JoinConstraint::Using(columns) => {
+                        if let Some(table) = &table {
+                            using.extend(
+                                columns
+                                    .iter()
+                                    .map(|column| (table.clone(), ident_name(column))),
+                            );
+                        }
+                    }
+                    _ => {}
+                },
+                _ => {}
+            }
+            relations.push((name, table));
+        }
+    }
+    let scope = Scope {
+        relations: &relations,
+        aliases: select
+            .projection
+            .iter()
+            .filter_map(|item| match item {
+                SelectItem::ExprWithAlias { expr, alias } => Some((ident_name(alias), expr)),
+                _ => None,
+            })
+            .collect(),
+    };
+
+    let mut tables: BTreeMap<String, TableAccess> = relations
+        .iter()
+        .filter_map(|(_, table)| table.clone())
+        .map(|table| (table, TableAccess::default()))
+        .collect();
+    if tables.is_empty() {
+        return None;
+    }
+
+    for (table, column) in using {
+        tables
+            .entry(table)
+            .or_default()
+            .joins
+            .push(quote_ident(&column));
+    }
+    let conditions = select.selection.iter().chain(join_conditions);
+    for condition in conditions {
+        for conjunct in conjuncts(condition) {
+            scope.condition(conjunct, &mut tables);
+        }
+    }
+    scope.order_by(query, &select.projection, &mut tables);
+    scope.columns(query, select, &mut tables);
+
+    for access in tables.values_mut() {
+        for keys in [
+            &mut access.equality,
+            &mut access.range,
+            &mut access.joins,
+            &mut access.order_by,
+        ] {
+            let mut seen = BTreeSet::new();
+            keys.retain(|key| seen.insert(key.clone()));
+        }
+    }
+    Some((tables, query.limit.is_some()))
+}
+
+// Names in scope in one SELECT
+struct Scope<'a> {
+    relations: &'a [(String, Option<String>)],
+    // Output columns by alias, which ORDER BY may refer to
+    aliases: HashMap<String, &'a Expr>,
+}
+
+impl Scope<'_> {
+    // The table a column qualified with `qualifier`, if any, belongs to
+    fn resolve(&self, qualifier: Option<&Ident>) -> Option<&str> {
+        match qualifier {
+            Some(qualifier) => {
+                let name = ident_name(qualifier);
+                self.relations
+                    .iter()
+                    .find(|(relation, _)| *relation == name)
+                    .and_then(|(_, table)| table.as_deref())
+            }
+            None => match self.relations {
+                [(_, table)] => table.as_deref(),
+                _ => None,
+            },
+        }
+    }
+
+    // The one table whose columns `expr` reads, if it reads columns of
+    // exactly one table and nothing else
+    fn owner(&self, expr: &Expr) -> Option<String> {
+        let mut owner: Option<String> = None;
+        let result = visit_expressions(expr, |expr| {
+            let table = match expr {
+                Expr::Identifier(_) => self.resolve(None),
+                Expr::CompoundIdentifier(idents) if idents.len() >= 2 => {
+                    self.resolve(idents.get(idents.len() - 2))
+                }
+                Expr::CompoundIdentifier(_)
+                | Expr::Subquery(_)
+                | Expr::Exists { .. }
+                | Expr::InSubquery { .. } => return ControlFlow::Break(()),
+                _ => return ControlFlow::Continue(()),
+            };
+            let Some(table) = table else {
+                return ControlFlow::Break(());
+            };
+            if matches!(&owner, Some(owner) if owner.as_str() != table) {
+                return ControlFlow::Break(());
+            }
+            owner = Some(table.to_string());
+            ControlFlow::Continue(())
+        });
+        if result.is_break() || sql::contains_aggregate(expr) {
+            return None;
+        }
+        owner
+    }
+
+    // Record the keys one condition of a WHERE or JOIN ON clause filters or
+    // joins on
+    fn condition(&self, expr: &Expr, tables: &mut BTreeMap<String, TableAccess>) {
+        match expr {
+            Expr::BinaryOp { left, op, right } => {
+                let range = match op {
+                    BinaryOperator::Eq => false,
+                    BinaryOperator::Lt
+                    | BinaryOperator::LtEq
+                    | BinaryOperator::Gt
+                    | BinaryOperator::GtEq => true,
+                    _ => return,
+                };
+                match (self.owner(left), self.owner(right)) {
+                    (Some(a), Some(b)) if a != b && !range => {
+                        tables.entry(a).or_default().joins.push(key(left));
+                        tables.entry(b).or_default().joins.push(key(right));
+                    }
+                    (Some(table), None) if is_constant(right) => {
+                        add_filter(tables, table, key(left), range)
+                    }
+                    (None, Some(table)) if is_constant(left) => {
+                        add_filter(tables, table, key(right), range)
+                    }
+                    _ => {}
+                }
+            }
+            Expr::Between {
+                expr,
+                negated: false,
+                low,
+                high,
+            } if is_constant(low) && is_constant(high) => {
+                if let Some(table) = self.owner(expr) {
+                    add_filter(tables, table, key(expr), true);
+                }
+            }
+            Expr::InList {
+                expr,
+                list,
+                negated: false,
+            } if list.iter().all(is_constant) => {
+                if let Some(table) = self.owner(expr) {
+                    add_filter(tables, table, key(expr), false);
+                }
+            }
+            Expr::IsNull(expr) => {
+                if let Some(table) = self.owner(expr) {
+                    add_filter(tables, table, key(expr), false);
+                }
+            }
+            _ => {}
+        }
+    }
+
+    // Record the sort keys of the query if they are all on one table, which
+    // an index can then return in order
+    //
+    // Keys can be output column aliases or positions. The direction is kept
+    // only when it differs between keys, since a btree is read either way.
+    fn order_by(
+        &self,
+        query: &Query,
+        projection: &[SelectItem],
+        tables: &mut BTreeMap<String, TableAccess>,
+    ) {
+        let mut keys = Vec::new();
+        let mut owner = None;
+        let mixed = query
+            .order_by
+            .windows(2)
+            .any(|pair| pair[0].asc.unwrap_or(true) != pair[1].asc.unwrap_or(true));
+        for order in &query.order_by {
+            let expr = match &order.expr {
+                Expr::Identifier(ident) => self
+                    .aliases
+                    .get(&ident_name(ident))
+                    .copied()
+                    .unwrap_or(&order.expr),
+                Expr::Value(Value::Number(position, _)) => {
+                    match position
+                        .parse::<usize>()
+                        .ok()
+                        .and_then(|i| projection.get(i.wrapping_sub(1)))
+                    {
+                        Some(SelectItem::UnnamedExpr(expr))
+                        | Some(SelectItem::ExprWithAlias { expr, .. }) => expr,
+                        _ => return,
+                    }
+                }
+                expr => expr,
+            };
+            let table = match self.owner(expr) {
+                Some(table) => table,
+                None => return,
+            };
+            if *owner.get_or_insert_with(|| table.clone()) != table {
+                return;
+            }
+            let mut key = key(expr);
+            if mixed && order.asc == Some(false) {
+                key.push_str(" DESC");
+            }
+            keys.push(key);
+        }
+        if let Some(table) = owner {
+            tables.entry(table).or_default().order_by = keys;
+        }
+    }
+
+    // Record the columns the query reads from each table, when they are all
+    // known: no `*`, no subqueries and no unqualified columns in joins
+    fn columns(&self, query: &Query, select: &Select, tables: &mut BTreeMap<String, TableAccess>) {
+        let mut columns: BTreeMap<String, BTreeSet<String>> = BTreeMap::new();
+        let known = query.with.is_none()
+            && select.projection.iter().all(|item| {
+                matches!(
+                    item,
+                    SelectItem::UnnamedExpr(_) | SelectItem::ExprWithAlias { .. }
+                )
+            })
+            && visit_expressions(query, |expr| {
+                let (table, column) = match expr {
+                    Expr::Identifier(ident) if self.aliases.contains_key(&ident_name(ident)) => {
+                        return ControlFlow::Continue(())
+                    }
+                    Expr::Identifier(ident) => (self.resolve(None), ident),
+                    Expr::CompoundIdentifier(idents) if idents.len() >= 2 => (
+                        self.resolve(idents.get(idents.len() - 2)),
+                        &idents[idents.len() - 1],
+                    ),
+                    Expr::CompoundIdentifier(_)
+                    | Expr::Subquery(_)
+                    | Expr::Exists { .. }
+                    | Expr::InSubquery { .. } => return ControlFlow::Break(()),
+                    _ => return ControlFlow::Continue(()),
+                };
+                match table {
+                    Some(table) => {
+                        columns
+                            .entry(table.to_string())
+                            .or_default()
+                            .insert(ident_name(column));
+                        ControlFlow::Continue(())
+                    }
+                    None => ControlFlow::Break(()),
+                }
+            })
+            .is_continue();
+
+        if known {
+            for (table, access) in tables.iter_mut() {
+                access.columns = Some(columns.remove(table).unwrap_or_default());
+            }
+        }
+    }
+}
+
+fn add_filter(tables: &mut BTreeMap<String, TableAccess>, table: String, key: String, range: bool) {
+    let access = tables.entry(table).or_default();
+    if range {
+        access.range.push(key);
+    } else {
+        access.equality.push(key);
+    }
+}
+
+// The name a relation is referred to with, and its table if it is one
+fn relation(factor: &TableFactor) -> (String, Option<String>) {
+    match factor {
+        TableFactor::Table { name, alias, .. } => {
+            let table = name.0.last().map(ident_name).unwrap_or_default();
+            let name = alias
+                .as_ref()
+                .map(|alias| ident_name(&alias.name))
+                .unwrap_or_else(|| table.clone());
+            (name, Some(table))
+        }
+        TableFactor::Derived {
+            alias: Some(alias), ..
+        } => (ident_name(&alias.name), None),
+        _ => (String::new(), None),
+    }
+}
+
+// The conditions of an AND chain
+fn conjuncts(expr: &Expr) -> Vec<&Expr> {
+    match expr {
+        Expr::BinaryOp {
+            left,
+            op: BinaryOperator::And,
+            right,
+        } => {
+            let mut conjuncts = conjuncts(left);
+            conjuncts.extend(self::conjuncts(right));
+            conjuncts
+        }
+        Expr::Nested(expr) => conjuncts(expr),
+        expr => vec![expr],
+    }
+}
+
+// Whether `expr` reads no columns, e.g. a literal or a parameter
+fn is_constant(expr: &Expr) -> bool {
+    visit_expressions(expr, |expr| match expr {
+        Expr::Identifier(_)
+        | Expr::CompoundIdentifier(_)
+        | Expr::Subquery(_)
+        | Expr::Exists { .. }
+        | Expr::InSubquery { .. } => ControlFlow::Break(()),
+        _ => ControlFlow::Continue(()),
+    })
+    .is_continue()
+}
+
+// `expr` as an index key: a column name, or an expression in parentheses,
+// with table qualifiers removed
+fn key(expr: &Expr) -> String {
+    let mut expr = expr;
+    while let Expr::Nested(inner) = expr {
+        expr = inner.as_ref();
+    }
+    let mut expr = expr.clone();
+    let _ = visit_expressions_mut(&mut expr, |expr| {
+        if let Expr::CompoundIdentifier(idents) = expr {
+            if let Some(column) = idents.pop() {
+                *expr = Expr::Identifier(column);
+            }
+        }
+        if let Expr::Identifier(ident) = expr {
+            if ident.quote_style.is_none() {
+                ident.value = ident.value.to_lowercase();
+            }
+        }
+        ControlFlow::<()>::Continue(())
+    });
+    match expr {
+        Expr::Identifier(ident) => ident.to_string(),
+        expr => format!("({})", expr),
+    }
+}
+
+// Unquoted identifiers are folded to lowercase
+fn ident_name(ident: &Ident) -> String {
+    match ident.quote_style {
+        Some(_) => ident.value.clone(),
+        None => ident.value.to_lowercase(),
+    }
+}
+
+fn quote_ident(name: &str) -> String {
+    let plain = name
+        .chars()
+        .all(|c| c.is_ascii_lowercase() || c.is_ascii_digit() || c == '_')
+        && !name.starts_with(|c: char| c.is_ascii_digit());
+    if plain {
+        name.to_string()
+    } else {
+        format!("\"{}\"", name.replace('"', "\"\""))
+    }
+}
@@ -0,0 +1,600 @@
+use axum::http::StatusCode;
+use serde::Serialize;
+use serde_json::{json, Map, Value};
+use sqlparser::ast::{
+    Expr, FunctionArg, FunctionArgExpr, GroupByExpr, Ident, ObjectName, SelectItem, SetExpr,
+    Statement, TableFactor, Value as SqlValue,
+};
+use sqlparser::dialect::PostgreSqlDialect;
+use sqlparser::parser::Parser;
+use sqlx::PgPool;
+
+use crate::sql;
+
+// z-score of the reported confidence intervals
+const Z_95: f64 = 1.96;
+
+// How large a sample approximate queries read, from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct SamplingConfig {
+    // Rows the sample should hold; the sampling rate is chosen from the
+    // planner's row estimate for the table to get close to it
+    pub target_rows: f64,
+    // Tables with at least this many rows are sampled by block (SYSTEM), which
+    // reads less but is less accurate, smaller ones by row (BERNOULLI)
+    pub system_min_rows: f64,
+}
+
+impl SamplingConfig {
+    pub fn from_env() -> Self {
+        SamplingConfig {
+            target_rows: crate::env_var("APPROX_TARGET_ROWS", 100_000.0),
+            system_min_rows: crate::env_var("APPROX_SYSTEM_MIN_ROWS", 10_000_000.0),
+        }
+    }
+}
+
+// How an approximate result was produced, returned with it
+#[derive(Serialize, Debug)]
+pub struct Approximation {
+    pub table: String,
+    // BERNOULLI or SYSTEM
+    pub method: &'static str,
+    // Share of the table's rows that were read
+    pub sample_fraction: f64,
+    pub confidence_level: f64,
+    // One entry per result row with the [low, high] interval of every
+    // estimated column
+    pub intervals: Vec<Map<String, Value>>,
+}
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum Aggregate {
+    Count,
+    Sum,
+    Avg,
+}
+
+enum OutputColumn {
+    // Copied from the sampled row, e.g. a GROUP BY column
+    Plain { name: String },
+    // Scaled up from statistics of the sample
+    Estimate { name: String, aggregate: Aggregate },
+}
+
+impl OutputColumn {
+    fn name(&self) -> &str {
+        match self {
+            OutputColumn::Plain { name } | OutputColumn::Estimate { name, .. } => name,
+        }
+    }
+
+    // The column of the sampled statement that sorts like the `i`th result
+    // column. Estimates are the sample statistic divided by the sampling
+    // fraction, or the sample mean itself, so they sort like the statistic.
+    fn sort_column(&self, i: usize) -> Ident {
+        let prefix = match self {
+            OutputColumn::Plain { .. } => "g",
+            OutputColumn::Estimate { aggregate, .. } => match aggregate {
+                Aggregate::Count => "n",
+                Aggregate::Sum => "s",
+                Aggregate::Avg => "a",
+            },
+        };
+        Ident::with_quote('"', format!("{}{}", prefix, i))
+    }
+}
+
+// A query that can be answered from a sample of its table: a single-table
+// SELECT whose aggregates are plain COUNT, SUM or AVG, without DISTINCT or
+// HAVING
+//
+// The aggregates are replaced by the sample statistics needed to scale them
+// up and to estimate their variance, in columns named after their position.
+// ORDER BY and GROUP BY keys that refer to result columns by position or name
+// are pointed at the replacement columns.
+pub struct SamplePlan {
+    statement: Statement,
+    table: String,
+    columns: Vec<OutputColumn>,
+}
+
+// A sampled statement, ready to run
+pub struct Sampled {
+    pub sql: String,
+    method: &'static str,
+    fraction: f64,
+}
+
+impl SamplePlan {
+    // Plan sampling for `query`, or None if its result cannot be estimated
+    // from a sample
+    pub fn new(query: &str) -> Option<Self> {
+        let mut statements = Parser::parse_sql(&PostgreSqlDialect {}, query).ok()?;
+        if statements.len() != 1 {
+            return None;
+        }
+        let mut statement = statements.pop()?;
+
+        let Statement::Query(query) = &mut statement else {
+            return None;
+        };
+        if query.with.is_some() {
+            return None;
+        }
+        let SetExpr::Select(select) = query.body.as_mut() else {
+            return None;
+        };
+        if select.distinct.is_some()
+            || select.having.is_some()
+            || select.from.len() != 1
+            || !select.from[0].joins.is_empty()
+        {
+            return None;
+        }
+        let TableFactor::Table { name, .. } = &select.from[0].relation else {
+            return None;
+        };
+        let table = name.to_string();
+
+        let mut columns = Vec::new();
+        let mut projection = Vec::new();
+        for (i, item) in select.projection.iter().enumerate() {
+            let (expr, name) = match item {
+                SelectItem::UnnamedExpr(expr) => (expr, output_name(expr)),
+                SelectItem::ExprWithAlias { expr, alias } => (expr, ident_name(alias)),
+                _ => return None,
+            };
+
+            match aggregate(expr) {
+                Some((aggregate, arg)) => {
+                    for (stat, sql) in statistics(aggregate, &arg) {
+                        projection.push(SelectItem::ExprWithAlias {
+                            expr: parse_expr(&sql)?,
+                            alias: Ident::with_quote('"', format!("{}{}", stat, i)),
+                        });
+                    }
+                    columns.push(OutputColumn::Estimate { name, aggregate });
+                }
+                None if sql::contains_aggregate(expr) => return None,
+                None => {
+                    projection.push(SelectItem::ExprWithAlias {
+                        expr: expr.clone(),
+                        alias: Ident::with_quote('"', format!("g{}", i)),
+                    });
+                    columns.push(OutputColumn::Plain { name });
+                }
+            }
+        }
+        if !columns
+            .iter()
+            .any(|column| matches!(column, OutputColumn::Estimate { .. }))
+        {
+            return None;
+        }
+
+        // GROUP BY takes a position to mean the expression in that place of
+        // the projection. A name matching an output alias is ambiguous here:
+        // Postgres prefers a table column of that name, which cannot be told
+        // apart without the schema, so such queries are run exactly.
+        if let GroupByExpr::Expressions(keys) = &mut select.group_by {
+            for key in keys.iter_mut() {
+                if let Some(i) = position(key) {
+                    match (columns.get(i), select.projection.get(i)) {
+                        (
+                            Some(OutputColumn::Plain { .. }),
+                            Some(
+                                SelectItem::UnnamedExpr(expr)
+                                | SelectItem::ExprWithAlias { expr, .. },
+                            ),
+                        ) => *key = expr.clone(),
+                        _ => return None,
+                    }
+                } else if names_alias(key, &select.projection) {
+                    return None;
+                }
+            }
+        }
+        select.projection = projection;
+
+        // ORDER BY takes a position or the name of a result column to mean
+        // that column
+        for order in query.order_by.iter_mut() {
+            let i = match position(&order.expr) {
+                Some(i) => i,
+                None => {
+                    let Expr::Identifier(ident) = &order.expr else {
+                        continue;
+                    };
+                    let name = ident_name(ident);
+                    let mut matching = columns
+                        .iter()
+                        .enumerate()
+                        .filter(|(_, column)| column.name() == name)
+                        .map(|(i, _)| i);
+                    match (matching.next(), matching.next()) {
+                        (Some(i), None) => i,
+                        // A table column
+                        (None, _) => continue,
+                        // Ambiguous, which Postgres rejects
+                        _ => return None,
+                    }
+                }
+            };
+            order.expr = Expr::Identifier(columns.get(i)?.sort_column(i));
+        }
+
+        Some(SamplePlan {
+            statement,
+            table,
+            columns,
+        })
+    }
+
+    // Choose the sampling method and rate from the planner's row estimate for
+    // the table, or return None if the table is small enough, or unknown to
+    // the planner, and should be read in full
+    pub async fn sample(
+        &self,
+        pool: &PgPool,
+        config: &SamplingConfig,
+    ) -> Result<Option<Sampled>, (StatusCode, String)> {
+        let rows: Option<f32> =
+            sqlx::query_scalar("SELECT reltuples FROM pg_class WHERE oid = to_regclass($1)")
+                .bind(&self.table)
+                .fetch_optional(pool)
+                .await
+                .map_err(|e| (StatusCode::BAD_REQUEST, format!("Query error: {}", e)))?;
+
+        let rows = match rows {
+            Some(rows) if rows > 0.0 => rows as f64,
+            _ => return Ok(None),
+        };
+        let fraction = config.target_rows / rows;
+        if fraction >= 1.0 {
+            return Ok(None);
+        }
+        let method = if rows >= config.system_min_rows {
+            "SYSTEM"
+        } else {
+            "BERNOULLI"
+        };
+
+        // sqlparser has no node for TABLESAMPLE, so the clause is carried in
+        // the table name, which is printed as is. Postgres expects the alias
+        // before the clause.
+        let mut statement = self.statement.clone();
+        if let Statement::Query(query) = &mut statement {
+            if let SetExpr::Select(select) = query.body.as_mut() {
+                if let TableFactor::Table { name, alias, .. } = &mut select.from[0].relation {
+                    let alias = alias
+                        .take()
+                        .map(|alias| format!(" AS {}", alias))
+                        .unwrap_or_default();
+                    let sampled = format!(
+                        "{}{} TABLESAMPLE {} ({})",
+                        name,
+                        alias,
+                        method,
+                        fraction * 100.0
+                    );
+                    *name = ObjectName(vec![Ident::new(sampled)]);
+                }
+            }
+        }
+
+        Ok(Some(Sampled {
+            sql: statement.to_string(),
+            method,
+            fraction,
+        }))
+    }
+
+    // Turn the rows of a sampled statement into estimated result rows, with
+    // the confidence interval of every estimate
+    //
+    // COUNT and SUM are Horvitz-Thompson estimates: the sample value divided
+    // by the sampling fraction, with variance (1 - f) / f² times the sum of
+    // squares in the sample. AVG is the sample mean with its standard error,
+    // corrected for sampling without replacement. Block sampling (SYSTEM)
+    // samples whole pages, so for clustered data its intervals are too narrow.
+    pub fn estimate(&self, sampled: &Sampled, rows: Vec<Value>) -> (Vec<Value>, Approximation) {
+        let f = sampled.fraction;
+        let mut results = Vec::with_capacity(rows.len());
+        let mut intervals = Vec::with_capacity(rows.len());
+
+        for row in rows {
+            let stat = |name: &str, i: usize| row[format!("{}{}", name, i)].as_f64();
+            let mut result = Map::new();
+            let mut interval = Map::new();
+
+            for (i, column) in self.columns.iter().enumerate() {
+                let (name, aggregate) = match column {
+                    OutputColumn::Plain { name } => {
+                        result.insert(name.clone(), row[format!("g{}", i)].clone());
+                        continue;
+                    }
+                    OutputColumn::Estimate { name, aggregate } => (name, *aggregate),
+                };
+
+                let (estimate, bounds) = match aggregate {
+                    Aggregate::Count => {
+                        let n = stat("n", i).unwrap_or(0.0);
+                        let se = (n * (1.0 - f)).sqrt() / f;
+                        let estimate = (n / f).round();
+                        let low = (estimate - Z_95 * se).max(n);
+                        (json!(estimate as i64), json!([low, estimate + Z_95 * se]))
+                    }
+                    Aggregate::Sum => match (stat("s", i), stat("q", i)) {
+                        (Some(sum), Some(squares)) => {
+                            let se = (squares * (1.0 - f)).sqrt() / f;
+                            let estimate = sum / f;
+                            (
+                                json!(estimate),
+                                json!([estimate - Z_95 * se, estimate + Z_95 * se]),
+                            )
+                        }
+                        _ => (Value::Null, Value::Null),
+                    },
+                    Aggregate::Avg => match (stat("a", i), stat("d", i), stat("n", i)) {
+                        (Some(mean), Some(sd), Some(n)) if n > 0.0 => {
+                            let se = sd / n.sqrt() * (1.0 - f).sqrt();
+                            (json!(mean), json!([mean - Z_95 * se, mean + Z_95 * se]))
+                        }
+                        (Some(mean), _, _) => (json!(mean), json!([mean, mean])),
+                        _ => (Value::Null, Value::Null),
+                    },
+                };
+                result.insert(name.clone(), estimate);
+                interval.insert(name.clone(), bounds);
+            }
+
+            results.push(Value::Object(result));
+            intervals.push(interval);
+        }
+
+        let approximation = Approximation {
+            table: self.table.clone(),
+            method: sampled.method,
+            sample_fraction: f,
+            confidence_level: 0.95,
+            intervals,
+        };
+        (results, approximation)
+    }
+}
+
+// The sample statistics an aggregate is estimated from, as (prefix, SQL)
+fn statistics(aggregate: Aggregate, arg: &str) -> Vec<(&'static str, String)> {
+    match aggregate {
+        Aggregate::Count => vec![("n", format!("count({})", arg))],
+        Aggregate::Sum => vec![
+            ("s", format!("sum(({})::float8)", arg)),
+            ("q", format!("sum(({0})::float8 * ({0})::float8)", arg)),
+        ],
+        Aggregate::Avg => vec![
+            ("a", format!("avg(({})::float8)", arg)),
+            ("d", format!("stddev_samp(({})::float8)", arg)),
+            ("n", format!("count({})", arg)),
+        ],
+    }
+}
+
+// Match a plain COUNT, SUM or AVG call with a single argument, and return the
+// argument as SQL
+fn aggregate(expr: &Expr) -> Option<(Aggregate, String)> {
+    let Expr::Function(function) = expr else {
+        return None;
+    };
+    let aggregate = match function.name.to_string().to_lowercase().as_str() {
+        "count" => Aggregate::Count,
+        "sum" => Aggregate::Sum,
+        "avg" => Aggregate::Avg,
+        _ => return None,
+    };
+    let arg = match function.args.as_slice() {
+        [FunctionArg::Unnamed(FunctionArgExpr::Expr(arg))] => arg.to_string(),
+        [FunctionArg::Unnamed(FunctionArgExpr::Wildcard)] if aggregate == Aggregate::Count => {
+            "*".to_string()
+        }
+        _ => return None,
+    };
+
+    // Anything printed beyond `name(arg)`, such as DISTINCT, FILTER, ORDER BY
+    // or OVER, changes what the aggregate means
+    if function.to_string() != format!("{}({})", function.name, arg) {
+        return None;
+    }
+    Some((aggregate, arg))
+}
+
+// The zero-based result column a key such as `ORDER BY 2` refers to
+fn position(expr: &Expr) -> Option<usize> {
+    match expr {
+        Expr::Value(SqlValue::Number(position, _)) => {
+            position.parse::<usize>().ok()?.checked_sub(1)
+        }
+        _ => None,
+    }
+}
+
+// Whether `key` is a bare name given to a projection item by an alias, other
+// than a column renamed to itself
+fn names_alias(key: &Expr, projection: &[SelectItem]) -> bool {
+    let Expr::Identifier(ident) = key else {
+        return false;
+    };
+    let name = ident_name(ident);
+    projection.iter().any(|item| match item {
+        SelectItem::ExprWithAlias { expr, alias } if ident_name(alias) == name => {
+            !matches!(expr, Expr::Identifier(column) if ident_name(column) == name)
+        }
+        _ => false,
+    })
+}
+
+fn parse_expr(sql: &str) -> Option<Expr> {
+    Parser::new(&PostgreSqlDialect {})
+        .try_with_sql(sql)
+        .ok()?
+        .parse_expr()
+        .ok()
+}
+
+// The name Postgres gives an unaliased result column
+fn output_name(expr: &Expr) -> String {
+    match expr {
+        Expr::Identifier(ident) => ident_name(ident),
+        Expr::CompoundIdentifier(idents) => idents.last().map(ident_name).unwrap_or_default(),
+        Expr::Function(function) => function.name.0.last().map(ident_name).unwrap_or_default(),
+        Expr::Nested(expr) => output_name(expr),
+        _ => "?column?".to_string(),
+    }
+}
+
+// Unquoted identifiers are folded to lowercase
+fn ident_name(ident: &Ident) -> String {
+    match ident.quote_style {
+        Some(_) => ident.value.clone(),
+        None => ident.value.to_lowercase(),
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn sampled(plan: &SamplePlan, fraction: f64) -> Sampled {
+        Sampled {
+            sql: plan.statement.to_string(),
+            method: "BERNOULLI",
+            fraction,
+        }
+    }
+
+    fn sql(query: &str) -> String {
+        SamplePlan::new(query).unwrap().statement.to_string()
+    }
+
+    #[test]
+    fn plans_single_table_aggregates() {
+        let plan =
+            SamplePlan::new("SELECT cyl, count(*), avg(mpg) FROM cars GROUP BY cyl").unwrap();
+        assert_eq!(plan.table, "cars");
+        let sql = plan.statement.to_string();
+        assert!(
+            sql.starts_with("SELECT cyl AS \"g0\", count(*) AS \"n1\", avg("),
+            "{}",
+            sql
+        );
+        assert!(
+            sql.ends_with("count(mpg) AS \"n2\" FROM cars GROUP BY cyl"),
+            "{}",
+            sql
+        );
+    }
+
+    #[test]
+    fn rejects_queries_that_cannot_be_sampled() {
+        for query in [
+            "SELECT * FROM cars",
+            "SELECT cyl FROM cars GROUP BY cyl",
+            "SELECT count(DISTINCT cyl) FROM cars",
+            "SELECT DISTINCT count(*) FROM cars",
+            "SELECT cyl, count(*) FROM cars GROUP BY cyl HAVING count(*) > 1",
+            "SELECT count(*) FROM cars JOIN makes ON cars.make = makes.id",
+            "SELECT count(*) FROM cars, makes",
+            "WITH c AS (SELECT * FROM cars) SELECT count(*) FROM c",
+            "SELECT count(*) FROM cars; SELECT 1",
+        ] {
+            assert!(SamplePlan::new(query).is_none(), "{}", query);
+        }
+    }
+
+    #[test]
+    fn points_order_by_at_the_replacement_columns() {
+        let query = "SELECT cyl, count(*) AS n, sum(hp) AS total, avg(mpg) AS \"Mean\" \
+                     FROM cars GROUP BY cyl";
+        assert!(sql(&format!("{} ORDER BY 1", query)).ends_with("ORDER BY \"g0\""));
+        assert!(sql(&format!("{} ORDER BY cyl DESC", query)).ends_with("ORDER BY \"g0\" DESC"));
+        assert!(sql(&format!("{} ORDER BY n DESC", query)).ends_with("ORDER BY \"n1\" DESC"));
+        assert!(sql(&format!("{} ORDER BY 3, 4", query)).ends_with("ORDER BY \"s2\", \"a3\""));
+        assert!(sql(&format!("{} ORDER BY \"Mean\"", query)).ends_with("ORDER BY \"a3\""));
+        // Not a result column, so a table column
+        assert!(sql(&format!("{} ORDER BY mean", query)).ends_with("ORDER BY mean"));
+        assert!(sql(&format!("{} ORDER BY count(*)", query)).ends_with("ORDER BY count(*)"));
+        assert!(SamplePlan::new(&format!("{} ORDER BY 5", query)).is_none());
+    }
+
+    #[test]
+    fn points_positional_group_by_at_the_expression() {
+        assert!(sql("SELECT cyl % 2 AS odd, count(*) FROM cars GROUP BY 1")
+            .ends_with("GROUP BY cyl % 2"));
+        assert!(sql("SELECT cyl AS cyl, count(*) FROM cars GROUP BY cyl").ends_with("GROUP BY cyl"));
+        assert!(SamplePlan::new("SELECT cyl, count(*) FROM cars GROUP BY 2").is_none());
+        assert!(SamplePlan::new("SELECT cyl, count(*) FROM cars GROUP BY 3").is_none());
+    }
+
+    #[test]
+    fn runs_group_by_alias_exactly() {
+        assert!(SamplePlan::new("SELECT cyl AS c, count(*) FROM cars GROUP BY c").is_none());
+        assert!(
+            SamplePlan::new("SELECT cyl % 2 AS cyl, count(*) FROM cars GROUP BY cyl").is_none()
+        );
+    }
+
+    #[test]
+    fn scales_count_and_sum() {
+        let plan = SamplePlan::new("SELECT count(*), sum(hp) AS total FROM cars").unwrap();
+        let rows = vec![json!({"n0": 50, "s1": 1000.0, "q1": 40000.0})];
+        let (results, approximation) = plan.estimate(&sampled(&plan, 0.25), rows);
+
+        assert_eq!(results, vec![json!({"count": 200, "total": 4000.0})]);
+        let intervals = &approximation.intervals[0];
+        let se = (50.0f64 * 0.75).sqrt() / 0.25;
+        assert_eq!(
+            intervals["count"],
+            json!([200.0 - Z_95 * se, 200.0 + Z_95 * se])
+        );
+        let se = (40000.0f64 * 0.75).sqrt() / 0.25;
+        assert_eq!(
+            intervals["total"],
+            json!([4000.0 - Z_95 * se, 4000.0 + Z_95 * se])
+        );
+        assert_eq!(approximation.sample_fraction, 0.25);
+    }
+
+    #[test]
+    fn never_estimates_fewer_rows_than_sampled() {
+        let plan = SamplePlan::new("SELECT count(*) FROM cars").unwrap();
+        let (_, approximation) = plan.estimate(&sampled(&plan, 0.5), vec![json!({"n0": 1})]);
+        assert_eq!(approximation.intervals[0]["count"][0], json!(1.0));
+    }
+
+    #[test]
+    fn keeps_the_sample_mean() {
+        let plan = SamplePlan::new("SELECT cyl, avg(mpg) FROM cars GROUP BY cyl").unwrap();
+        let rows = vec![
+            json!({"g0": 4, "a1": 26.5, "d1": 4.0, "n1": 16}),
+            json!({"g0": 8, "a1": 15.0, "d1": null, "n1": 1}),
+            json!({"g0": 6, "a1": null, "d1": null, "n1": 0}),
+        ];
+        let (results, approximation) = plan.estimate(&sampled(&plan, 0.75), rows);
+
+        assert_eq!(
+            results,
+            vec![
+                json!({"cyl": 4, "avg": 26.5}),
+                json!({"cyl": 8, "avg": 15.0}),
+                json!({"cyl": 6, "avg": null}),
+            ]
+        );
+        let se = 4.0 / 4.0 * 0.25f64.sqrt();
+        assert_eq!(
+            approximation.intervals[0]["avg"],
+            json!([26.5 - Z_95 * se, 26.5 + Z_95 * se])
+        );
+        assert_eq!(approximation.intervals[1]["avg"], json!([15.0, 15.0]));
+        assert_eq!(approximation.intervals[2]["avg"], Value::Null);
+    }
+}
@@ -0,0 +1,204 @@
+use std::time::Duration;
+
+use axum::http::StatusCode;
+use futures::StreamExt;
+use serde::Serialize;
+use serde_json::value::RawValue;
+use sqlx::postgres::PgRow;
+use sqlx::{PgPool, Row};
+
+use crate::decode::ResultPlan;
+use crate::execute::Execution;
+use crate::models::ResultFormat;
+use crate::sql;
+
+// Most rows and serialized bytes one response may contain
+#[derive(Clone, Copy, Debug, PartialEq, Eq, Hash)]
+pub struct Budget {
+    pub max_rows: usize,
+    pub max_bytes: usize,
+}
+
+// Size of a result, reported alongside it
+#[derive(Serialize, Clone, Copy, Debug, Default)]
+pub struct ResultStats {
+    // Whether rows were left out because the result exceeded its budget
+    pub truncated: bool,
+    pub row_count: usize,
+    // Size of the serialized result, in bytes
+    pub byte_count: usize,
+}
+
+fn query_error(e: sqlx::Error) -> (StatusCode, String) {
+    (StatusCode::BAD_REQUEST, format!("Query error: {}", e))
+}
+
+pub fn serialization_error(e: serde_json::Error) -> (StatusCode, String) {
+    (
+        StatusCode::INTERNAL_SERVER_ERROR,
+        format!("Serialization error: {}", e),
+    )
+}
+
+// Writes the JSON of a result as its rows arrive, without building a Value
+// per row first
+//
+// In the rows format every row is serialized straight into the output. In the
+// columnar format every cell is serialized into the buffer of its column, and
+// the buffers are joined once the result is complete.
+pub struct ResultWriter {
+    columnar: bool,
+    // Planned from the first row
+    plan: Option<ResultPlan>,
+    rows: Vec<u8>,
+    columns: Vec<Vec<u8>>,
+    // Where each column buffer ended before the current row, so a row that
+    // does not fit can be taken back out
+    column_starts: Vec<usize>,
+    count: usize,
+}
+
+impl ResultWriter {
+    pub fn new(format: ResultFormat) -> Self {
+        ResultWriter {
+            columnar: format == ResultFormat::Columnar,
+            plan: None,
+            rows: vec![b'['],
+            columns: Vec::new(),
+            column_starts: Vec::new(),
+            count: 0,
+        }
+    }
+
+    // Serialize `row` into the result, unless it takes more than `room` bytes
+    //
+    // Returns the bytes the row added, separator included, or None if it was
+    // left out.
+    pub fn push(&mut self, row: &PgRow, room: usize) -> Result<Option<usize>, serde_json::Error> {
+        let plan = self.plan.get_or_insert_with(|| ResultPlan::new(row.columns()));
+
+        if !self.columnar {
+            let start = self.rows.len();
+            if self.count > 0 {
+                self.rows.push(b',');
+            }
+            serde_json::to_writer(&mut self.rows, &plan.object(row))?;
+            let size = self.rows.len() - start;
+            if size > room {
+                self.rows.truncate(start);
+                return Ok(None);
+            }
+            self.count += 1;
+            return Ok(Some(size));
+        }
+
+        if self.columns.len() != plan.columns.len() {
+            self.columns = vec![Vec::new(); plan.columns.len()];
+        }
+        self.column_starts.clear();
+        let mut size = 0;
+        for (i, column) in self.columns.iter_mut().enumerate() {
+            let start = column.len();
+            self.column_starts.push(start);
+            if self.count > 0 {
+                column.push(b',');
+            }
+            serde_json::to_writer(&mut *column, &plan.cell(row, i))?;
+            size += column.len() - start;
+        }
+        if size > room {
+            for (column, &start) in self.columns.iter_mut().zip(&self.column_starts) {
+                column.truncate(start);
+            }
+            return Ok(None);
+        }
+        self.count += 1;
+        Ok(Some(size))
+    }
+
+    // The complete result: an array of row objects, or the columns and one
+    // array of values per column
+    pub fn finish(mut self) -> Result<Box<RawValue>, serde_json::Error> {
+        let json = if self.columnar {
+            let data: usize = self.columns.iter().map(|column| column.len() + 3).sum();
+            let mut out = Vec::with_capacity(data + 64);
+            out.extend_from_slice(b"{\"columns\":");
+            match &self.plan {
+                Some(plan) => serde_json::to_writer(&mut out, &plan.column_info())?,
+                None => out.extend_from_slice(b"[]"),
+            }
+            out.extend_from_slice(b",\"data\":[");
+            for (i, column) in self.columns.iter().enumerate() {
+                if i > 0 {
+                    out.push(b',');
+                }
+                out.push(b'[');
+                out.extend_from_slice(column);
+                out.push(b']');
+            }
+            out.extend_from_slice(b"]}");
+            out
+        } else {
+            self.rows.push(b']');
+            self.rows
+        };
+
+        // serde_json only ever writes UTF-8, so this does not copy
+        let json = String::from_utf8(json).map_err(serde::ser::Error::custom)?;
+        RawValue::from_string(json)
+    }
+}
+
+// Run a query and serialize its result, stopping once the budget is used up
+//
+// Read-only queries are wrapped in a LIMIT of one more row than the budget,
+// so Postgres stops producing rows early and the extra row shows whether the
+// result was truncated. Other statements are cut off while serializing. Either
+// way the remaining rows are read and discarded so the statement completes.
+pub async fn fetch_result(
+    pool: &PgPool,
+    query: &str,
+    timeout: Duration,
+    budget: Budget,
+    format: ResultFormat,
+) -> Result<(Box<RawValue>, ResultStats), (StatusCode, String)> {
+    let limited = sql::with_row_limit(query, budget.max_rows.saturating_add(1));
+    let statement = limited.as_deref().unwrap_or(query);
+
+    let mut execution = Execution::begin(pool, timeout).await.map_err(query_error)?;
+    let mut rows = execution.fetch(statement);
+
+    let mut writer = ResultWriter::new(format);
+    let mut stats = ResultStats::default();
+
+    while let Some(row) = rows.next().await {
+        let row = row.map_err(query_error)?;
+        if stats.row_count == budget.max_rows {
+            stats.truncated = true;
+            break;
+        }
+
+        let room = budget.max_bytes.saturating_sub(stats.byte_count);
+        match writer.push(&row, room).map_err(serialization_error)? {
+            Some(size) => {
+                stats.row_count += 1;
+                stats.byte_count += size;
+            }
+            None => {
+                stats.truncated = true;
+                break;
+            }
+        }
+    }
+
+    // Let the statement finish before committing, so the execution ends as
+    // finished instead of being cancelled from a new connection. With the
+    // LIMIT applied, at most max_rows + 1 rows are left to read.
+    while let Some(row) = rows.next().await {
+        row.map_err(query_error)?;
+    }
+    drop(rows);
+    execution.commit().await.map_err(query_error)?;
+
+    Ok((writer.finish().map_err(serialization_error)?, stats))
+}
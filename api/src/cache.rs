@@ -0,0 +1,244 @@
+use std::collections::{HashMap, HashSet};
+use std::future::Future;
+use std::sync::{Arc, Mutex, RwLock};
+use std::time::Duration;
+
+use axum::http::StatusCode;
+use moka::future::Cache;
+use serde_json::value::RawValue;
+use sqlx::postgres::PgListener;
+
+use crate::budget::{Budget, ResultStats};
+use crate::models::ResultFormat;
+use crate::sql;
+
+// Channel the table change triggers notify on, with the table name as payload
+// (see database/migrations/002_table_change_notify.sql)
+pub const TABLE_CHANGED_CHANNEL: &str = "lucidata_table_changed";
+
+#[derive(Clone, Debug, PartialEq, Eq, Hash)]
+pub struct CacheKey {
+    sql: String,
+    format: ResultFormat,
+    // Different budgets can truncate the same result differently
+    budget: Budget,
+}
+
+// A query that can be answered from the cache
+pub struct CacheLookup {
+    key: CacheKey,
+    tables: Vec<String>,
+}
+
+// Whether a response came from the cache, sent in the x-cache header
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum CacheStatus {
+    Hit,
+    // Served from an outdated entry while it is refreshed in the background
+    Stale,
+    Miss,
+}
+
+impl CacheStatus {
+    pub fn as_str(self) -> &'static str {
+        match self {
+            CacheStatus::Hit => "hit",
+            CacheStatus::Stale => "stale",
+            CacheStatus::Miss => "miss",
+        }
+    }
+}
+
+// Versions of the tables a result was read from, taken before it was executed
+#[derive(Clone, Debug, PartialEq, Eq)]
+struct Versions {
+    epoch: u64,
+    tables: Vec<u64>,
+}
+
+struct CachedResult {
+    // The serialized `result` field of the response
+    result: Box<RawValue>,
+    stats: ResultStats,
+    versions: Versions,
+}
+
+#[derive(Default)]
+struct TableVersions {
+    // Bumped when every table must be treated as changed, e.g. after missed
+    // notifications
+    epoch: u64,
+    tables: HashMap<String, u64>,
+}
+
+// In-process cache of /api/query results
+//
+// Entries are keyed by the canonical form of the SQL, the result format and
+// the budget, and bounded by their size in bytes. Every table has a version that is bumped
+// whenever Postgres notifies that it changed; an entry is only served while
+// the versions of all its tables match those it was read with.
+pub struct ResultCache {
+    entries: Cache<CacheKey, Arc<CachedResult>>,
+    versions: RwLock<TableVersions>,
+    stale_while_revalidate: bool,
+    refreshing: Mutex<HashSet<CacheKey>>,
+}
+
+impl ResultCache {
+    pub fn new(max_bytes: u64, ttl: Duration, stale_while_revalidate: bool) -> Self {
+        let entries = Cache::builder()
+            .max_capacity(max_bytes)
+            .weigher(|key: &CacheKey, value: &Arc<CachedResult>| {
+                (key.sql.len() + value.result.get().len())
+                    .try_into()
+                    .unwrap_or(u32::MAX)
+            })
+            .time_to_live(ttl)
+            .build();
+
+        ResultCache {
+            entries,
+            versions: RwLock::new(TableVersions::default()),
+            stale_while_revalidate,
+            refreshing: Mutex::new(HashSet::new()),
+        }
+    }
+
+    // Look up how `query` would be cached, or None if its result must not be
+    pub fn lookup(query: &str, format: ResultFormat, budget: Budget) -> Option<CacheLookup> {
+        let canonical = sql::canonical_query(query)?;
+        Some(CacheLookup {
+            key: CacheKey {
+                sql: canonical.sql,
+                format,
+                budget,
+            },
+            tables: canonical.tables,
+        })
+    }
+
+    // Return the cached result for `lookup`, calling `execute` to produce it
+    // when there is no up-to-date entry
+    //
+    // Concurrent misses for the same key wait for a single execution.
+    pub async fn get_or_execute<F, Fut>(
+        self: &Arc<Self>,
+        lookup: CacheLookup,
+        execute: F,
+    ) -> Result<(Box<RawValue>, ResultStats, CacheStatus), (StatusCode, String)>
+    where
+        F: FnOnce() -> Fut + Send + 'static,
+        Fut: Future<Output = Result<(Box<RawValue>, ResultStats), (StatusCode, String)>>
+            + Send
+            + 'static,
+    {
+        let versions = self.current_versions(&lookup.tables);
+
+        if let Some(entry) = self.entries.get(&lookup.key).await {
+            if entry.versions == versions {
+                return Ok((entry.result.clone(), entry.stats, CacheStatus::Hit));
+            }
+            if self.stale_while_revalidate {
+                self.refresh(lookup.key, versions, execute);
+                return Ok((entry.result.clone(), entry.stats, CacheStatus::Stale));
+            }
+            self.entries.invalidate(&lookup.key).await;
+        }
+
+        let entry = self
+            .entries
+            .try_get_with(lookup.key, async move {
+                let (result, stats) = execute().await?;
+                Ok::<_, (StatusCode, String)>(Arc::new(CachedResult {
+                    result,
+                    stats,
+                    versions,
+                }))
+            })
+            .await
+            .map_err(|e| (*e).clone())?;
+
+        Ok((entry.result.clone(), entry.stats, CacheStatus::Miss))
+    }
+
+    // Re-execute an outdated entry in the background, once per key at a time
+    fn refresh<F, Fut>(self: &Arc<Self>, key: CacheKey, versions: Versions, execute: F)
+    where
+        F: FnOnce() -> Fut + Send + 'static,
+        Fut: Future<Output = Result<(Box<RawValue>, ResultStats), (StatusCode, String)>>
+            + Send
+            + 'static,
+    {
+        if !self.refreshing.lock().unwrap().insert(key.clone()) {
+            return;
+        }
+
+        let cache = Arc::clone(self);
+        tokio::spawn(async move {
+            match execute().await {
+                Ok((result, stats)) => {
+                    let entry = Arc::new(CachedResult {
+                        result,
+                        stats,
+                        versions,
+                    });
+                    cache.entries.insert(key.clone(), entry).await;
+                }
+                Err((_, e)) => tracing::warn!("Failed to refresh cached result: {}", e),
+            }
+            cache.refreshing.lock().unwrap().remove(&key);
+        });
+    }
+
+    fn current_versions(&self, tables: &[String]) -> Versions {
+        let versions = self.versions.read().unwrap();
+        Versions {
+            epoch: versions.epoch,
+            tables: tables
+                .iter()
+                .map(|table| versions.tables.get(table).copied().unwrap_or(0))
+                .collect(),
+        }
+    }
+
+    pub fn invalidate_table(&self, table: &str) {
+        let mut versions = self.versions.write().unwrap();
+        *versions.tables.entry(table.to_string()).or_insert(0) += 1;
+    }
+
+    pub fn invalidate_all(&self) {
+        self.versions.write().unwrap().epoch += 1;
+        self.entries.invalidate_all();
+    }
+
+    // Listen for table change notifications in the background
+    //
+    // The listener has a connection of its own, outside the pool, for as long
+    // as the service runs.
+    pub fn spawn_invalidation_listener(self: &Arc<Self>, database_url: String) {
+        let cache = Arc::clone(self);
+        tokio::spawn(async move {
+            loop {
+                if let Err(e) = cache.listen(&database_url).await {
+                    tracing::warn!("Result cache listener failed: {}", e);
+                }
+                // Notifications may have been missed while disconnected
+                cache.invalidate_all();
+                tokio::time::sleep(Duration::from_secs(1)).await;
+            }
+        });
+    }
+
+    async fn listen(&self, database_url: &str) -> Result<(), sqlx::Error> {
+        let mut listener = PgListener::connect(database_url).await?;
+        listener.listen(TABLE_CHANGED_CHANNEL).await?;
+        // Anything cached before the listener was up may already be outdated
+        self.invalidate_all();
+
+        // try_recv returns None once the connection is lost
+        while let Some(notification) = listener.try_recv().await? {
+            self.invalidate_table(notification.payload());
+        }
+        Ok(())
+    }
+}
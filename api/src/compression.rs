@@ -0,0 +1,44 @@
+use tower_http::compression::predicate::{NotForContentType, Predicate, SizeAbove};
+use tower_http::compression::{CompressionLayer, CompressionLevel};
+
+use crate::dataframe::{ARROW_STREAM_CONTENT_TYPE, PARQUET_CONTENT_TYPE};
+use crate::stream::NDJSON_CONTENT_TYPE;
+
+// Response compression, negotiated with the Accept-Encoding header
+//
+// gzip, brotli and zstd are offered. Responses smaller than
+// COMPRESSION_MIN_BYTES are sent as they are, and so are images, Parquet
+// files, event streams, NDJSON and Arrow streams. These are either already
+// compressed or must reach the client as soon as each chunk is written, which
+// the encoder does not do: it holds output back until its buffer fills.
+pub fn layer() -> CompressionLayer<impl Predicate> {
+    let min_bytes = crate::env_var("COMPRESSION_MIN_BYTES", 1024);
+    let level = std::env::var("COMPRESSION_LEVEL").unwrap_or_default();
+
+    let predicate = SizeAbove::new(min_bytes)
+        .and(NotForContentType::IMAGES)
+        .and(NotForContentType::const_new("text/event-stream"))
+        .and(NotForContentType::const_new(NDJSON_CONTENT_TYPE))
+        .and(NotForContentType::const_new(ARROW_STREAM_CONTENT_TYPE))
+        .and(NotForContentType::const_new(PARQUET_CONTENT_TYPE));
+
+    CompressionLayer::new()
+        .gzip(true)
+        .br(true)
+        .zstd(true)
+        .quality(parse_level(&level))
+        .compress_when(predicate)
+}
+
+// "fastest", "best", a number for the algorithm's own scale, or anything else
+// for each algorithm's default
+fn parse_level(level: &str) -> CompressionLevel {
+    match level.trim() {
+        "fastest" => CompressionLevel::Fastest,
+        "best" => CompressionLevel::Best,
+        level => level
+            .parse()
+            .map(CompressionLevel::Precise)
+            .unwrap_or(CompressionLevel::Default),
+    }
+}
@@ -0,0 +1,233 @@
+use std::collections::HashMap;
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
+
+use axum::http::StatusCode;
+use sqlx::postgres::PgRow;
+use sqlx::{Postgres, Transaction};
+use tokio::sync::{Mutex as AsyncMutex, OwnedSemaphorePermit, Semaphore};
+use uuid::Uuid;
+
+use crate::pool;
+use crate::replicas::ReadTarget;
+use crate::sql;
+
+// Every cursor lives in its own transaction, so they can all share one name
+const CURSOR_NAME: &str = "lucidata_cursor";
+
+// Largest page that can be requested in one call
+pub const MAX_PAGE_SIZE: u32 = 10_000;
+
+// A server-side cursor together with the transaction that keeps it open
+struct OpenCursor {
+    tx: Transaction<'static, Postgres>,
+    query: String,
+    page_size: u32,
+    last_used: Instant,
+    // Released when the cursor is closed
+    _slot: OwnedSemaphorePermit,
+    // Counts the cursor's connection against admission while it is open
+    _connection: OwnedSemaphorePermit,
+    // Keeps a replica counted as in use while the cursor is open
+    _target: ReadTarget,
+}
+
+impl OpenCursor {
+    // Fetch the next page, of at most `max_rows` rows whatever the page size,
+    // and say whether it was the last one
+    //
+    // At least one row is fetched: FETCH FORWARD 0 would return the current
+    // row again.
+    async fn fetch(&mut self, max_rows: usize) -> Result<(Vec<PgRow>, bool), sqlx::Error> {
+        self.last_used = Instant::now();
+        let count = (self.page_size as usize).min(max_rows).max(1);
+        let statement = format!("FETCH FORWARD {} FROM {}", count, CURSOR_NAME);
+        let rows = sqlx::query(&statement).fetch_all(&mut *self.tx).await?;
+        self.last_used = Instant::now();
+        let exhausted = rows.len() < count;
+        Ok((rows, exhausted))
+    }
+}
+
+// One page of a paginated result
+pub struct Page {
+    pub rows: Vec<PgRow>,
+    // The statement the cursor was declared for
+    pub query: String,
+    // Token for the next page, or None once the result is exhausted
+    pub next_cursor: Option<String>,
+}
+
+// Open server-side cursors, keyed by their continuation token
+//
+// Each open cursor holds a pooled connection inside a transaction, so the
+// number of cursors is capped below the pool size, and cursors that are not
+// read from for `idle_timeout` are closed and their connection returned.
+pub struct CursorRegistry {
+    cursors: Mutex<HashMap<String, Arc<AsyncMutex<OpenCursor>>>>,
+    slots: Arc<Semaphore>,
+    idle_timeout: Duration,
+}
+
+impl CursorRegistry {
+    pub fn new(max_open: usize, idle_timeout: Duration) -> Self {
+        CursorRegistry {
+            cursors: Mutex::new(HashMap::new()),
+            slots: Arc::new(Semaphore::new(max_open)),
+            idle_timeout,
+        }
+    }
+
+    // Declare a cursor for `query` on `target` and fetch its first page, of at
+    // most `max_rows` rows. `connection` is the admission permit the cursor
+    // holds while it is open.
+    pub async fn open(
+        &self,
+        target: ReadTarget,
+        connection: OwnedSemaphorePermit,
+        query: &str,
+        page_size: u32,
+        max_rows: usize,
+        timeout: Duration,
+    ) -> Result<Page, (StatusCode, String)> {
+        let query = sql::read_only_statement(query).map_err(|e| (StatusCode::BAD_REQUEST, e))?;
+
+        let slot = self.slots.clone().try_acquire_owned().map_err(|_| {
+            (
+                StatusCode::SERVICE_UNAVAILABLE,
+                "Too many open cursors, try again later".to_string(),
+            )
+        })?;
+
+        let tx = pool::begin(&target.pool).await.map_err(|e| {
+            (
+                StatusCode::INTERNAL_SERVER_ERROR,
+                format!("Database error: {}", e),
+            )
+        })?;
+        let mut cursor = OpenCursor {
+            tx,
+            query: query.clone(),
+            page_size,
+            last_used: Instant::now(),
+            _slot: slot,
+            _connection: connection,
+            _target: target,
+        };
+
+        // Applies to every FETCH for as long as the cursor stays open
+        sqlx::query("SELECT set_config('statement_timeout', $1, true)")
+            .bind(timeout.as_millis().to_string())
+            .execute(&mut *cursor.tx)
+            .await
+            .map_err(query_error)?;
+
+        let declare = format!("DECLARE {} NO SCROLL CURSOR FOR {}", CURSOR_NAME, query);
+        sqlx::query(&declare)
+            .execute(&mut *cursor.tx)
+            .await
+            .map_err(query_error)?;
+
+        let (rows, exhausted) = cursor.fetch(max_rows).await.map_err(query_error)?;
+        if exhausted {
+            // Dropping the cursor rolls back its transaction
+            return Ok(Page {
+                rows,
+                query: cursor.query,
+                next_cursor: None,
+            });
+        }
+
+        let token = Uuid::new_v4().simple().to_string();
+        let query = cursor.query.clone();
+        self.cursors
+            .lock()
+            .unwrap()
+            .insert(token.clone(), Arc::new(AsyncMutex::new(cursor)));
+
+        Ok(Page {
+            rows,
+            query,
+            next_cursor: Some(token),
+        })
+    }
+
+    // Fetch the page after the one that returned `token`, of at most
+    // `max_rows` rows, optionally changing the page size
+    pub async fn next(
+        &self,
+        token: &str,
+        page_size: Option<u32>,
+        max_rows: usize,
+    ) -> Result<Page, (StatusCode, String)> {
+        let entry = self.cursors.lock().unwrap().get(token).cloned().ok_or_else(|| {
+            (
+                StatusCode::NOT_FOUND,
+                "Cursor not found or expired".to_string(),
+            )
+        })?;
+
+        let mut cursor = entry.lock().await;
+        if let Some(page_size) = page_size {
+            cursor.page_size = page_size;
+        }
+
+        let (rows, exhausted) = match cursor.fetch(max_rows).await {
+            Ok(page) => page,
+            Err(e) => {
+                // The transaction is aborted, so the cursor cannot be read again
+                self.close(token);
+                return Err(query_error(e));
+            }
+        };
+
+        let next_cursor = if exhausted {
+            self.close(token);
+            None
+        } else {
+            Some(token.to_string())
+        };
+
+        Ok(Page {
+            rows,
+            query: cursor.query.clone(),
+            next_cursor,
+        })
+    }
+
+    // Close a cursor and return its connection, e.g. once the rest of its
+    // result is no longer wanted
+    pub fn close(&self, token: &str) {
+        self.cursors.lock().unwrap().remove(token);
+    }
+
+    // Close every cursor that has not been read from within the idle timeout.
+    // Cursors that are fetching a page right now are left alone.
+    pub fn close_idle(&self) {
+        let idle_timeout = self.idle_timeout;
+        self.cursors
+            .lock()
+            .unwrap()
+            .retain(|_, cursor| match cursor.try_lock() {
+                Ok(cursor) => cursor.last_used.elapsed() < idle_timeout,
+                Err(_) => true,
+            });
+    }
+
+    // Periodically close idle cursors in the background
+    pub fn spawn_reaper(self: &Arc<Self>) {
+        let registry = Arc::clone(self);
+        let period = (registry.idle_timeout / 2).max(Duration::from_secs(1));
+        tokio::spawn(async move {
+            let mut interval = tokio::time::interval(period);
+            loop {
+                interval.tick().await;
+                registry.close_idle();
+            }
+        });
+    }
+}
+
+fn query_error(e: sqlx::Error) -> (StatusCode, String) {
+    (StatusCode::BAD_REQUEST, format!("Query error: {}", e))
+}
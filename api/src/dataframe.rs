@@ -0,0 +1,346 @@
+use std::sync::Arc;
+
+use arrow::array::{
+    ArrayRef, BooleanBuilder, Date32Builder, Float32Builder, Float64Builder, Int16Builder,
+    Int32Builder, Int64Builder, StringBuilder, TimestampMicrosecondBuilder,
+};
+use arrow::datatypes::{DataType, Field, Schema, SchemaRef, TimeUnit};
+use arrow::ipc::writer::StreamWriter;
+use arrow::record_batch::RecordBatch;
+use num_traits::ToPrimitive;
+use parquet::arrow::ArrowWriter;
+use parquet::basic::Compression;
+use parquet::file::properties::WriterProperties;
+use serde_json::Value;
+use sqlx::postgres::PgRow;
+use sqlx::types::chrono::{DateTime, NaiveDate, NaiveDateTime, TimeZone, Utc};
+use sqlx::types::BigDecimal;
+use sqlx::Row;
+
+use crate::budget::Budget;
+use crate::decode::{ColumnKind, ResultPlan};
+use crate::budget::ResultStats;
+use crate::stream::{BoxError, RowEncoder};
+
+pub const ARROW_STREAM_CONTENT_TYPE: &str = "application/vnd.apache.arrow.stream";
+pub const PARQUET_CONTENT_TYPE: &str = "application/vnd.apache.parquet";
+
+// Rows per Arrow record batch
+const BATCH_ROWS: usize = 8192;
+
+// Arrow type used for a Postgres column. Types without a direct Arrow
+// equivalent are carried as their JSON/text representation.
+fn data_type(kind: ColumnKind) -> DataType {
+    match kind {
+        ColumnKind::Int2 => DataType::Int16,
+        ColumnKind::Int4 => DataType::Int32,
+        ColumnKind::Int8 => DataType::Int64,
+        ColumnKind::Float4 => DataType::Float32,
+        ColumnKind::Float8 | ColumnKind::Numeric => DataType::Float64,
+        ColumnKind::Bool => DataType::Boolean,
+        ColumnKind::Date => DataType::Date32,
+        ColumnKind::Timestamp => DataType::Timestamp(TimeUnit::Microsecond, None),
+        ColumnKind::Timestamptz => DataType::Timestamp(TimeUnit::Microsecond, Some("UTC".into())),
+        _ => DataType::Utf8,
+    }
+}
+
+fn schema(plan: &ResultPlan) -> SchemaRef {
+    let fields = plan
+        .columns
+        .iter()
+        .map(|column| Field::new(column.name.as_str(), data_type(column.kind), true))
+        .collect::<Vec<_>>();
+    Arc::new(Schema::new(fields))
+}
+
+enum ColumnBuilder {
+    Int16(Int16Builder),
+    Int32(Int32Builder),
+    Int64(Int64Builder),
+    Float32(Float32Builder),
+    Float64(Float64Builder),
+    Boolean(BooleanBuilder),
+    Date32(Date32Builder),
+    Timestamp(TimestampMicrosecondBuilder),
+    Utf8(StringBuilder),
+}
+
+impl ColumnBuilder {
+    fn new(kind: ColumnKind) -> Self {
+        match data_type(kind) {
+            DataType::Int16 => ColumnBuilder::Int16(Int16Builder::with_capacity(BATCH_ROWS)),
+            DataType::Int32 => ColumnBuilder::Int32(Int32Builder::with_capacity(BATCH_ROWS)),
+            DataType::Int64 => ColumnBuilder::Int64(Int64Builder::with_capacity(BATCH_ROWS)),
+            DataType::Float32 => ColumnBuilder::Float32(Float32Builder::with_capacity(BATCH_ROWS)),
+            DataType::Float64 => ColumnBuilder::Float64(Float64Builder::with_capacity(BATCH_ROWS)),
+            DataType::Boolean => ColumnBuilder::Boolean(BooleanBuilder::with_capacity(BATCH_ROWS)),
+            DataType::Date32 => ColumnBuilder::Date32(Date32Builder::with_capacity(BATCH_ROWS)),
+            DataType::Timestamp(_, timezone) => ColumnBuilder::Timestamp(
+                TimestampMicrosecondBuilder::with_capacity(BATCH_ROWS).with_timezone_opt(timezone),
+            ),
+            _ => ColumnBuilder::Utf8(StringBuilder::new()),
+        }
+    }
+
+    fn append(&mut self, plan: &ResultPlan, row: &PgRow, i: usize) -> Result<(), sqlx::Error> {
+        let kind = plan.columns[i].kind;
+        match self {
+            ColumnBuilder::Int16(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<i16>, _>(i)?)
+            }
+            ColumnBuilder::Int32(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<i32>, _>(i)?)
+            }
+            ColumnBuilder::Int64(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<i64>, _>(i)?)
+            }
+            ColumnBuilder::Float32(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<f32>, _>(i)?)
+            }
+            ColumnBuilder::Float64(builder) if kind == ColumnKind::Numeric => builder.append_option(
+                row.try_get_unchecked::<Option<BigDecimal>, _>(i)?
+                    .and_then(|v| v.to_f64()),
+            ),
+            ColumnBuilder::Float64(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<f64>, _>(i)?)
+            }
+            ColumnBuilder::Boolean(builder) => {
+                builder.append_option(row.try_get_unchecked::<Option<bool>, _>(i)?)
+            }
+            ColumnBuilder::Date32(builder) => builder.append_option(
+                row.try_get_unchecked::<Option<NaiveDate>, _>(i)?
+                    .map(days_since_epoch),
+            ),
+            ColumnBuilder::Timestamp(builder) if kind == ColumnKind::Timestamptz => builder
+                .append_option(
+                    row.try_get_unchecked::<Option<DateTime<Utc>>, _>(i)?
+                        .map(|v| v.timestamp_micros()),
+                ),
+            ColumnBuilder::Timestamp(builder) => builder.append_option(
+                row.try_get_unchecked::<Option<NaiveDateTime>, _>(i)?
+                    .map(|v| Utc.from_utc_datetime(&v).timestamp_micros()),
+            ),
+            ColumnBuilder::Utf8(builder) if kind == ColumnKind::Text => {
+                builder.append_option(row.try_get_unchecked::<Option<&str>, _>(i)?)
+            }
+            // Everything else goes through the JSON decoder, e.g. uuids, json and arrays
+            ColumnBuilder::Utf8(builder) => match plan.decode_value(row, i) {
+                Value::Null => builder.append_null(),
+                Value::String(s) => builder.append_value(s),
+                other => builder.append_value(other.to_string()),
+            },
+        }
+        Ok(())
+    }
+
+    fn finish(&mut self) -> ArrayRef {
+        match self {
+            ColumnBuilder::Int16(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Int32(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Int64(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Float32(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Float64(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Boolean(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Date32(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Timestamp(builder) => Arc::new(builder.finish()),
+            ColumnBuilder::Utf8(builder) => Arc::new(builder.finish()),
+        }
+    }
+}
+
+fn days_since_epoch(date: NaiveDate) -> i32 {
+    let epoch = NaiveDate::from_ymd_opt(1970, 1, 1).expect("the unix epoch is a valid date");
+    date.signed_duration_since(epoch).num_days() as i32
+}
+
+// Accumulates rows into Arrow record batches of at most BATCH_ROWS rows
+struct BatchBuilder {
+    schema: SchemaRef,
+    columns: Vec<ColumnBuilder>,
+    rows: usize,
+}
+
+impl BatchBuilder {
+    fn new(plan: &ResultPlan) -> Self {
+        BatchBuilder {
+            schema: schema(plan),
+            columns: plan.columns.iter().map(|c| ColumnBuilder::new(c.kind)).collect(),
+            rows: 0,
+        }
+    }
+
+    fn push(&mut self, plan: &ResultPlan, row: &PgRow) -> Result<(), BoxError> {
+        for (i, column) in self.columns.iter_mut().enumerate() {
+            column.append(plan, row, i)?;
+        }
+        self.rows += 1;
+        Ok(())
+    }
+
+    fn is_full(&self) -> bool {
+        self.rows >= BATCH_ROWS
+    }
+
+    // Take the buffered rows as a record batch, if there are any
+    fn flush(&mut self) -> Result<Option<RecordBatch>, BoxError> {
+        if self.rows == 0 {
+            return Ok(None);
+        }
+        let arrays = self.columns.iter_mut().map(ColumnBuilder::finish).collect();
+        self.rows = 0;
+        Ok(Some(RecordBatch::try_new(self.schema.clone(), arrays)?))
+    }
+}
+
+// Streams the result as an Arrow IPC stream, one record batch at a time
+//
+// An Arrow stream cannot say that rows were left out, so a result that does
+// not fit the budget ends in an error after the batches that did.
+#[derive(Default)]
+pub struct ArrowStreamEncoder {
+    batch: Option<BatchBuilder>,
+    writer: Option<StreamWriter<Vec<u8>>>,
+}
+
+impl ArrowStreamEncoder {
+    fn write_batch(&mut self, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        if let (Some(batch), Some(writer)) = (&mut self.batch, &mut self.writer) {
+            if let Some(record_batch) = batch.flush()? {
+                writer.write(&record_batch)?;
+            }
+            out.append(writer.get_mut());
+        }
+        Ok(())
+    }
+}
+
+impl RowEncoder for ArrowStreamEncoder {
+    fn begin(&mut self, plan: &ResultPlan, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        let batch = BatchBuilder::new(plan);
+        let mut writer = StreamWriter::try_new(Vec::new(), &batch.schema)?;
+        // Send the schema message straight away
+        out.append(writer.get_mut());
+        self.batch = Some(batch);
+        self.writer = Some(writer);
+        Ok(())
+    }
+
+    fn row(&mut self, plan: &ResultPlan, row: &PgRow, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        if let Some(batch) = &mut self.batch {
+            batch.push(plan, row)?;
+            if batch.is_full() {
+                self.write_batch(out)?;
+            }
+        }
+        Ok(())
+    }
+
+    fn truncated(&mut self, stats: &ResultStats, _out: &mut Vec<u8>) -> Result<(), BoxError> {
+        Err(format!(
+            "The result exceeds the budget after {} rows and {} bytes",
+            stats.row_count, stats.byte_count
+        )
+        .into())
+    }
+
+    fn finish(&mut self, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        self.write_batch(out)?;
+        if let Some(writer) = &mut self.writer {
+            writer.finish()?;
+            out.append(writer.get_mut());
+        }
+        Ok(())
+    }
+}
+
+// Encodes the result as a Parquet file
+//
+// The Parquet footer can only be written once every row group is known, so
+// the file is sent in one piece at the end. Until then the whole encoded file
+// is held in memory: the finished row groups, plus the row group being written
+// and the record batch being built, both uncompressed.
+//
+// Since nothing is sent before the end, a result that would not fit the budget
+// is rejected rather than truncated: the file could not say that rows were left
+// out.
+pub struct ParquetEncoder {
+    budget: Budget,
+    batch: Option<BatchBuilder>,
+    writer: Option<ArrowWriter<Vec<u8>>>,
+}
+
+impl ParquetEncoder {
+    pub fn new(budget: Budget) -> Self {
+        ParquetEncoder {
+            budget,
+            batch: None,
+            writer: None,
+        }
+    }
+
+    fn write_batch(&mut self) -> Result<(), BoxError> {
+        if let (Some(batch), Some(writer)) = (&mut self.batch, &mut self.writer) {
+            if let Some(record_batch) = batch.flush()? {
+                writer.write(&record_batch)?;
+            }
+            let size = writer.bytes_written() + writer.in_progress_size();
+            if size > self.budget.max_bytes {
+                return Err(too_large(self.budget));
+            }
+        }
+        Ok(())
+    }
+}
+
+fn too_large(budget: Budget) -> BoxError {
+    format!("The Parquet file exceeds the budget of {} bytes", budget.max_bytes).into()
+}
+
+impl RowEncoder for ParquetEncoder {
+    fn begin(&mut self, plan: &ResultPlan, _out: &mut Vec<u8>) -> Result<(), BoxError> {
+        let batch = BatchBuilder::new(plan);
+        let properties = WriterProperties::builder()
+            .set_compression(Compression::SNAPPY)
+            .build();
+        self.writer = Some(ArrowWriter::try_new(
+            Vec::new(),
+            batch.schema.clone(),
+            Some(properties),
+        )?);
+        self.batch = Some(batch);
+        Ok(())
+    }
+
+    fn row(&mut self, plan: &ResultPlan, row: &PgRow, _out: &mut Vec<u8>) -> Result<(), BoxError> {
+        if let Some(batch) = &mut self.batch {
+            batch.push(plan, row)?;
+            if batch.is_full() {
+                self.write_batch()?;
+            }
+        }
+        Ok(())
+    }
+
+    // Nothing is written until the end, so only the row budget can cut the
+    // result short
+    fn truncated(&mut self, _stats: &ResultStats, _out: &mut Vec<u8>) -> Result<(), BoxError> {
+        Err(format!(
+            "The result has more rows than the budget of {}",
+            self.budget.max_rows
+        )
+        .into())
+    }
+
+    fn finish(&mut self, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        self.write_batch()?;
+        if let Some(writer) = self.writer.take() {
+            let file = writer.into_inner()?;
+            if file.len() > self.budget.max_bytes {
+                return Err(too_large(self.budget));
+            }
+            out.extend_from_slice(&file);
+        }
+        Ok(())
+    }
+}
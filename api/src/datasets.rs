@@ -0,0 +1,1013 @@
+use std::fmt::Display;
+use std::time::Instant;
+
+use axum::body::Bytes;
+use axum::http::StatusCode;
+use futures::{Stream, StreamExt, TryStreamExt};
+use serde::{Deserialize, Serialize};
+use serde_json::{Map, Value};
+use sqlx::{PgPool, Postgres, Transaction};
+
+use crate::cache::TABLE_CHANGED_CHANNEL;
+use crate::models::ColumnInfo;
+use crate::views::ViewManager;
+
+// Tables are loaded here first, out of sight of the LLM engine's schema
+// introspection, which only reads the public schema
+const STAGING_SCHEMA: &str = "lucidata_staging";
+
+// Header of the binary COPY format: signature, flags and header extension length
+const BINARY_HEADER: &[u8] = b"PGCOPY\n\xff\r\n\0\0\0\0\0\0\0\0\0";
+
+// How uploads are split up and loaded, from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct DatasetConfig {
+    // Upload bytes per COPY; each chunk in flight is held in memory once
+    pub chunk_bytes: usize,
+    // Chunks loaded at the same time, each on its own connection from the
+    // dataset pool, which has this many
+    pub parallelism: usize,
+    // Records the column types are inferred from
+    pub sample_rows: usize,
+}
+
+impl DatasetConfig {
+    pub fn from_env() -> Self {
+        DatasetConfig {
+            chunk_bytes: crate::env_var("DATASET_CHUNK_BYTES", 8 * 1024 * 1024).max(1),
+            parallelism: crate::env_var("DATASET_PARALLELISM", 4).max(1),
+            sample_rows: crate::env_var("DATASET_SAMPLE_ROWS", 1000).max(1),
+        }
+    }
+}
+
+#[derive(Deserialize, Clone, Copy, Debug, PartialEq, Eq)]
+#[serde(rename_all = "lowercase")]
+pub enum DatasetFormat {
+    // With a header row naming the columns
+    Csv,
+    // One JSON object per line
+    Ndjson,
+}
+
+#[derive(Deserialize, Clone, Copy, Debug, Default, PartialEq, Eq)]
+#[serde(rename_all = "lowercase")]
+pub enum LoadMode {
+    // Fail if the table already exists
+    #[default]
+    Create,
+    // Swap the new table in for the existing one
+    Replace,
+}
+
+#[derive(Serialize)]
+pub struct LoadSummary {
+    pub table: String,
+    pub columns: Vec<ColumnInfo>,
+    pub rows: u64,
+    pub chunks: usize,
+    pub elapsed_ms: u128,
+}
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum ColumnType {
+    Boolean,
+    Bigint,
+    Double,
+    Text,
+    Jsonb,
+}
+
+impl ColumnType {
+    fn sql(self) -> &'static str {
+        match self {
+            ColumnType::Boolean => "boolean",
+            ColumnType::Bigint => "bigint",
+            ColumnType::Double => "double precision",
+            ColumnType::Text => "text",
+            ColumnType::Jsonb => "jsonb",
+        }
+    }
+
+    // The narrowest type holding values of both types
+    fn widen(self, other: ColumnType) -> ColumnType {
+        use ColumnType::*;
+        match (self, other) {
+            (a, b) if a == b => a,
+            (Bigint, Double) | (Double, Bigint) => Double,
+            (Jsonb, _) | (_, Jsonb) => Jsonb,
+            _ => Text,
+        }
+    }
+}
+
+struct Column {
+    // As it appears in the upload
+    source: String,
+    // Sanitized for Postgres
+    name: String,
+    column_type: ColumnType,
+}
+
+// Load an uploaded CSV or NDJSON body into `table`
+//
+// The body is split into chunks at record boundaries as it arrives. Column
+// names and types are inferred from the first records, then up to
+// `parallelism` chunks at a time are copied into a staging table, each on its
+// own connection, so memory use depends on the chunk size and not on the size
+// of the upload. CSV chunks are passed to `COPY ... (FORMAT csv)` as they are;
+// NDJSON is converted to the binary COPY format. Once every chunk is in, the
+// staging table is moved into place in one transaction, replacing the
+// existing table if asked to, and analyzed.
+pub async fn load<S, E>(
+    pool: &PgPool,
+    config: &DatasetConfig,
+    views: &ViewManager,
+    table: &str,
+    format: DatasetFormat,
+    mode: LoadMode,
+    body: S,
+) -> Result<LoadSummary, (StatusCode, String)>
+where
+    S: Stream<Item = Result<Bytes, E>> + Send + Unpin,
+    E: Display,
+{
+    let start = Instant::now();
+    let table = table_name(table)?;
+    let mut chunks = Chunker::new(body, format, config.chunk_bytes);
+
+    let mut first = chunks
+        .next_chunk()
+        .await?
+        .ok_or_else(|| (StatusCode::BAD_REQUEST, "The upload is empty".to_string()))?;
+    let columns = match format {
+        DatasetFormat::Csv => {
+            let (columns, header_len) = infer_csv(&first, config.sample_rows)?;
+            first.drain(..header_len);
+            columns
+        }
+        DatasetFormat::Ndjson => infer_ndjson(&first, config.sample_rows)?,
+    };
+
+    if mode == LoadMode::Create && exists(pool, &table).await.map_err(database_error)? {
+        return Err((
+            StatusCode::CONFLICT,
+            format!(
+                "Table {} already exists; upload with mode=replace to replace it",
+                table
+            ),
+        ));
+    }
+
+    let staging = format!("{}.t_{}", STAGING_SCHEMA, uuid::Uuid::new_v4().simple());
+    let definitions: Vec<String> = columns
+        .iter()
+        .map(|column| format!("{} {}", quote_ident(&column.name), column.column_type.sql()))
+        .collect();
+    sqlx::query(&format!("CREATE SCHEMA IF NOT EXISTS {}", STAGING_SCHEMA))
+        .execute(pool)
+        .await
+        .map_err(database_error)?;
+    sqlx::query(&format!(
+        "CREATE TABLE {} ({})",
+        staging,
+        definitions.join(", ")
+    ))
+    .execute(pool)
+    .await
+    .map_err(database_error)?;
+
+    let loaded = copy_chunks(pool, config, &staging, &columns, format, first, chunks).await;
+    let (rows, count) = match loaded {
+        Ok(loaded) => loaded,
+        Err(e) => {
+            drop_staging(pool, &staging).await;
+            return Err(e);
+        }
+    };
+
+    if let Err(e) = swap(pool, views, &staging, &table, mode).await {
+        drop_staging(pool, &staging).await;
+        return Err(e);
+    }
+    // Outside the swap, so the new table is visible while it runs
+    analyze(pool, &table).await.map_err(database_error)?;
+
+    Ok(LoadSummary {
+        columns: columns
+            .iter()
+            .map(|column| ColumnInfo {
+                name: column.name.clone(),
+                type_name: column.column_type.sql().to_string(),
+            })
+            .collect(),
+        table,
+        rows,
+        chunks: count,
+        elapsed_ms: start.elapsed().as_millis(),
+    })
+}
+
+// Copy every chunk into the staging table, and return the rows and chunks loaded
+async fn copy_chunks<S, E>(
+    pool: &PgPool,
+    config: &DatasetConfig,
+    staging: &str,
+    columns: &[Column],
+    format: DatasetFormat,
+    first: Vec<u8>,
+    chunks: Chunker<S>,
+) -> Result<(u64, usize), (StatusCode, String)>
+where
+    S: Stream<Item = Result<Bytes, E>> + Send + Unpin,
+    E: Display,
+{
+    let names: Vec<String> = columns
+        .iter()
+        .map(|column| quote_ident(&column.name))
+        .collect();
+    let statement = match format {
+        DatasetFormat::Csv => format!(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT csv)",
+            staging,
+            names.join(", ")
+        ),
+        DatasetFormat::Ndjson => format!(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT binary)",
+            staging,
+            names.join(", ")
+        ),
+    };
+
+    // Chunks are read from the body only as fast as they are loaded
+    let rest = futures::stream::unfold(Some(chunks), |chunks| async move {
+        let mut chunks = chunks?;
+        match chunks.next_chunk().await {
+            Ok(Some(chunk)) => Some((Ok(chunk), Some(chunks))),
+            Ok(None) => None,
+            Err(e) => Some((Err(e), None)),
+        }
+    });
+    let source = futures::stream::once(async move { Ok(first) }).chain(rest);
+
+    source
+        .enumerate()
+        .map(|(index, chunk)| {
+            let statement = &statement;
+            async move {
+                let chunk = chunk?;
+                let data = match format {
+                    DatasetFormat::Csv => chunk,
+                    DatasetFormat::Ndjson => encode_binary(&chunk, columns).map_err(|e| {
+                        (StatusCode::BAD_REQUEST, format!("Chunk {}: {}", index, e))
+                    })?,
+                };
+                copy_chunk(pool, statement, data)
+                    .await
+                    .map_err(|e| (StatusCode::BAD_REQUEST, format!("Chunk {}: {}", index, e)))
+            }
+        })
+        .buffer_unordered(config.parallelism)
+        .try_fold((0, 0), |(rows, chunks), loaded| async move {
+            Ok((rows + loaded, chunks + 1))
+        })
+        .await
+}
+
+async fn copy_chunk(pool: &PgPool, statement: &str, data: Vec<u8>) -> Result<u64, sqlx::Error> {
+    let mut tx = without_timeout(pool).await?;
+    let mut copy = tx.copy_in_raw(statement).await?;
+    copy.send(data).await?;
+    let rows = copy.finish().await?;
+    tx.commit().await?;
+    Ok(rows)
+}
+
+// Move the staging table into the public schema as `table`
+//
+// Readers see either the old table or the new one. The new table gets the
+// trigger that tells the api's caches about changes, and replacing a table
+// drops the cached results that read from the old one, and the materialized
+// views built on it, which would otherwise keep it from being dropped.
+async fn swap(
+    pool: &PgPool,
+    views: &ViewManager,
+    staging: &str,
+    table: &str,
+    mode: LoadMode,
+) -> Result<(), (StatusCode, String)> {
+    let mut tx = without_timeout(pool).await.map_err(database_error)?;
+    let temporary = staging.rsplit('.').next().unwrap_or_default();
+
+    let mut dropped_views = Vec::new();
+    if mode == LoadMode::Replace {
+        dropped_views = views
+            .drop_dependents(&mut tx, &format!("public.{}", quote_ident(table)))
+            .await
+            .map_err(database_error)?;
+        sqlx::query(&format!(
+            "DROP TABLE IF EXISTS public.{}",
+            quote_ident(table)
+        ))
+        .execute(&mut *tx)
+        .await
+        .map_err(|e| {
+            (
+                StatusCode::CONFLICT,
+                format!("Cannot replace table {}: {}", table, e),
+            )
+        })?;
+    }
+    for statement in [
+        format!("ALTER TABLE {} SET SCHEMA public", staging),
+        format!(
+            "ALTER TABLE public.{} RENAME TO {}",
+            temporary,
+            quote_ident(table)
+        ),
+        format!(
+            "CREATE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.{} \
+             FOR EACH STATEMENT EXECUTE FUNCTION lucidata_notify_table_change()",
+            quote_ident(&format!("{}_notify_change", table)),
+            quote_ident(table)
+        ),
+    ] {
+        sqlx::query(&statement)
+            .execute(&mut *tx)
+            .await
+            .map_err(database_error)?;
+    }
+    sqlx::query("SELECT pg_notify($1, $2)")
+        .bind(TABLE_CHANGED_CHANNEL)
+        .bind(table)
+        .execute(&mut *tx)
+        .await
+        .map_err(database_error)?;
+
+    tx.commit().await.map_err(database_error)?;
+    views.forget(&dropped_views);
+    Ok(())
+}
+
+async fn analyze(pool: &PgPool, table: &str) -> Result<(), sqlx::Error> {
+    let mut tx = without_timeout(pool).await?;
+    sqlx::query(&format!("ANALYZE public.{}", quote_ident(table)))
+        .execute(&mut *tx)
+        .await?;
+    tx.commit().await
+}
+
+async fn drop_staging(pool: &PgPool, staging: &str) {
+    if let Err(e) = sqlx::query(&format!("DROP TABLE IF EXISTS {}", staging))
+        .execute(pool)
+        .await
+    {
+        tracing::warn!("Failed to drop staging table {}: {}", staging, e);
+    }
+}
+
+async fn exists(pool: &PgPool, table: &str) -> Result<bool, sqlx::Error> {
+    sqlx::query_scalar("SELECT to_regclass($1) IS NOT NULL")
+        .bind(format!("public.{}", quote_ident(table)))
+        .fetch_one(pool)
+        .await
+}
+
+// A transaction without the pool's statement timeout, which loads of large
+// uploads would exceed
+async fn without_timeout(pool: &PgPool) -> Result<Transaction<'static, Postgres>, sqlx::Error> {
+    let mut tx = pool.begin().await?;
+    sqlx::query("SELECT set_config('statement_timeout', '0', true)")
+        .execute(&mut *tx)
+        .await?;
+    Ok(tx)
+}
+
+fn database_error(e: sqlx::Error) -> (StatusCode, String) {
+    (
+        StatusCode::INTERNAL_SERVER_ERROR,
+        format!("Database error: {}", e),
+    )
+}
+
+// Splits an upload into chunks of about `chunk_bytes` that end at record
+// boundaries
+//
+// In CSV a newline inside a quoted field does not end the record, so quotes
+// are tracked across reads.
+struct Chunker<S> {
+    body: S,
+    format: DatasetFormat,
+    chunk_bytes: usize,
+    buffer: Vec<u8>,
+    // Bytes of `buffer` already scanned for boundaries, whether the scan
+    // ended inside quotes, and the end of the last record found
+    scanned: usize,
+    quoted: bool,
+    boundary: usize,
+    finished: bool,
+}
+
+impl<S, E> Chunker<S>
+where
+    S: Stream<Item = Result<Bytes, E>> + Unpin,
+    E: Display,
+{
+    fn new(body: S, format: DatasetFormat, chunk_bytes: usize) -> Self {
+        Chunker {
+            body,
+            format,
+            chunk_bytes,
+            buffer: Vec::new(),
+            scanned: 0,
+            quoted: false,
+            boundary: 0,
+            finished: false,
+        }
+    }
+
+    async fn next_chunk(&mut self) -> Result<Option<Vec<u8>>, (StatusCode, String)> {
+        loop {
+            if self.boundary > 0 && self.buffer.len() >= self.chunk_bytes {
+                let rest = self.buffer.split_off(self.boundary);
+                self.scanned -= self.boundary;
+                self.boundary = 0;
+                return Ok(Some(std::mem::replace(&mut self.buffer, rest)));
+            }
+            if self.finished {
+                if self.buffer.iter().all(u8::is_ascii_whitespace) {
+                    return Ok(None);
+                }
+                if self.quoted {
+                    return Err((
+                        StatusCode::BAD_REQUEST,
+                        "The upload ends inside a quoted field".to_string(),
+                    ));
+                }
+                self.scanned = 0;
+                self.boundary = 0;
+                let mut chunk = std::mem::take(&mut self.buffer);
+                // COPY expects every record to be terminated
+                if chunk.last() != Some(&b'\n') {
+                    chunk.push(b'\n');
+                }
+                return Ok(Some(chunk));
+            }
+
+            match self.body.next().await {
+                Some(Ok(bytes)) => {
+                    self.buffer.extend_from_slice(&bytes);
+                    self.scan();
+                }
+                Some(Err(e)) => {
+                    return Err((
+                        StatusCode::BAD_REQUEST,
+                        format!("Failed to read the upload: {}", e),
+                    ))
+                }
+                None => self.finished = true,
+            }
+        }
+    }
+
+    fn scan(&mut self) {
+        for (i, &byte) in self.buffer.iter().enumerate().skip(self.scanned) {
+            match byte {
+                b'"' if self.format == DatasetFormat::Csv => self.quoted = !self.quoted,
+                b'\n' if !self.quoted => self.boundary = i + 1,
+                _ => {}
+            }
+        }
+        self.scanned = self.buffer.len();
+    }
+}
+
+// Column names from the header record of a CSV chunk, and types inferred from
+// the records after it, with the length of the header
+fn infer_csv(
+    chunk: &[u8],
+    sample_rows: usize,
+) -> Result<(Vec<Column>, usize), (StatusCode, String)> {
+    let text = std::str::from_utf8(chunk).map_err(|e| {
+        (
+            StatusCode::BAD_REQUEST,
+            format!("The upload is not UTF-8: {}", e),
+        )
+    })?;
+    let mut records = CsvRecords { text, position: 0 };
+    let header = records.next().ok_or_else(|| {
+        (
+            StatusCode::BAD_REQUEST,
+            "The upload has no header".to_string(),
+        )
+    })?;
+    let header_len = records.position;
+
+    let mut types: Vec<Option<ColumnType>> = vec![None; header.len()];
+    for (row, record) in records.take(sample_rows).enumerate() {
+        if record.len() != header.len() {
+            return Err((
+                StatusCode::BAD_REQUEST,
+                format!(
+                    "Record {} has {} fields, the header has {}",
+                    row + 1,
+                    record.len(),
+                    header.len()
+                ),
+            ));
+        }
+        for (column_type, field) in types.iter_mut().zip(&record) {
+            // Empty fields are loaded as NULL
+            if field.is_empty() {
+                continue;
+            }
+            let field_type = if field.parse::<i64>().is_ok() {
+                ColumnType::Bigint
+            } else if field.parse::<f64>().is_ok() {
+                ColumnType::Double
+            } else if matches!(field.to_lowercase().as_str(), "true" | "false") {
+                ColumnType::Boolean
+            } else {
+                ColumnType::Text
+            };
+            *column_type = Some(match column_type {
+                Some(column_type) => column_type.widen(field_type),
+                None => field_type,
+            });
+        }
+    }
+
+    let columns = columns(
+        header
+            .into_iter()
+            .zip(types)
+            .map(|(name, column_type)| (name, column_type.unwrap_or(ColumnType::Text))),
+    )?;
+    Ok((columns, header_len))
+}
+
+// Columns from the keys of the objects in an NDJSON chunk, in the order they
+// first appear, with types inferred from their values
+fn infer_ndjson(chunk: &[u8], sample_rows: usize) -> Result<Vec<Column>, (StatusCode, String)> {
+    let mut fields: Vec<(String, Option<ColumnType>)> = Vec::new();
+    let lines = chunk
+        .split(|&byte| byte == b'\n')
+        .filter(|line| !line.iter().all(u8::is_ascii_whitespace));
+    for (row, line) in lines.take(sample_rows).enumerate() {
+        let object: Map<String, Value> = serde_json::from_slice(line).map_err(|e| {
+            (
+                StatusCode::BAD_REQUEST,
+                format!("Line {} is not a JSON object: {}", row + 1, e),
+            )
+        })?;
+        for (key, value) in object {
+            let value_type = match value {
+                Value::Null => None,
+                Value::Bool(_) => Some(ColumnType::Boolean),
+                Value::Number(number) if number.is_i64() => Some(ColumnType::Bigint),
+                Value::Number(_) => Some(ColumnType::Double),
+                Value::String(_) => Some(ColumnType::Text),
+                Value::Array(_) | Value::Object(_) => Some(ColumnType::Jsonb),
+            };
+            match fields.iter_mut().find(|(name, _)| *name == key) {
+                Some((_, column_type)) => {
+                    if let Some(value_type) = value_type {
+                        *column_type = Some(match column_type {
+                            Some(column_type) => column_type.widen(value_type),
+                            None => value_type,
+                        });
+                    }
+                }
+                None => fields.push((key, value_type)),
+            }
+        }
+    }
+
+    columns(
+        fields
+            .into_iter()
+            .map(|(name, column_type)| (name, column_type.unwrap_or(ColumnType::Text))),
+    )
+}
+
+// Columns with names Postgres accepts: lowercase letters, digits and
+// underscores, unique, and at most 63 bytes
+fn columns(
+    fields: impl Iterator<Item = (String, ColumnType)>,
+) -> Result<Vec<Column>, (StatusCode, String)> {
+    let mut columns: Vec<Column> = Vec::new();
+    for (source, column_type) in fields {
+        let mut name: String = source
+            .trim_start_matches('\u{feff}')
+            .trim()
+            .to_lowercase()
+            .chars()
+            .map(|c| if c.is_ascii_alphanumeric() { c } else { '_' })
+            .collect();
+        if name.is_empty() || name.starts_with(|c: char| c.is_ascii_digit()) {
+            name.insert(0, '_');
+        }
+        name.truncate(59);
+        let base = name.clone();
+        let mut suffix = 1;
+        while columns.iter().any(|column| column.name == name) {
+            suffix += 1;
+            name = format!("{}_{}", base, suffix);
+        }
+        columns.push(Column {
+            source,
+            name,
+            column_type,
+        });
+    }
+    if columns.is_empty() {
+        return Err((
+            StatusCode::BAD_REQUEST,
+            "The upload has no columns".to_string(),
+        ));
+    }
+    Ok(columns)
+}
+
+// Encode the objects of an NDJSON chunk as binary COPY data
+fn encode_binary(chunk: &[u8], columns: &[Column]) -> Result<Vec<u8>, String> {
+    let mut out = Vec::with_capacity(chunk.len());
+    out.extend_from_slice(BINARY_HEADER);
+
+    let lines = chunk
+        .split(|&byte| byte == b'\n')
+        .filter(|line| !line.iter().all(u8::is_ascii_whitespace));
+    for (row, line) in lines.enumerate() {
+        let mut object: Map<String, Value> = serde_json::from_slice(line)
+            .map_err(|e| format!("line {} is not a JSON object: {}", row + 1, e))?;
+
+        out.extend_from_slice(&(columns.len() as i16).to_be_bytes());
+        for column in columns {
+            let value = object.remove(&column.source).unwrap_or(Value::Null);
+            encode_value(&mut out, column.column_type, value)
+                .map_err(|e| format!("line {}, field {}: {}", row + 1, column.source, e))?;
+        }
+        if let Some(key) = object.keys().next() {
+            return Err(format!(
+                "line {} has field {}, which is not in the first rows",
+                row + 1,
+                key
+            ));
+        }
+    }
+
+    // File trailer
+    out.extend_from_slice(&(-1i16).to_be_bytes());
+    Ok(out)
+}
+
+// Append one field: its length, or -1 for NULL, followed by the value in the
+// column type's binary representation
+fn encode_value(out: &mut Vec<u8>, column_type: ColumnType, value: Value) -> Result<(), String> {
+    let bytes: Vec<u8> = match (column_type, value) {
+        (_, Value::Null) => {
+            out.extend_from_slice(&(-1i32).to_be_bytes());
+            return Ok(());
+        }
+        (ColumnType::Boolean, Value::Bool(b)) => vec![b as u8],
+        (ColumnType::Bigint, Value::Number(number)) => number
+            .as_i64()
+            .ok_or_else(|| format!("{} is not an integer", number))?
+            .to_be_bytes()
+            .to_vec(),
+        (ColumnType::Double, Value::Number(number)) => number
+            .as_f64()
+            .ok_or_else(|| format!("{} is not a number", number))?
+            .to_be_bytes()
+            .to_vec(),
+        (ColumnType::Text, Value::String(s)) => s.into_bytes(),
+        (ColumnType::Text, value) => value.to_string().into_bytes(),
+        (ColumnType::Jsonb, value) => {
+            // Version 1 of the jsonb binary format is the JSON text
+            let mut bytes = vec![1];
+            bytes.extend_from_slice(value.to_string().as_bytes());
+            bytes
+        }
+        (column_type, value) => {
+            return Err(format!("{} is not a {} value", value, column_type.sql()));
+        }
+    };
+    out.extend_from_slice(&(bytes.len() as i32).to_be_bytes());
+    out.extend_from_slice(&bytes);
+    Ok(())
+}
+
+// Records of CSV text with quoted fields, as RFC 4180 describes
+struct CsvRecords<'a> {
+    text: &'a str,
+    // Byte offset of the next record
+    position: usize,
+}
+
+impl Iterator for CsvRecords<'_> {
+    type Item = Vec<String>;
+
+    fn next(&mut self) -> Option<Vec<String>> {
+        let rest = &self.text[self.position..];
+        if rest.trim().is_empty() {
+            return None;
+        }
+
+        let mut fields = Vec::new();
+        let mut field = String::new();
+        let mut quoted = false;
+        let mut chars = rest.char_indices().peekable();
+        while let Some((i, c)) = chars.next() {
+            match c {
+                '"' if quoted && chars.peek().map(|&(_, c)| c) == Some('"') => {
+                    field.push('"');
+                    chars.next();
+                }
+                '"' => quoted = !quoted,
+                ',' if !quoted => fields.push(std::mem::take(&mut field)),
+                '\n' if !quoted => {
+                    self.position += i + 1;
+                    if field.ends_with('\r') {
+                        field.pop();
+                    }
+                    fields.push(field);
+                    return Some(fields);
+                }
+                c => field.push(c),
+            }
+        }
+        self.position = self.text.len();
+        fields.push(field);
+        Some(fields)
+    }
+}
+
+// Check a table name from the request path
+fn table_name(name: &str) -> Result<String, (StatusCode, String)> {
+    let valid = !name.is_empty()
+        && name.len() <= 63
+        && name
+            .chars()
+            .all(|c| c.is_ascii_lowercase() || c.is_ascii_digit() || c == '_')
+        && !name.starts_with(|c: char| c.is_ascii_digit())
+        && !name.starts_with("pg_")
+        && !name.starts_with("lucidata_");
+    if !valid {
+        return Err((
+            StatusCode::BAD_REQUEST,
+            format!(
+                "Invalid table name {:?}: use lowercase letters, digits and underscores, \
+                 not starting with a digit, pg_ or lucidata_",
+                name
+            ),
+        ));
+    }
+    Ok(name.to_string())
+}
+
+fn quote_ident(name: &str) -> String {
+    format!("\"{}\"", name.replace('"', "\"\""))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    async fn chunks(
+        pieces: &[&'static str],
+        format: DatasetFormat,
+        chunk_bytes: usize,
+    ) -> Result<Vec<String>, (StatusCode, String)> {
+        let body = futures::stream::iter(
+            pieces
+                .iter()
+                .map(|piece| Ok::<_, String>(Bytes::from_static(piece.as_bytes())))
+                .collect::<Vec<_>>(),
+        );
+        let mut chunker = Chunker::new(body, format, chunk_bytes);
+        let mut chunks = Vec::new();
+        while let Some(chunk) = chunker.next_chunk().await? {
+            chunks.push(String::from_utf8(chunk).unwrap());
+        }
+        Ok(chunks)
+    }
+
+    fn types(columns: &[Column]) -> Vec<(&str, ColumnType)> {
+        columns
+            .iter()
+            .map(|column| (column.name.as_str(), column.column_type))
+            .collect()
+    }
+
+    #[tokio::test]
+    async fn chunks_end_at_record_boundaries() {
+        let chunks = chunks(&["a,b\n1,2\n3,", "4\n5,6"], DatasetFormat::Csv, 4)
+            .await
+            .unwrap();
+        assert_eq!(chunks, ["a,b\n1,2\n", "3,4\n", "5,6\n"]);
+    }
+
+    #[tokio::test]
+    async fn chunks_keep_quoted_newlines_together() {
+        let chunks = chunks(
+            &["\"a\n", "b\",1\n\"c\"\"\n", "d\",2\n"],
+            DatasetFormat::Csv,
+            1,
+        )
+        .await
+        .unwrap();
+        assert_eq!(chunks, ["\"a\nb\",1\n", "\"c\"\"\nd\",2\n"]);
+    }
+
+    #[tokio::test]
+    async fn ndjson_chunks_ignore_quotes() {
+        let chunks = chunks(&["{\"a\":\"\\\"\"}\n{\"a\":1}\n"], DatasetFormat::Ndjson, 1)
+            .await
+            .unwrap();
+        assert_eq!(chunks, ["{\"a\":\"\\\"\"}\n", "{\"a\":1}\n"]);
+    }
+
+    #[tokio::test]
+    async fn empty_uploads_have_no_chunks() {
+        assert!(chunks(&[], DatasetFormat::Csv, 1024)
+            .await
+            .unwrap()
+            .is_empty());
+        assert!(chunks(&["\n ", "\r\n"], DatasetFormat::Csv, 1024)
+            .await
+            .unwrap()
+            .is_empty());
+    }
+
+    #[tokio::test]
+    async fn rejects_an_unterminated_quote() {
+        let (status, _) = chunks(&["a\n\"b,1\n"], DatasetFormat::Csv, 1024)
+            .await
+            .unwrap_err();
+        assert_eq!(status, StatusCode::BAD_REQUEST);
+    }
+
+    #[tokio::test]
+    async fn reports_body_errors() {
+        let body = futures::stream::iter(vec![
+            Ok(Bytes::from_static(b"a\n")),
+            Err("connection reset".to_string()),
+        ]);
+        let mut chunker = Chunker::new(body, DatasetFormat::Csv, 1024);
+        let (status, message) = chunker.next_chunk().await.unwrap_err();
+        assert_eq!(status, StatusCode::BAD_REQUEST);
+        assert!(message.contains("connection reset"), "{}", message);
+    }
+
+    #[test]
+    fn infers_csv_types() {
+        let csv = "id,price,flag,name,empty,mixed\n\
+                   1,1.5,true,x,,1\n\
+                   2,2,FALSE,\"y, \"\"z\"\"\",,2.5\n";
+        let (columns, header_len) = infer_csv(csv.as_bytes(), 100).unwrap();
+        assert_eq!(header_len, "id,price,flag,name,empty,mixed\n".len());
+        assert_eq!(
+            types(&columns),
+            [
+                ("id", ColumnType::Bigint),
+                ("price", ColumnType::Double),
+                ("flag", ColumnType::Boolean),
+                ("name", ColumnType::Text),
+                ("empty", ColumnType::Text),
+                ("mixed", ColumnType::Double),
+            ]
+        );
+    }
+
+    #[test]
+    fn infers_csv_types_from_the_sample_only() {
+        let (columns, _) = infer_csv(b"a,b\r\n1,2\r\nx,y\r\n", 1).unwrap();
+        assert_eq!(
+            types(&columns),
+            [("a", ColumnType::Bigint), ("b", ColumnType::Bigint)]
+        );
+    }
+
+    #[test]
+    fn cleans_up_column_names() {
+        let (columns, _) = infer_csv(
+            "\u{feff}Model Name,2nd,model name,\"a,b\",\n".as_bytes(),
+            10,
+        )
+        .unwrap();
+        let names: Vec<&str> = columns.iter().map(|column| column.name.as_str()).collect();
+        assert_eq!(names, ["model_name", "_2nd", "model_name_2", "a_b", "_"]);
+        assert_eq!(columns[3].source, "a,b");
+    }
+
+    #[test]
+    fn rejects_ragged_csv() {
+        let (status, message) = infer_csv(b"a,b\n1,2\n3\n", 10).unwrap_err();
+        assert_eq!(status, StatusCode::BAD_REQUEST);
+        assert_eq!(message, "Record 2 has 1 fields, the header has 2");
+    }
+
+    #[test]
+    fn infers_ndjson_types() {
+        let ndjson = b"{\"a\":1,\"b\":null,\"c\":[1]}\n\n{\"a\":2.5,\"b\":\"x\",\"d\":true,\"e\":1}\n{\"e\":\"1\"}\n";
+        let columns = infer_ndjson(ndjson, 100).unwrap();
+        assert_eq!(
+            types(&columns),
+            [
+                ("a", ColumnType::Double),
+                ("b", ColumnType::Text),
+                ("c", ColumnType::Jsonb),
+                ("d", ColumnType::Boolean),
+                ("e", ColumnType::Text),
+            ]
+        );
+    }
+
+    #[test]
+    fn rejects_ndjson_that_is_not_objects() {
+        let (status, message) = infer_ndjson(b"{\"a\":1}\n[1]\n", 100).unwrap_err();
+        assert_eq!(status, StatusCode::BAD_REQUEST);
+        assert!(
+            message.starts_with("Line 2 is not a JSON object"),
+            "{}",
+            message
+        );
+    }
+
+    #[test]
+    fn encodes_binary_copy_data() {
+        let ndjson = b"{\"n\":-2,\"f\":0.5,\"b\":true,\"s\":\"\\u00e9\\\"\",\"j\":{\"k\":[1]}}\n\
+                       {\"n\":null,\"s\":7}\n";
+        let columns = vec![
+            ("n", ColumnType::Bigint),
+            ("f", ColumnType::Double),
+            ("b", ColumnType::Boolean),
+            ("s", ColumnType::Text),
+            ("j", ColumnType::Jsonb),
+        ]
+        .into_iter()
+        .map(|(name, column_type)| Column {
+            source: name.to_string(),
+            name: name.to_string(),
+            column_type,
+        })
+        .collect::<Vec<_>>();
+
+        let mut expected = BINARY_HEADER.to_vec();
+        let field = |expected: &mut Vec<u8>, bytes: &[u8]| {
+            expected.extend_from_slice(&(bytes.len() as i32).to_be_bytes());
+            expected.extend_from_slice(bytes);
+        };
+        let null = (-1i32).to_be_bytes();
+
+        expected.extend_from_slice(&5i16.to_be_bytes());
+        field(&mut expected, &(-2i64).to_be_bytes());
+        field(&mut expected, &0.5f64.to_be_bytes());
+        field(&mut expected, &[1]);
+        field(&mut expected, "é\"".as_bytes());
+        field(&mut expected, b"\x01{\"k\":[1]}");
+
+        expected.extend_from_slice(&5i16.to_be_bytes());
+        expected.extend_from_slice(&null);
+        expected.extend_from_slice(&null);
+        expected.extend_from_slice(&null);
+        field(&mut expected, b"7");
+        expected.extend_from_slice(&null);
+
+        expected.extend_from_slice(&(-1i16).to_be_bytes());
+        assert_eq!(encode_binary(ndjson, &columns).unwrap(), expected);
+    }
+
+    #[test]
+    fn rejects_values_that_do_not_fit_the_columns() {
+        let columns = infer_ndjson(b"{\"n\":1}\n", 10).unwrap();
+        assert_eq!(
+            encode_binary(b"{\"n\":1}\n{\"n\":1.5}\n", &columns).unwrap_err(),
+            "line 2, field n: 1.5 is not an integer"
+        );
+        assert_eq!(
+            encode_binary(b"{\"n\":\"1\"}\n", &columns).unwrap_err(),
+            "line 1, field n: \"1\" is not a bigint value"
+        );
+        assert_eq!(
+            encode_binary(b"{\"n\":1,\"m\":2}\n", &columns).unwrap_err(),
+            "line 1 has field m, which is not in the first rows"
+        );
+    }
+
+    #[test]
+    fn checks_table_names() {
+        assert!(table_name("emissions_2024").is_ok());
+        for name in [
+            "",
+            "Emissions",
+            "2024",
+            "pg_stats",
+            "lucidata_mv",
+            "a-b",
+            "a\"b",
+        ] {
+            assert!(table_name(name).is_err(), "{}", name);
+        }
+    }
+}
@@ -0,0 +1,244 @@
+use num_traits::ToPrimitive;
+use serde::ser::{SerializeMap, SerializeSeq, Serializer};
+use serde::Serialize;
+use serde_json::{Number, Value};
+use sqlx::postgres::{PgColumn, PgRow};
+use sqlx::types::chrono::{DateTime, NaiveDate, NaiveDateTime, NaiveTime, Utc};
+use sqlx::types::{BigDecimal, Uuid};
+use sqlx::{Column, Decode, Postgres, Row, TypeInfo};
+
+use crate::models::ColumnInfo;
+
+// How a single result column is decoded, chosen once per result set from the
+// Postgres type of the column
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum ColumnKind {
+    Int2,
+    Int4,
+    Int8,
+    Float4,
+    Float8,
+    Numeric,
+    Text,
+    Bool,
+    Date,
+    Time,
+    Timestamp,
+    Timestamptz,
+    Uuid,
+    Json,
+    Int2Array,
+    Int4Array,
+    Int8Array,
+    Float4Array,
+    Float8Array,
+    TextArray,
+    BoolArray,
+    Other,
+}
+
+impl ColumnKind {
+    // Map a Postgres type name, as reported by sqlx, to its decoder
+    pub fn from_type_name(name: &str) -> Self {
+        match name {
+            "INT2" => ColumnKind::Int2,
+            "INT4" => ColumnKind::Int4,
+            "INT8" => ColumnKind::Int8,
+            "FLOAT4" => ColumnKind::Float4,
+            "FLOAT8" => ColumnKind::Float8,
+            "NUMERIC" => ColumnKind::Numeric,
+            "TEXT" | "VARCHAR" | "BPCHAR" | "NAME" => ColumnKind::Text,
+            "BOOL" => ColumnKind::Bool,
+            "DATE" => ColumnKind::Date,
+            "TIME" => ColumnKind::Time,
+            "TIMESTAMP" => ColumnKind::Timestamp,
+            "TIMESTAMPTZ" => ColumnKind::Timestamptz,
+            "UUID" => ColumnKind::Uuid,
+            "JSON" | "JSONB" => ColumnKind::Json,
+            "INT2[]" => ColumnKind::Int2Array,
+            "INT4[]" => ColumnKind::Int4Array,
+            "INT8[]" => ColumnKind::Int8Array,
+            "FLOAT4[]" => ColumnKind::Float4Array,
+            "FLOAT8[]" => ColumnKind::Float8Array,
+            "TEXT[]" | "VARCHAR[]" | "BPCHAR[]" | "NAME[]" => ColumnKind::TextArray,
+            "BOOL[]" => ColumnKind::BoolArray,
+            _ => ColumnKind::Other,
+        }
+    }
+}
+
+// A column of a result set together with its planned decoder
+#[derive(Clone, Debug)]
+pub struct PlannedColumn {
+    pub name: String,
+    pub type_name: String,
+    pub kind: ColumnKind,
+}
+
+// Decoder plan for a result set, built once from the column metadata and then
+// applied to every row, so no per-cell type probing is needed
+#[derive(Clone, Debug)]
+pub struct ResultPlan {
+    pub columns: Vec<PlannedColumn>,
+}
+
+impl ResultPlan {
+    pub fn new(columns: &[PgColumn]) -> Self {
+        let columns = columns
+            .iter()
+            .map(|column| {
+                let type_name = column.type_info().name().to_string();
+                PlannedColumn {
+                    name: column.name().to_string(),
+                    kind: ColumnKind::from_type_name(&type_name),
+                    type_name,
+                }
+            })
+            .collect();
+
+        ResultPlan { columns }
+    }
+
+    // Names and Postgres types of the columns, for columnar headers
+    pub fn column_info(&self) -> Vec<ColumnInfo> {
+        self.columns
+            .iter()
+            .map(|column| ColumnInfo {
+                name: column.name.clone(),
+                type_name: column.type_name.clone(),
+            })
+            .collect()
+    }
+
+    // A row as a JSON object keyed by column name, in column order
+    pub fn object<'a>(&'a self, row: &'a PgRow) -> RowObject<'a> {
+        RowObject { plan: self, row }
+    }
+
+    // A row as a positional JSON array, in column order
+    pub fn array<'a>(&'a self, row: &'a PgRow) -> RowArray<'a> {
+        RowArray { plan: self, row }
+    }
+
+    // A single cell, decoded with the decoder planned for its column
+    pub fn cell<'a>(&'a self, row: &'a PgRow, index: usize) -> Cell<'a> {
+        Cell {
+            row,
+            index,
+            column: &self.columns[index],
+        }
+    }
+
+    // Decode a single cell into a Value, for callers that need to inspect it
+    pub fn decode_value(&self, row: &PgRow, index: usize) -> Value {
+        serde_json::to_value(self.cell(row, index)).unwrap_or(Value::Null)
+    }
+}
+
+// The views below serialize straight from the row's buffers, so a result can
+// be written to its output without building a Value per row first
+
+pub struct RowObject<'a> {
+    plan: &'a ResultPlan,
+    row: &'a PgRow,
+}
+
+impl Serialize for RowObject<'_> {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        let mut map = serializer.serialize_map(Some(self.plan.columns.len()))?;
+        for (i, column) in self.plan.columns.iter().enumerate() {
+            map.serialize_entry(&column.name, &self.plan.cell(self.row, i))?;
+        }
+        map.end()
+    }
+}
+
+pub struct RowArray<'a> {
+    plan: &'a ResultPlan,
+    row: &'a PgRow,
+}
+
+impl Serialize for RowArray<'_> {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        let mut seq = serializer.serialize_seq(Some(self.plan.columns.len()))?;
+        for i in 0..self.plan.columns.len() {
+            seq.serialize_element(&self.plan.cell(self.row, i))?;
+        }
+        seq.end()
+    }
+}
+
+pub struct Cell<'a> {
+    row: &'a PgRow,
+    index: usize,
+    column: &'a PlannedColumn,
+}
+
+// The plan has already matched the column type, so the compatibility check in
+// `try_get` is skipped and the value is decoded directly
+impl<'a> Serialize for Cell<'a> {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        match self.column.kind {
+            ColumnKind::Int2 => self.emit(serializer, |v: i16| v),
+            ColumnKind::Int4 => self.emit(serializer, |v: i32| v),
+            ColumnKind::Int8 => self.emit(serializer, |v: i64| v),
+            ColumnKind::Float4 => self.emit(serializer, |v: f32| v),
+            ColumnKind::Float8 => self.emit(serializer, |v: f64| v),
+            ColumnKind::Numeric => self.emit(serializer, |v: BigDecimal| numeric_to_json(&v)),
+            ColumnKind::Text => self.emit(serializer, |v: &'a str| v),
+            ColumnKind::Bool => self.emit(serializer, |v: bool| v),
+            ColumnKind::Date => self.emit(serializer, |v: NaiveDate| v.to_string()),
+            ColumnKind::Time => self.emit(serializer, |v: NaiveTime| v.to_string()),
+            ColumnKind::Timestamp => self.emit(serializer, |v: NaiveDateTime| {
+                v.format("%Y-%m-%dT%H:%M:%S%.f").to_string()
+            }),
+            ColumnKind::Timestamptz => self.emit(serializer, |v: DateTime<Utc>| v.to_rfc3339()),
+            ColumnKind::Uuid => self.emit(serializer, |v: Uuid| v.to_string()),
+            ColumnKind::Json => self.emit(serializer, |v: Value| v),
+            ColumnKind::Int2Array => self.emit(serializer, |v: Vec<i16>| v),
+            ColumnKind::Int4Array => self.emit(serializer, |v: Vec<i32>| v),
+            ColumnKind::Int8Array => self.emit(serializer, |v: Vec<i64>| v),
+            ColumnKind::Float4Array => self.emit(serializer, |v: Vec<f32>| v),
+            ColumnKind::Float8Array => self.emit(serializer, |v: Vec<f64>| v),
+            ColumnKind::TextArray => self.emit(serializer, |v: Vec<String>| v),
+            ColumnKind::BoolArray => self.emit(serializer, |v: Vec<bool>| v),
+            // Most other types can be represented as strings
+            ColumnKind::Other => match self.row.try_get::<Option<&str>, _>(self.index) {
+                Ok(value) => value.serialize(serializer),
+                Err(_) => self.fallback(serializer),
+            },
+        }
+    }
+}
+
+impl<'a> Cell<'a> {
+    // Decode the cell as a `T` and serialize it converted by `convert`, or
+    // serialize the fallback if it cannot be decoded
+    fn emit<T, U, S>(&self, serializer: S, convert: impl FnOnce(T) -> U) -> Result<S::Ok, S::Error>
+    where
+        T: Decode<'a, Postgres>,
+        U: Serialize,
+        S: Serializer,
+    {
+        match self.row.try_get_unchecked::<Option<T>, _>(self.index) {
+            Ok(value) => value.map(convert).serialize(serializer),
+            Err(_) => self.fallback(serializer),
+        }
+    }
+
+    // If all else fails, return the type name as a fallback
+    fn fallback<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        serializer.collect_str(&format_args!("Value of type: {}", self.column.type_name))
+    }
+}
+
+// NUMERIC values are returned as JSON numbers, falling back to their exact
+// string form when they are outside the range of an f64
+fn numeric_to_json(value: &BigDecimal) -> Value {
+    value
+        .to_f64()
+        .filter(|v| v.is_finite())
+        .and_then(Number::from_f64)
+        .map(Value::Number)
+        .unwrap_or_else(|| Value::String(value.to_string()))
+}
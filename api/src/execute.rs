@@ -0,0 +1,99 @@
+use std::time::Duration;
+
+use futures::stream::BoxStream;
+use sqlx::postgres::{PgColumn, PgConnectOptions, PgConnection, PgRow};
+use sqlx::{Connection, Executor, PgPool, Postgres, Transaction};
+
+// A query running in its own transaction with a statement timeout
+//
+// If the execution is dropped while a statement is still running, e.g.
+// because the client disconnected and axum dropped the handler, the
+// statement is cancelled on the server with `pg_cancel_backend`. The cancel
+// is sent over a connection of its own rather than one from the pool, which
+// may have none to spare: the heavy pool usually has just the one running the
+// query. The connection is only handed back to the pool after the cancel has
+// been sent, so it can never hit a statement run by the next user of the
+// connection.
+pub struct Execution {
+    tx: Option<Transaction<'static, Postgres>>,
+    pool: PgPool,
+    pid: i32,
+    running: bool,
+}
+
+impl Execution {
+    pub async fn begin(pool: &PgPool, timeout: Duration) -> Result<Self, sqlx::Error> {
+        let mut tx = crate::pool::begin(pool).await?;
+        // The timeout is local to the transaction, so the connection goes back
+        // to the pool with its default timeout
+        let (pid, _): (i32, String) = sqlx::query_as(
+            "SELECT pg_backend_pid(), set_config('statement_timeout', $1, true)",
+        )
+        .bind(timeout.as_millis().to_string())
+        .fetch_one(&mut *tx)
+        .await?;
+
+        Ok(Execution {
+            tx: Some(tx),
+            pool: pool.clone(),
+            pid,
+            running: false,
+        })
+    }
+
+    fn connection(&mut self) -> &mut PgConnection {
+        self.tx
+            .as_mut()
+            .expect("the transaction is only taken when the execution ends")
+    }
+
+    // Stream the rows of `query`. The statement counts as running until
+    // `commit` is called, so stopping early cancels it.
+    pub fn fetch<'e>(&'e mut self, query: &'e str) -> BoxStream<'e, Result<PgRow, sqlx::Error>> {
+        self.running = true;
+        sqlx::query(query).fetch(self.connection())
+    }
+
+    // The result columns of `query`, described on the execution's connection
+    pub async fn columns(&mut self, query: &str) -> Result<Vec<PgColumn>, sqlx::Error> {
+        let describe = self.connection().describe(query).await?;
+        Ok(describe.columns().to_vec())
+    }
+
+    pub async fn commit(mut self) -> Result<(), sqlx::Error> {
+        self.running = false;
+        match self.tx.take() {
+            Some(tx) => tx.commit().await,
+            None => Ok(()),
+        }
+    }
+}
+
+impl Drop for Execution {
+    fn drop(&mut self) {
+        let tx = match self.tx.take() {
+            Some(tx) if self.running => tx,
+            // Dropping an idle transaction just rolls it back
+            _ => return,
+        };
+
+        let options = self.pool.connect_options().clone();
+        let pid = self.pid;
+        tokio::spawn(async move {
+            tracing::info!("Cancelling abandoned query on backend {}", pid);
+            if let Err(e) = cancel_backend(&options, pid).await {
+                tracing::warn!("Failed to cancel query on backend {}: {}", pid, e);
+            }
+            let _ = tx.rollback().await;
+        });
+    }
+}
+
+async fn cancel_backend(options: &PgConnectOptions, pid: i32) -> Result<(), sqlx::Error> {
+    let mut conn = PgConnection::connect_with(options).await?;
+    sqlx::query("SELECT pg_cancel_backend($1)")
+        .bind(pid)
+        .execute(&mut conn)
+        .await?;
+    conn.close().await
+}
@@ -0,0 +1,35 @@
+// The API server's modules. They are a library so that benches can run the
+// encoders the server uses; main.rs only wires them together.
+pub mod advisor;
+pub mod approximate;
+pub mod budget;
+pub mod cache;
+pub mod compression;
+pub mod cursor;
+pub mod dataframe;
+pub mod datasets;
+pub mod decode;
+pub mod execute;
+pub mod limits;
+pub mod metrics;
+pub mod models;
+pub mod pool;
+pub mod replicas;
+pub mod routes;
+pub mod sql;
+pub mod state;
+pub mod stream;
+pub mod views;
+pub mod workload;
+
+use std::env;
+use std::str::FromStr;
+
+// Read a setting from the environment, falling back to `default` when it is
+// unset or cannot be parsed
+pub fn env_var<T: FromStr>(name: &str, default: T) -> T {
+    env::var(name)
+        .ok()
+        .and_then(|v| v.parse().ok())
+        .unwrap_or(default)
+}
@@ -0,0 +1,59 @@
+use std::time::Duration;
+
+use crate::budget::Budget;
+
+// Per-request limits on /api/query
+#[derive(Clone, Copy, Debug)]
+pub struct QueryLimits {
+    // Statement timeout for requests that don't ask for one, and the default
+    // for every pooled connection
+    pub default_timeout: Duration,
+    // Largest statement timeout a request may ask for
+    pub max_timeout: Duration,
+    // Largest number of rows and serialized bytes in one JSON response
+    pub max_rows: usize,
+    pub max_bytes: usize,
+    // Largest number of statements in one /api/query/batch request, and how
+    // many of them may run at the same time
+    pub max_batch_queries: usize,
+    pub max_batch_parallelism: usize,
+}
+
+impl QueryLimits {
+    pub fn from_env() -> Self {
+        QueryLimits {
+            default_timeout: Duration::from_millis(crate::env_var("QUERY_TIMEOUT_MS", 30_000)),
+            max_timeout: Duration::from_millis(crate::env_var("QUERY_TIMEOUT_MAX_MS", 300_000)),
+            max_rows: crate::env_var("QUERY_MAX_ROWS", 100_000),
+            max_bytes: crate::env_var("QUERY_MAX_BYTES", 64 * 1024 * 1024),
+            max_batch_queries: crate::env_var("BATCH_MAX_QUERIES", 50),
+            max_batch_parallelism: crate::env_var("BATCH_MAX_PARALLELISM", 4),
+        }
+    }
+
+    // The statement timeout for a request that asked for `requested_ms`
+    //
+    // Postgres treats a timeout of zero as no timeout at all, so the result
+    // is never less than a millisecond.
+    pub fn timeout(&self, requested_ms: Option<u64>) -> Duration {
+        requested_ms
+            .map(Duration::from_millis)
+            .unwrap_or(self.default_timeout)
+            .min(self.max_timeout)
+            .max(Duration::from_millis(1))
+    }
+
+    // The budget for a request, which may ask for less than the global caps
+    pub fn budget(&self, max_rows: Option<usize>, max_bytes: Option<usize>) -> Budget {
+        Budget {
+            max_rows: max_rows.map_or(self.max_rows, |rows| rows.min(self.max_rows)),
+            max_bytes: max_bytes.map_or(self.max_bytes, |bytes| bytes.min(self.max_bytes)),
+        }
+    }
+
+    // Statements of a batch to run at once, when a request asked for `requested`
+    pub fn batch_parallelism(&self, requested: Option<usize>) -> usize {
+        let max = self.max_batch_parallelism.max(1);
+        requested.map_or(max, |parallelism| parallelism.clamp(1, max))
+    }
+}
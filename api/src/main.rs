@@ -1,17 +1,29 @@
-mod models;
-mod routes;
-
 use axum::{
+    middleware,
     routing::{get, post},
     Router,
 };
 use dotenv::dotenv;
-use sqlx::postgres::PgPoolOptions;
 use std::env;
 use std::net::SocketAddr;
+use std::sync::Arc;
+use std::time::Duration;
 use tower_http::cors::{Any, CorsLayer};
 use tracing_subscriber::{layer::SubscriberExt, util::SubscriberInitExt};
 
+use lucidata_api::advisor::{AdvisorConfig, IndexAdvisor};
+use lucidata_api::approximate::SamplingConfig;
+use lucidata_api::cache::ResultCache;
+use lucidata_api::cursor::CursorRegistry;
+use lucidata_api::datasets::DatasetConfig;
+use lucidata_api::limits::QueryLimits;
+use lucidata_api::pool::{PoolConfig, PoolMonitor};
+use lucidata_api::replicas::{Replica, ReplicaSet};
+use lucidata_api::state::AppState;
+use lucidata_api::views::{ViewConfig, ViewManager};
+use lucidata_api::workload::{CostGuard, WorkloadConfig};
+use lucidata_api::{compression, env_var, pool, routes};
+
 #[tokio::main]
 async fn main() {
     // Load environment variables, don't require .env file in Docker
@@ -31,29 +43,159 @@ async fn main() {
     
     tracing::info!("Connecting to database...");
     
-    let pool = PgPoolOptions::new()
-        .max_connections(5)
-        .connect(&database_url)
+    let limits = QueryLimits::from_env();
+    let pool_config = PoolConfig::from_env();
+    let pool = pool_config
+        .connect(&database_url, limits.default_timeout)
         .await
         .expect("Failed to create pool");
+    pool::warm(&pool, pool_config.min_connections)
+        .await
+        .expect("Failed to open database connections");
         
     tracing::info!("Successfully connected to database");
     
+    // Read replicas, as a comma-separated list of connection URLs. Each gets
+    // its own pool with the same settings as the primary.
+    let replica_urls = env::var("DATABASE_REPLICA_URLS").unwrap_or_default();
+    let replica_max_heavy = env_var("REPLICA_HEAVY_MAX_QUERIES", 1);
+    let replicas = replica_urls
+        .split(',')
+        .map(str::trim)
+        .filter(|url| !url.is_empty())
+        .map(|url| {
+            let replica_pool = pool_config
+                .connect_lazy(url, limits.default_timeout)
+                .expect("Invalid replica database URL");
+            Replica::new(url, replica_pool, replica_max_heavy)
+        })
+        .collect::<Vec<_>>();
+    tracing::info!("Using {} read replicas", replicas.len());
+    let replicas = Arc::new(ReplicaSet::new(
+        pool.clone(),
+        replicas,
+        Duration::from_millis(env_var("REPLICA_MAX_LAG_MS", 5000)),
+    ));
+    replicas.spawn_lag_monitor(Duration::from_millis(env_var("REPLICA_LAG_POLL_MS", 1000)));
+    
+    // Queries the planner estimates to be expensive run on a replica, or,
+    // when none is usable, on a separate, small pool, so they cannot take the
+    // connections interactive queries need
+    let heavy_pool = PoolConfig {
+        max_connections: env_var("DB_HEAVY_MAX_CONNECTIONS", 1),
+        min_connections: 0,
+        ..pool_config.clone()
+    }
+    .connect_lazy(&database_url, limits.default_timeout)
+    .expect("Invalid database URL");
+    let cost_guard = Arc::new(CostGuard::new(WorkloadConfig::from_env(), heavy_pool));
+    
+    // Uploads load their chunks on a pool of their own, with a connection
+    // per chunk loaded at once, so a load running for minutes cannot take the
+    // connections queries need
+    let datasets = DatasetConfig::from_env();
+    let dataset_pool = PoolConfig {
+        max_connections: datasets.parallelism as u32,
+        min_connections: 0,
+        ..pool_config.clone()
+    }
+    .connect_lazy(&database_url, limits.default_timeout)
+    .expect("Invalid database URL");
+    
+    let pool_monitor = Arc::new(PoolMonitor::new(pool_config));
+    
+    // Server-side cursors each hold a connection while open, so only part of
+    // the pool may be used for them
+    let max_cursors = env_var("CURSOR_MAX_OPEN", 2);
+    let cursor_idle_timeout = env_var("CURSOR_IDLE_TIMEOUT_SECS", 60);
+    let cursors = Arc::new(CursorRegistry::new(
+        max_cursors,
+        Duration::from_secs(cursor_idle_timeout),
+    ));
+    cursors.spawn_reaper();
+    
+    // Result cache for repeated read-only queries, bounded in bytes.
+    // Setting RESULT_CACHE_MAX_BYTES=0 disables it.
+    let cache_max_bytes = env_var("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024);
+    let cache_ttl = env_var("RESULT_CACHE_TTL_SECS", 300);
+    let stale_while_revalidate = env_var("RESULT_CACHE_STALE_WHILE_REVALIDATE", false);
+    let result_cache = (cache_max_bytes > 0).then(|| {
+        let cache = Arc::new(ResultCache::new(
+            cache_max_bytes,
+            Duration::from_secs(cache_ttl),
+            stale_while_revalidate,
+        ));
+        cache.spawn_invalidation_listener(database_url.clone());
+        cache
+    });
+    
+    // Materialized views for frequent aggregate queries. Setting
+    // MATVIEW_MAX_VIEWS=0 disables them.
+    let views = Arc::new(ViewManager::new(ViewConfig::from_env(), pool.clone()));
+    if let Err(e) = views.drop_orphans().await {
+        tracing::warn!("Failed to drop materialized views from a previous run: {}", e);
+    }
+    views.spawn_refresher(database_url.clone());
+    
+    // Index recommendations from the queries the service runs. Indexes are
+    // only created automatically with INDEX_ADVISOR_AUTO_CREATE=true.
+    let advisor = Arc::new(IndexAdvisor::new(AdvisorConfig::from_env(), pool.clone()));
+    advisor.spawn_auto_create();
+    
+    let state = AppState {
+        pool,
+        cursors,
+        result_cache,
+        pool_monitor,
+        limits,
+        replicas,
+        cost_guard,
+        sampling: SamplingConfig::from_env(),
+        views,
+        advisor,
+        datasets,
+        dataset_pool,
+    };
+    
     // CORS configuration
     let cors = CorsLayer::new()
         .allow_origin(Any)
         .allow_methods(Any)
         .allow_headers(Any);
     
+    // Routes that use the database go through admission control
+    let database_routes = Router::new()
+        .route("/api/cars", get(routes::get_cars))
+        .route("/api/cars/:id", get(routes::get_car_by_id))
+        .route("/api/query", post(routes::query))
+        .route("/api/export", post(routes::export))
+        .route_layer(middleware::from_fn_with_state(
+            state.clone(),
+            pool::admission,
+        ));
+    // Batches are admitted for every statement they may run at once
+    let batch_routes = Router::new()
+        .route("/api/query/batch", post(routes::query_batch))
+        .route_layer(middleware::from_fn_with_state(
+            state.clone(),
+            pool::batch_admission,
+        ));
+    
     // Router setup
     let app = Router::new()
         .route("/", get(routes::health_check))
         .route("/api/health", get(routes::health_check))
-        .route("/api/cars", get(routes::get_cars))
-        .route("/api/cars/:id", get(routes::get_car_by_id))
-        .route("/api/query", post(routes::query))
+        .route("/metrics", get(routes::metrics))
+        .route("/api/admin/views", get(routes::list_views))
+        .route("/api/admin/indexes", get(routes::index_recommendations))
+        // Loads run for minutes on their own pool, so they do not wait in
+        // admission control
+        .route("/api/datasets/:name", post(routes::upload_dataset))
+        .merge(database_routes)
+        .merge(batch_routes)
         .layer(cors)
-        .with_state(pool);
+        .layer(compression::layer())
+        .with_state(state);
     
     // Start the server
     let addr = SocketAddr::from(([0, 0, 0, 0], 8000));
@@ -63,3 +205,4 @@ async fn main() {
         .await
         .unwrap();
 }
+
@@ -1,6 +1,10 @@
 use serde::{Deserialize, Serialize};
 use sqlx::FromRow;
 
+use crate::approximate::Approximation;
+use crate::datasets::{DatasetFormat, LoadMode};
+use crate::budget::ResultStats;
+
 #[derive(Serialize, Deserialize, FromRow, Debug)]
 pub struct Car {
     pub id: i32,
@@ -18,13 +22,235 @@ pub struct Car {
     pub carb: Option<i32>,
 }
 
+// Columns of the cars table that can be selected with ?fields=
+pub const CAR_FIELDS: &[&str] = &[
+    "id", "model", "mpg", "cyl", "disp", "hp", "drat", "wt", "qsec", "vs", "am", "gear", "carb",
+];
+
+// A car with only the requested fields
+//
+// `id` is always present so it can be used as the `after_id` of the next
+// page. Fields that were not selected, or are NULL, are left out.
+#[derive(Serialize, FromRow, Debug)]
+pub struct PartialCar {
+    pub id: i32,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub model: Option<String>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub mpg: Option<f64>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub cyl: Option<i32>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub disp: Option<f64>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub hp: Option<i32>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub drat: Option<f64>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub wt: Option<f64>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub qsec: Option<f64>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub vs: Option<i32>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub am: Option<i32>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub gear: Option<i32>,
+    #[sqlx(default)]
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub carb: Option<i32>,
+}
+
+// Query string options for /api/cars
+#[derive(Deserialize, Default)]
+pub struct CarsParams {
+    // Only return cars with a larger id, for keyset pagination
+    pub after_id: Option<i32>,
+    pub limit: Option<i64>,
+    // Comma-separated list of fields to return
+    pub fields: Option<String>,
+    pub model: Option<String>,
+    pub cyl: Option<i32>,
+    pub min_mpg: Option<f64>,
+    pub max_mpg: Option<f64>,
+}
+
+impl CarsParams {
+    // The columns to select, always starting with `id`
+    pub fn columns(&self) -> Result<Vec<&'static str>, String> {
+        let fields = match &self.fields {
+            Some(fields) => fields,
+            None => return Ok(CAR_FIELDS.to_vec()),
+        };
+
+        let mut columns = vec!["id"];
+        for field in fields.split(',').map(str::trim).filter(|f| !f.is_empty()) {
+            let column = CAR_FIELDS
+                .iter()
+                .find(|&&c| c == field)
+                .copied()
+                .ok_or_else(|| format!("Unknown field: {}", field))?;
+            if !columns.contains(&column) {
+                columns.push(column);
+            }
+        }
+        Ok(columns)
+    }
+}
+
 #[derive(Deserialize)]
 pub struct QueryRequest {
+    #[serde(default)]
     pub query: String,
+    // Continuation token from a previous page; replaces `query` when set
+    #[serde(default)]
+    pub cursor: Option<String>,
+}
+
+// Query string options for /api/query
+#[derive(Deserialize, Default)]
+pub struct QueryParams {
+    // Stream rows as NDJSON instead of returning a single JSON document
+    #[serde(default)]
+    pub stream: bool,
+    #[serde(default)]
+    pub format: ResultFormat,
+    // Return the result in pages of this many rows, read from a server-side cursor
+    #[serde(default)]
+    pub page_size: Option<u32>,
+    // Statement timeout for this request, capped by QUERY_TIMEOUT_MAX_MS
+    #[serde(default)]
+    pub timeout_ms: Option<u64>,
+    // Row and byte budgets for this request, capped by QUERY_MAX_ROWS and
+    // QUERY_MAX_BYTES
+    #[serde(default)]
+    pub max_rows: Option<usize>,
+    #[serde(default)]
+    pub max_bytes: Option<usize>,
+    // Answer aggregate queries from a sample of their table when possible
+    #[serde(default)]
+    pub approximate: bool,
+}
+
+// Query string options for /api/export
+#[derive(Deserialize, Default)]
+pub struct ExportParams {
+    // Statement timeout for the whole export, capped by QUERY_TIMEOUT_MAX_MS
+    #[serde(default)]
+    pub timeout_ms: Option<u64>,
+}
+
+// Query string options for /api/datasets/:name
+#[derive(Deserialize, Default)]
+pub struct DatasetParams {
+    // Taken from the Content-Type when not given
+    #[serde(default)]
+    pub format: Option<DatasetFormat>,
+    #[serde(default)]
+    pub mode: LoadMode,
+}
+
+// Body of /api/query/batch: independent statements, run concurrently
+#[derive(Deserialize)]
+pub struct BatchRequest {
+    pub queries: Vec<String>,
+}
+
+// Query string options for /api/query/batch, applied to every statement
+#[derive(Deserialize, Default)]
+pub struct BatchParams {
+    // Write each result as one NDJSON line as soon as it completes, instead of
+    // returning all of them in order once the last one has finished
+    #[serde(default)]
+    pub stream: bool,
+    #[serde(default)]
+    pub format: ResultFormat,
+    // Statements run at the same time, capped by BATCH_MAX_PARALLELISM
+    #[serde(default)]
+    pub parallelism: Option<usize>,
+    #[serde(default)]
+    pub timeout_ms: Option<u64>,
+    #[serde(default)]
+    pub max_rows: Option<usize>,
+    #[serde(default)]
+    pub max_bytes: Option<usize>,
+}
+
+// Shape of the rows in a query result
+#[derive(Deserialize, Clone, Copy, Debug, Default, PartialEq, Eq, Hash)]
+#[serde(rename_all = "lowercase")]
+pub enum ResultFormat {
+    // One JSON object per row, keyed by column name
+    #[default]
+    Rows,
+    // A single column header followed by one array of values per column
+    Columnar,
+    // Apache Arrow IPC stream
+    Arrow,
+    // Apache Parquet file
+    Parquet,
+}
+
+#[derive(Serialize, Clone, Debug)]
+pub struct ColumnInfo {
+    pub name: String,
+    #[serde(rename = "type")]
+    pub type_name: String,
+}
+
+#[derive(Serialize)]
+#[serde(untagged)]
+pub enum QueryResult {
+    Rows(Vec<serde_json::Value>),
+    // A result serialized as its rows were read, in the rows or the columnar
+    // format: `{"columns": [...], "data": [[...], ...]}` with data[i] holding
+    // every value of columns[i], in row order
+    Raw(Box<serde_json::value::RawValue>),
 }
 
 #[derive(Serialize)]
 pub struct QueryResponse {
-    pub result: serde_json::Value,
+    pub result: QueryResult,
     pub executed_query: String,
+    // Pass back as `cursor` to fetch the next page of a paginated result
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub next_cursor: Option<String>,
+    // Present when the result was estimated from a sample
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub approximation: Option<Approximation>,
+    #[serde(flatten)]
+    pub stats: ResultStats,
+}
+
+// The result of one statement of a batch, tagged with its position in the request
+#[derive(Serialize)]
+pub struct BatchItem {
+    pub index: usize,
+    #[serde(flatten)]
+    pub outcome: BatchOutcome,
+}
+
+#[derive(Serialize)]
+#[serde(untagged)]
+pub enum BatchOutcome {
+    Ok(QueryResponse),
+    // The status the statement would have failed with on /api/query
+    Err { status: u16, error: String },
+}
+
+#[derive(Serialize)]
+pub struct BatchResponse {
+    // In request order
+    pub results: Vec<BatchItem>,
 }
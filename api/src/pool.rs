@@ -0,0 +1,290 @@
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, OnceLock};
+use std::time::{Duration, Instant};
+
+use axum::{
+    extract::{Query, State},
+    http::{header, Request, StatusCode},
+    middleware::Next,
+    response::{IntoResponse, Response},
+};
+use sqlx::postgres::PgPoolOptions;
+use sqlx::{Executor, PgPool, Postgres, Transaction};
+use tokio::sync::{OwnedSemaphorePermit, Semaphore};
+
+use crate::metrics::{self, Histogram};
+use crate::models::BatchParams;
+use crate::state::AppState;
+
+// Time taken to get a connection from any pool and begin a transaction on it.
+// It is kept for the whole process so that code holding just a pool can
+// record into it.
+static ACQUIRE_LATENCY: OnceLock<Histogram> = OnceLock::new();
+
+fn acquire_latency() -> &'static Histogram {
+    ACQUIRE_LATENCY.get_or_init(|| Histogram::new(metrics::LATENCY_BUCKETS))
+}
+
+// Begin a transaction on a connection from `pool`, recording how long it took
+// to get the connection
+pub async fn begin(pool: &PgPool) -> Result<Transaction<'static, Postgres>, sqlx::Error> {
+    let start = Instant::now();
+    let tx = pool.begin().await;
+    acquire_latency().observe(start.elapsed());
+    tx
+}
+
+// Connection pool settings, read from the environment
+#[derive(Clone, Debug)]
+pub struct PoolConfig {
+    pub max_connections: u32,
+    pub min_connections: u32,
+    pub acquire_timeout: Duration,
+    pub idle_timeout: Duration,
+    pub max_lifetime: Duration,
+    // Requests that wait longer than this for a connection are turned away
+    pub admission_wait: Duration,
+    pub retry_after_secs: u64,
+}
+
+impl PoolConfig {
+    pub fn from_env() -> Self {
+        PoolConfig {
+            max_connections: crate::env_var("DB_MAX_CONNECTIONS", 5),
+            min_connections: crate::env_var("DB_MIN_CONNECTIONS", 1),
+            acquire_timeout: Duration::from_secs(crate::env_var("DB_ACQUIRE_TIMEOUT_SECS", 30)),
+            idle_timeout: Duration::from_secs(crate::env_var("DB_IDLE_TIMEOUT_SECS", 600)),
+            max_lifetime: Duration::from_secs(crate::env_var("DB_MAX_LIFETIME_SECS", 1800)),
+            admission_wait: Duration::from_millis(crate::env_var("DB_ADMISSION_WAIT_MS", 2000)),
+            retry_after_secs: crate::env_var("DB_RETRY_AFTER_SECS", 1),
+        }
+    }
+
+    // Connect with `statement_timeout` as the default for every connection
+    pub async fn connect(
+        &self,
+        database_url: &str,
+        statement_timeout: Duration,
+    ) -> Result<PgPool, sqlx::Error> {
+        self.options(statement_timeout).connect(database_url).await
+    }
+
+    // Like `connect`, but only opens connections once they are needed, so an
+    // unreachable database does not hold up startup
+    pub fn connect_lazy(
+        &self,
+        database_url: &str,
+        statement_timeout: Duration,
+    ) -> Result<PgPool, sqlx::Error> {
+        self.options(statement_timeout).connect_lazy(database_url)
+    }
+
+    fn options(&self, statement_timeout: Duration) -> PgPoolOptions {
+        let set_timeout = format!("SET statement_timeout = {}", statement_timeout.as_millis());
+        PgPoolOptions::new()
+            .max_connections(self.max_connections)
+            .min_connections(self.min_connections)
+            .acquire_timeout(self.acquire_timeout)
+            .idle_timeout(self.idle_timeout)
+            .max_lifetime(self.max_lifetime)
+            .after_connect(move |connection, _| {
+                let set_timeout = set_timeout.clone();
+                Box::pin(async move {
+                    connection.execute(set_timeout.as_str()).await?;
+                    Ok(())
+                })
+            })
+    }
+}
+
+// Open the minimum number of connections up front, so the first requests do
+// not pay for connection setup
+pub async fn warm(pool: &PgPool, connections: u32) -> Result<(), sqlx::Error> {
+    let acquires = (0..connections).map(|_| pool.acquire());
+    let connections = futures::future::try_join_all(acquires).await?;
+    tracing::info!("Warmed {} database connections", connections.len());
+    Ok(())
+}
+
+// Lets as many requests use the database at once as the pool has
+// connections, tracks how long requests wait for their turn, and rejects them
+// once the wait exceeds the admission threshold
+pub struct PoolMonitor {
+    config: PoolConfig,
+    // One permit per pooled connection, held by each admitted request for
+    // every connection it may use at once, and by each open cursor
+    permits: Arc<Semaphore>,
+    waiters: AtomicUsize,
+    admission_wait: Histogram,
+    rejected: AtomicU64,
+}
+
+// Counts a request as waiting for as long as it is alive, including when the
+// client goes away while it waits
+struct Waiting<'a>(&'a AtomicUsize);
+
+impl<'a> Waiting<'a> {
+    fn new(waiters: &'a AtomicUsize) -> Self {
+        waiters.fetch_add(1, Ordering::Relaxed);
+        Waiting(waiters)
+    }
+}
+
+impl Drop for Waiting<'_> {
+    fn drop(&mut self) {
+        self.0.fetch_sub(1, Ordering::Relaxed);
+    }
+}
+
+impl PoolMonitor {
+    pub fn new(config: PoolConfig) -> Self {
+        PoolMonitor {
+            permits: Arc::new(Semaphore::new(config.max_connections as usize)),
+            config,
+            waiters: AtomicUsize::new(0),
+            admission_wait: Histogram::new(metrics::LATENCY_BUCKETS),
+            rejected: AtomicU64::new(0),
+        }
+    }
+
+    // Wait for `permits` permits to use the database, up to the admission
+    // threshold, or return None once it has passed
+    //
+    // No more permits are asked for than the pool has connections, so a
+    // request can always be admitted eventually.
+    async fn acquire(&self, permits: u32) -> Option<OwnedSemaphorePermit> {
+        let permits = permits.clamp(1, self.config.max_connections.max(1));
+        let waiting = Waiting::new(&self.waiters);
+        let start = Instant::now();
+        let acquired = tokio::time::timeout(
+            self.config.admission_wait,
+            Arc::clone(&self.permits).acquire_many_owned(permits),
+        )
+        .await;
+        self.admission_wait.observe(start.elapsed());
+        drop(waiting);
+
+        match acquired {
+            Ok(permit) => Some(permit.expect("the admission semaphore is never closed")),
+            Err(_) => {
+                self.rejected.fetch_add(1, Ordering::Relaxed);
+                None
+            }
+        }
+    }
+
+    // Wait for a permit for each connection a request may use at once
+    //
+    // Taking a permit is an in-memory operation, so requests that never reach
+    // the database, such as result cache hits, only wait when the service is
+    // saturated. The permits are held until the handler returns.
+    async fn admit(&self, permits: u32) -> Result<OwnedSemaphorePermit, Response> {
+        self.acquire(permits).await.ok_or_else(|| {
+            (
+                StatusCode::SERVICE_UNAVAILABLE,
+                [(
+                    header::RETRY_AFTER,
+                    self.config.retry_after_secs.to_string(),
+                )],
+                "Database is busy, try again later".to_string(),
+            )
+                .into_response()
+        })
+    }
+
+    // Wait for a permit for a connection that stays in use after the request
+    // that took it has returned, such as the one an open cursor holds
+    pub async fn reserve(&self) -> Result<OwnedSemaphorePermit, (StatusCode, String)> {
+        self.acquire(1).await.ok_or_else(|| {
+            (
+                StatusCode::SERVICE_UNAVAILABLE,
+                "Database is busy, try again later".to_string(),
+            )
+        })
+    }
+
+    // Append the pool metrics to a Prometheus text exposition
+    pub fn write_metrics(&self, pool: &PgPool, out: &mut String) {
+        let gauges = [
+            (
+                "lucidata_db_pool_max_connections",
+                "Maximum number of pooled connections",
+                self.config.max_connections as f64,
+            ),
+            (
+                "lucidata_db_pool_size",
+                "Open pooled connections",
+                pool.size() as f64,
+            ),
+            (
+                "lucidata_db_pool_idle",
+                "Idle pooled connections",
+                pool.num_idle() as f64,
+            ),
+            (
+                "lucidata_db_pool_waiters",
+                "Requests waiting for admission",
+                self.waiters.load(Ordering::Relaxed) as f64,
+            ),
+            (
+                "lucidata_db_pool_admitted",
+                "Connections held by running requests and open cursors",
+                (self.config.max_connections as usize - self.permits.available_permits()) as f64,
+            ),
+        ];
+        for (name, help, value) in gauges {
+            metrics::write_header(out, name, help, "gauge");
+            metrics::write_sample(out, name, "", value);
+        }
+
+        let name = "lucidata_db_pool_rejected_total";
+        metrics::write_header(
+            out,
+            name,
+            "Requests rejected because no connection became available in time",
+            "counter",
+        );
+        metrics::write_sample(out, name, "", self.rejected.load(Ordering::Relaxed) as f64);
+
+        let name = "lucidata_db_pool_admission_wait_seconds";
+        metrics::write_header(out, name, "Time spent waiting for admission", "histogram");
+        self.admission_wait.write_samples(out, name, "");
+
+        let name = "lucidata_db_pool_acquire_seconds";
+        metrics::write_header(
+            out,
+            name,
+            "Time taken to get a pooled connection and begin a transaction on it",
+            "histogram",
+        );
+        acquire_latency().write_samples(out, name, "");
+    }
+}
+
+// Middleware that turns requests away with 503 and Retry-After while the pool
+// is saturated, instead of letting them queue without bound
+pub async fn admission<B>(
+    State(state): State<AppState>,
+    request: Request<B>,
+    next: Next<B>,
+) -> Response {
+    match state.pool_monitor.admit(1).await {
+        Ok(_permit) => next.run(request).await,
+        Err(response) => response,
+    }
+}
+
+// Admission for batches, which may run as many statements at once as their
+// parallelism, each on a connection of its own
+pub async fn batch_admission<B>(
+    State(state): State<AppState>,
+    Query(params): Query<BatchParams>,
+    request: Request<B>,
+    next: Next<B>,
+) -> Response {
+    let parallelism = state.limits.batch_parallelism(params.parallelism);
+    match state.pool_monitor.admit(parallelism as u32).await {
+        Ok(_permits) => next.run(request).await,
+        Err(response) => response,
+    }
+}
@@ -0,0 +1,237 @@
+use std::cmp::Reverse;
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::sync::Arc;
+use std::time::{Duration, Instant};
+
+use sqlx::PgPool;
+use tokio::sync::{OwnedSemaphorePermit, Semaphore};
+
+use crate::metrics::{self, Histogram};
+use crate::sql;
+
+// Replication lag in seconds, or 0 when the replica has replayed everything it
+// received. pg_last_xact_replay_timestamp() alone would report a growing lag
+// while the primary is idle.
+const LAG_QUERY: &str = "SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END::float8";
+
+// A read replica and what is known about its health and load
+pub struct Replica {
+    // Host, port and database of the replica, used as the metrics label
+    name: String,
+    pool: PgPool,
+    lag_ms: AtomicU64,
+    healthy: AtomicBool,
+    in_flight: AtomicUsize,
+    // Slots for expensive queries, so they cannot take every connection of
+    // the replica from interactive queries
+    heavy: Arc<Semaphore>,
+    max_heavy: usize,
+    latency: Histogram,
+}
+
+impl Replica {
+    pub fn new(database_url: &str, pool: PgPool, max_heavy: usize) -> Self {
+        // Leave the credentials out of the label
+        let name = database_url
+            .rsplit('@')
+            .next()
+            .unwrap_or(database_url)
+            .split('?')
+            .next()
+            .unwrap_or_default()
+            .to_string();
+
+        Replica {
+            name,
+            pool,
+            lag_ms: AtomicU64::new(u64::MAX),
+            healthy: AtomicBool::new(false),
+            in_flight: AtomicUsize::new(0),
+            heavy: Arc::new(Semaphore::new(max_heavy)),
+            max_heavy,
+            latency: Histogram::new(metrics::LATENCY_BUCKETS),
+        }
+    }
+
+    fn is_usable(&self, max_lag: Duration) -> bool {
+        self.healthy.load(Ordering::Relaxed)
+            && self.lag_ms.load(Ordering::Relaxed) <= max_lag.as_millis() as u64
+    }
+
+    async fn poll_lag(&self) {
+        match sqlx::query_scalar::<_, f64>(LAG_QUERY).fetch_one(&self.pool).await {
+            Ok(lag) => {
+                self.lag_ms.store((lag * 1000.0) as u64, Ordering::Relaxed);
+                self.healthy.store(true, Ordering::Relaxed);
+            }
+            Err(e) => {
+                if self.healthy.swap(false, Ordering::Relaxed) {
+                    tracing::warn!("Replica {} is unavailable: {}", self.name, e);
+                }
+            }
+        }
+    }
+}
+
+// Marks a query as running on a replica, and records its duration when dropped
+pub struct ReplicaLease {
+    replica: Arc<Replica>,
+    start: Instant,
+    // The heavy slot of an expensive query, released with the lease
+    _heavy: Option<OwnedSemaphorePermit>,
+}
+
+impl Drop for ReplicaLease {
+    fn drop(&mut self) {
+        self.replica.in_flight.fetch_sub(1, Ordering::Relaxed);
+        self.replica.latency.observe(self.start.elapsed());
+    }
+}
+
+// The pool a query runs on. For replicas, the lease has to be kept alive for
+// as long as the query runs.
+pub struct ReadTarget {
+    pub pool: PgPool,
+    _lease: Option<ReplicaLease>,
+}
+
+impl ReadTarget {
+    pub fn from_pool(pool: PgPool) -> Self {
+        ReadTarget { pool, _lease: None }
+    }
+}
+
+// The primary database and its read replicas
+pub struct ReplicaSet {
+    primary: PgPool,
+    replicas: Vec<Arc<Replica>>,
+    // Replicas lagging further behind than this are not used
+    max_lag: Duration,
+}
+
+impl ReplicaSet {
+    pub fn new(primary: PgPool, replicas: Vec<Replica>, max_lag: Duration) -> Self {
+        ReplicaSet {
+            primary,
+            replicas: replicas.into_iter().map(Arc::new).collect(),
+            max_lag,
+        }
+    }
+
+    // Pick where to run `query`
+    //
+    // Read-only statements go to the replica with the fewest queries in
+    // flight among those within the lag bound, and everything else, or
+    // everything when no replica qualifies, goes to the primary.
+    pub fn route(&self, query: &str) -> ReadTarget {
+        let replica = match sql::read_only_statement(query) {
+            Ok(_) => self
+                .replicas
+                .iter()
+                .filter(|replica| replica.is_usable(self.max_lag))
+                .min_by_key(|replica| replica.in_flight.load(Ordering::Relaxed)),
+            Err(_) => None,
+        };
+
+        match replica {
+            Some(replica) => lease(replica, None),
+            None => self.primary(),
+        }
+    }
+
+    // Pick a replica to run an expensive read-only `query` on, and wait for
+    // one of its heavy slots
+    //
+    // The replica with the most free heavy slots among those within the lag
+    // bound is used, then the one with the fewest queries in flight. Returns
+    // None when no replica qualifies, or the statement is not read-only.
+    // Replicas without heavy slots never qualify.
+    pub async fn route_heavy(&self, query: &str) -> Option<ReadTarget> {
+        sql::read_only_statement(query).ok()?;
+        let replica = self
+            .replicas
+            .iter()
+            .filter(|replica| replica.max_heavy > 0 && replica.is_usable(self.max_lag))
+            .max_by_key(|replica| {
+                (
+                    replica.heavy.available_permits(),
+                    Reverse(replica.in_flight.load(Ordering::Relaxed)),
+                )
+            })?;
+
+        let permit = Arc::clone(&replica.heavy).acquire_owned().await.ok()?;
+        Some(lease(replica, Some(permit)))
+    }
+
+    pub fn primary(&self) -> ReadTarget {
+        ReadTarget::from_pool(self.primary.clone())
+    }
+
+    // Poll the replication lag of every replica in the background
+    pub fn spawn_lag_monitor(self: &Arc<Self>, period: Duration) {
+        if self.replicas.is_empty() {
+            return;
+        }
+
+        let replicas = self.replicas.clone();
+        tokio::spawn(async move {
+            let mut interval = tokio::time::interval(period);
+            loop {
+                interval.tick().await;
+                futures::future::join_all(replicas.iter().map(|replica| replica.poll_lag())).await;
+            }
+        });
+    }
+
+    // Append the replica metrics to a Prometheus text exposition
+    pub fn write_metrics(&self, out: &mut String) {
+        if self.replicas.is_empty() {
+            return;
+        }
+
+        let gauges: [(&str, &str, fn(&Replica) -> f64); 4] = [
+            ("lucidata_replica_up", "Whether the replica answered the last lag poll", |r| {
+                r.healthy.load(Ordering::Relaxed) as u8 as f64
+            }),
+            ("lucidata_replica_lag_seconds", "Replication lag of the replica", |r| {
+                r.lag_ms.load(Ordering::Relaxed) as f64 / 1000.0
+            }),
+            ("lucidata_replica_in_flight", "Queries running on the replica", |r| {
+                r.in_flight.load(Ordering::Relaxed) as f64
+            }),
+            ("lucidata_replica_heavy_in_flight", "Expensive queries running on the replica", |r| {
+                (r.max_heavy - r.heavy.available_permits()) as f64
+            }),
+        ];
+        for (name, help, value) in gauges {
+            metrics::write_header(out, name, help, "gauge");
+            for replica in &self.replicas {
+                let labels = format!("replica=\"{}\"", replica.name);
+                metrics::write_sample(out, name, &labels, value(replica));
+            }
+        }
+
+        let name = "lucidata_replica_query_seconds";
+        metrics::write_header(out, name, "Duration of queries run on the replica", "histogram");
+        for replica in &self.replicas {
+            let labels = format!("replica=\"{}\"", replica.name);
+            replica.latency.write_samples(out, name, &labels);
+        }
+    }
+}
+
+// Count a query as running on `replica` until the returned target is dropped
+fn lease(replica: &Arc<Replica>, heavy: Option<OwnedSemaphorePermit>) -> ReadTarget {
+    replica.in_flight.fetch_add(1, Ordering::Relaxed);
+    ReadTarget {
+        pool: replica.pool.clone(),
+        _lease: Some(ReplicaLease {
+            replica: Arc::clone(replica),
+            start: Instant::now(),
+            _heavy: heavy,
+        }),
+    }
+}
@@ -1,22 +1,114 @@
+use std::time::Duration;
+
 use axum::{
-    extract::{Path, State},
-    http::StatusCode,
-    response::Json,
+    body::StreamBody,
+    extract::{BodyStream, Path, Query, State},
+    http::{header, HeaderMap, HeaderValue, StatusCode},
+    response::{IntoResponse, Json, Response},
     Json as RequestJson,
 };
-use serde_json::{json, Value};
-use sqlx::{PgPool, Row, Column, TypeInfo};
+use futures::StreamExt;
+use serde_json::value::RawValue;
+use serde_json::Value;
+use sqlx::postgres::PgRow;
+use sqlx::{PgPool, Postgres, QueryBuilder};
 
-use crate::models::{Car, QueryRequest, QueryResponse};
+use crate::advisor::AdvisorReport;
+use crate::approximate::SamplePlan;
+use crate::budget::{self, Budget, ResultStats, ResultWriter};
+use crate::cache::{CacheStatus, ResultCache};
+use crate::cursor;
+use crate::datasets::{self, DatasetFormat, LoadSummary};
+use crate::dataframe::{
+    ArrowStreamEncoder, ParquetEncoder, ARROW_STREAM_CONTENT_TYPE, PARQUET_CONTENT_TYPE,
+};
+use crate::metrics;
+use crate::models::{
+    BatchItem, BatchOutcome, BatchParams, BatchRequest, BatchResponse, Car, CarsParams,
+    DatasetParams, ExportParams, PartialCar, QueryParams, QueryRequest, QueryResponse, QueryResult,
+    ResultFormat,
+};
+use crate::sql;
+use crate::state::AppState;
+use crate::stream::{self, NdjsonEncoder};
+use crate::views::ViewInfo;
+use crate::workload::Workload;
 
 // Health check endpoint
 pub async fn health_check() -> &'static str {
     "OK"
 }
 
-// Get all cars
-pub async fn get_cars(State(pool): State<PgPool>) -> Result<Json<Vec<Car>>, (StatusCode, String)> {
-    let cars = sqlx::query_as::<_, Car>("SELECT * FROM cars")
+// Prometheus metrics
+pub async fn metrics(State(state): State<AppState>) -> impl IntoResponse {
+    let mut out = String::new();
+    state.pool_monitor.write_metrics(&state.pool, &mut out);
+    state.replicas.write_metrics(&mut out);
+    state.cost_guard.write_metrics(&mut out);
+    ([(header::CONTENT_TYPE, metrics::CONTENT_TYPE)], out)
+}
+
+// Materialized views created for frequent aggregate queries, most used first
+pub async fn list_views(State(state): State<AppState>) -> Json<Vec<ViewInfo>> {
+    Json(state.views.list())
+}
+
+// Index recommendations for the observed workload, best first
+pub async fn index_recommendations(
+    State(state): State<AppState>,
+) -> Result<Json<AdvisorReport>, (StatusCode, String)> {
+    let report = state.advisor.recommend().await.map_err(|e| {
+        (
+            StatusCode::INTERNAL_SERVER_ERROR,
+            format!("Failed to analyze the workload: {}", e),
+        )
+    })?;
+    Ok(Json(report))
+}
+
+// Rows returned by /api/cars when no limit is given, and the largest allowed limit
+const DEFAULT_CARS_LIMIT: i64 = 100;
+const MAX_CARS_LIMIT: i64 = 1000;
+
+// List cars a page at a time, ordered by id
+//
+// Pages are keyed on the primary key (`WHERE id > after_id ORDER BY id`), and
+// the projection and filters are pushed into the SQL so the cost of a call
+// depends on the page rather than the size of the table.
+pub async fn get_cars(
+    State(pool): State<PgPool>,
+    Query(params): Query<CarsParams>,
+) -> Result<Json<Vec<PartialCar>>, (StatusCode, String)> {
+    let columns = params.columns().map_err(|e| (StatusCode::BAD_REQUEST, e))?;
+    let limit = params.limit.unwrap_or(DEFAULT_CARS_LIMIT);
+    if !(1..=MAX_CARS_LIMIT).contains(&limit) {
+        return Err((
+            StatusCode::BAD_REQUEST,
+            format!("limit must be between 1 and {}", MAX_CARS_LIMIT),
+        ));
+    }
+
+    // Column names come from CAR_FIELDS, everything else is bound
+    let mut query = QueryBuilder::<Postgres>::new("SELECT ");
+    query.push(columns.join(", "));
+    query.push(" FROM cars WHERE id > ");
+    query.push_bind(params.after_id.unwrap_or(0));
+    if let Some(model) = &params.model {
+        query.push(" AND model = ").push_bind(model);
+    }
+    if let Some(cyl) = params.cyl {
+        query.push(" AND cyl = ").push_bind(cyl);
+    }
+    if let Some(min_mpg) = params.min_mpg {
+        query.push(" AND mpg >= ").push_bind(min_mpg);
+    }
+    if let Some(max_mpg) = params.max_mpg {
+        query.push(" AND mpg <= ").push_bind(max_mpg);
+    }
+    query.push(" ORDER BY id LIMIT ").push_bind(limit);
+
+    let cars = query
+        .build_query_as::<PartialCar>()
         .fetch_all(&pool)
         .await
         .map_err(|e| {
@@ -51,91 +143,462 @@ pub async fn get_car_by_id(
 
 // Execute a raw SQL query
 pub async fn query(
-    State(pool): State<PgPool>,
+    State(state): State<AppState>,
+    Query(params): Query<QueryParams>,
+    headers: HeaderMap,
     RequestJson(payload): RequestJson<QueryRequest>,
-) -> Result<Json<QueryResponse>, (StatusCode, String)> {
+) -> Result<Response, (StatusCode, String)> {
+    // Content negotiation: binary dataframe formats via the Accept header or
+    // ?format=, NDJSON via the Accept header or ?stream=true
+    let format = if accepts(&headers, ARROW_STREAM_CONTENT_TYPE) {
+        ResultFormat::Arrow
+    } else if accepts(&headers, PARQUET_CONTENT_TYPE) {
+        ResultFormat::Parquet
+    } else {
+        params.format
+    };
+    let paginated = params.page_size.is_some() || payload.cursor.is_some();
+    let streamed = params.stream || accepts(&headers, stream::NDJSON_CONTENT_TYPE);
+
+    // Aggregates over large tables can be answered from a sample; queries
+    // that cannot are run exactly
+    if params.approximate {
+        if paginated || streamed || format != ResultFormat::Rows {
+            return Err((
+                StatusCode::BAD_REQUEST,
+                "Approximate results are only available as a single response in the rows format"
+                    .to_string(),
+            ));
+        }
+        if let Some(response) = query_approximate(&state, &payload.query, &params).await? {
+            return Ok(response);
+        }
+    }
+
+    // Estimate the cost of the query before running it. Queries that are too
+    // expensive are rejected here; continuation pages were checked when their
+    // cursor was opened.
+    let workload = match payload.cursor {
+        Some(_) => Workload::Interactive,
+        None => classify(&state, &payload.query).await?,
+    };
+
+    if paginated {
+        if streamed || matches!(format, ResultFormat::Arrow | ResultFormat::Parquet) {
+            return Err((
+                StatusCode::BAD_REQUEST,
+                "Pagination is only available for the rows and columnar formats".to_string(),
+            ));
+        }
+        return query_page(&state, payload, &params, format, workload).await;
+    }
+
     // Note: In a production environment, you'd want to validate and sanitize this query
     // or use a query builder to prevent SQL injection
     let query = payload.query;
+    let timeout = state.limits.timeout(params.timeout_ms);
+    let budget = state.limits.budget(params.max_rows, params.max_bytes);
+
+    match format {
+        ResultFormat::Arrow => {
+            let encoder = ArrowStreamEncoder::default();
+            let query = state.views.rewrite(&query).unwrap_or(query);
+            let target = state.cost_guard.target(workload, &state.replicas, &query).await;
+            return stream::stream_rows(target, query, timeout, budget, encoder, ARROW_STREAM_CONTENT_TYPE).await;
+        }
+        ResultFormat::Parquet => {
+            let encoder = ParquetEncoder::new(budget);
+            let query = state.views.rewrite(&query).unwrap_or(query);
+            let target = state.cost_guard.target(workload, &state.replicas, &query).await;
+            let mut response = stream::stream_rows(target, query, timeout, budget, encoder, PARQUET_CONTENT_TYPE).await?;
+            response.headers_mut().insert(
+                header::CONTENT_DISPOSITION,
+                HeaderValue::from_static("attachment; filename=\"query.parquet\""),
+            );
+            return Ok(response);
+        }
+        _ => {}
+    }
+
+    // Stream rows as NDJSON when asked to, instead of buffering the whole result set
+    if streamed {
+        let encoder = NdjsonEncoder::new(format);
+        let query = state.views.rewrite(&query).unwrap_or(query);
+        let target = state.cost_guard.target(workload, &state.replicas, &query).await;
+        return stream::stream_rows(target, query, timeout, budget, encoder, stream::NDJSON_CONTENT_TYPE).await;
+    }
     
-    let rows = sqlx::query(&query)
-        .fetch_all(&pool)
-        .await
-        .map_err(|e| {
-            (
-                StatusCode::BAD_REQUEST,
-                format!("Query error: {}", e),
-            )
-        })?;
+    let (response, cache_status) =
+        run_json(&state, query, workload, format, timeout, budget).await?;
 
-    // Convert the rows to a JSON array
-    let result = rows
-        .iter()
-        .map(|row| {
-            let mut map = serde_json::Map::new();
-            for i in 0..row.len() {
-                let column_name = row.column(i).name();
-                // Type info is used only in the fallback case
-                
-                // Handle different data types explicitly
-                let value = if let Ok(v) = row.try_get::<Option<i32>, _>(i) {
-                    match v {
-                        Some(val) => json!(val),
-                        None => Value::Null,
-                    }
-                } else if let Ok(v) = row.try_get::<Option<i64>, _>(i) {
-                    match v {
-                        Some(val) => json!(val),
-                        None => Value::Null,
-                    }
-                } else if let Ok(v) = row.try_get::<Option<f64>, _>(i) {
-                    match v {
-                        Some(val) => json!(val),
-                        None => Value::Null,
-                    }
-                } else if let Ok(v) = row.try_get::<Option<String>, _>(i) {
-                    match v {
-                        Some(val) => json!(val),
-                        None => Value::Null,
-                    }
-                } else if let Ok(v) = row.try_get::<Option<bool>, _>(i) {
-                    match v {
-                        Some(val) => json!(val),
-                        None => Value::Null,
-                    }
-                } else {
-                    // For any other types, try simpler approaches
-                    let type_info = row.column(i).type_info();
-                    let type_name = type_info.name();
-                    
-                    // Try to decode as JSON value first (works for many types)
-                    if let Ok(v) = row.try_get::<Option<serde_json::Value>, _>(i) {
-                        match v {
-                            Some(val) => val,
-                            None => Value::Null,
-                        }
-                    } else {
-                        // Try to get as a string (most types can be represented as strings)
-                        if let Ok(v) = row.try_get::<Option<String>, _>(i) {
-                            match v {
-                                Some(s) => json!(s),
-                                None => Value::Null,
-                            }
-                        } else {
-                            // If all else fails, return the type name as a fallback
-                            json!(format!("Value of type: {}", type_name))
-                        }
-                    }
+    let mut response = Json(response).into_response();
+    if let Some(status) = cache_status {
+        response
+            .headers_mut()
+            .insert("x-cache", HeaderValue::from_static(status.as_str()));
+    }
+    Ok(response)
+}
+
+// Classify a query by its estimated cost, and count it towards a materialized
+// view and the index advisor's workload
+async fn classify(state: &AppState, query: &str) -> Result<Workload, (StatusCode, String)> {
+    let workload = state.cost_guard.classify(&state.pool, query).await?;
+    state.views.record(query, state.cost_guard.estimate(query).await);
+    state.advisor.record(query);
+    Ok(workload)
+}
+
+// Run a query for a JSON response, and say whether the result cache was used
+async fn run_json(
+    state: &AppState,
+    query: String,
+    workload: Workload,
+    format: ResultFormat,
+    timeout: Duration,
+    budget: Budget,
+) -> Result<(QueryResponse, Option<CacheStatus>), (StatusCode, String)> {
+    // Repeated read-only queries are answered from the result cache
+    if let Some(cache) = &state.result_cache {
+        if let Some(lookup) = ResultCache::lookup(&query, format, budget) {
+            let (cost_guard, replicas, views, sql) = (
+                state.cost_guard.clone(),
+                state.replicas.clone(),
+                state.views.clone(),
+                query.clone(),
+            );
+            let (result, stats, status) = cache
+                .get_or_execute(lookup, move || async move {
+                    let sql = views.rewrite(&sql).unwrap_or(sql);
+                    let target = cost_guard.target(workload, &replicas, &sql).await;
+                    let (result, stats) =
+                        budget::fetch_result(&target.pool, &sql, timeout, budget, format).await?;
+                    Ok((result, stats))
+                })
+                .await?;
+
+            let response = QueryResponse {
+                result: QueryResult::Raw(result),
+                executed_query: query,
+                next_cursor: None,
+                approximation: None,
+                stats,
+            };
+            return Ok((response, Some(status)));
+        }
+    }
+
+    // Runs with a statement timeout; if the client disconnects meanwhile, the
+    // future is dropped and the query is cancelled on the server
+    let sql = state.views.rewrite(&query);
+    let sql = sql.as_deref().unwrap_or(&query);
+    let target = state.cost_guard.target(workload, &state.replicas, sql).await;
+    let (result, stats) = budget::fetch_result(&target.pool, sql, timeout, budget, format).await?;
+
+    let response = QueryResponse {
+        result: QueryResult::Raw(result),
+        executed_query: query,
+        next_cursor: None,
+        approximation: None,
+        stats,
+    };
+    Ok((response, None))
+}
+
+// Execute several independent queries in one request
+//
+// Statements run concurrently on separate pooled connections, at most
+// `parallelism` at a time, and each one gets its own result or error. With
+// ?stream=true every result is written as one NDJSON line as soon as it
+// completes, tagged with its index; otherwise all results are returned in
+// request order.
+pub async fn query_batch(
+    State(state): State<AppState>,
+    Query(params): Query<BatchParams>,
+    RequestJson(payload): RequestJson<BatchRequest>,
+) -> Result<Response, (StatusCode, String)> {
+    if payload.queries.len() > state.limits.max_batch_queries {
+        return Err((
+            StatusCode::BAD_REQUEST,
+            format!(
+                "A batch may hold at most {} queries",
+                state.limits.max_batch_queries
+            ),
+        ));
+    }
+    let format = params.format;
+    if matches!(format, ResultFormat::Arrow | ResultFormat::Parquet) {
+        return Err((
+            StatusCode::BAD_REQUEST,
+            "Batches are only available for the rows and columnar formats".to_string(),
+        ));
+    }
+
+    let parallelism = state.limits.batch_parallelism(params.parallelism);
+    let timeout = state.limits.timeout(params.timeout_ms);
+    let budget = state.limits.budget(params.max_rows, params.max_bytes);
+
+    let items = futures::stream::iter(payload.queries.into_iter().enumerate()).map(
+        move |(index, query)| {
+            let state = state.clone();
+            async move {
+                let outcome = match run_batch_query(&state, query, format, timeout, budget).await {
+                    Ok(response) => BatchOutcome::Ok(response),
+                    Err((status, error)) => BatchOutcome::Err {
+                        status: status.as_u16(),
+                        error,
+                    },
                 };
-                
-                map.insert(column_name.to_string(), value);
+                BatchItem { index, outcome }
             }
-            Value::Object(map)
+        },
+    );
+
+    if params.stream {
+        let lines = items.buffer_unordered(parallelism).map(|item| {
+            let mut line = serde_json::to_vec(&item)?;
+            line.push(b'\n');
+            Ok::<_, serde_json::Error>(line)
+        });
+        return Ok((
+            [(header::CONTENT_TYPE, stream::NDJSON_CONTENT_TYPE)],
+            StreamBody::new(lines),
+        )
+            .into_response());
+    }
+
+    let results = items.buffered(parallelism).collect::<Vec<_>>().await;
+    Ok(Json(BatchResponse { results }).into_response())
+}
+
+async fn run_batch_query(
+    state: &AppState,
+    query: String,
+    format: ResultFormat,
+    timeout: Duration,
+    budget: Budget,
+) -> Result<QueryResponse, (StatusCode, String)> {
+    let workload = classify(state, &query).await?;
+    let (response, _) = run_json(state, query, workload, format, timeout, budget).await?;
+    Ok(response)
+}
+
+// Answer an aggregate query from a sample of its table, or return None if it
+// has to be answered exactly
+async fn query_approximate(
+    state: &AppState,
+    query: &str,
+    params: &QueryParams,
+) -> Result<Option<Response>, (StatusCode, String)> {
+    let plan = match SamplePlan::new(query) {
+        Some(plan) => plan,
+        None => return Ok(None),
+    };
+    let sampled = match plan.sample(&state.pool, &state.sampling).await? {
+        Some(sampled) => sampled,
+        None => return Ok(None),
+    };
+
+    let timeout = state.limits.timeout(params.timeout_ms);
+    let budget = state.limits.budget(params.max_rows, params.max_bytes);
+    let workload = state.cost_guard.classify(&state.pool, &sampled.sql).await?;
+    let target = state.cost_guard.target(workload, &state.replicas, &sampled.sql).await;
+    let (result, stats) =
+        budget::fetch_result(&target.pool, &sampled.sql, timeout, budget, ResultFormat::Rows)
+            .await?;
+
+    // Sampled results are small enough to estimate from as values
+    let rows: Vec<Value> = serde_json::from_str(result.get()).map_err(budget::serialization_error)?;
+    let (rows, approximation) = plan.estimate(&sampled, rows);
+
+    Ok(Some(
+        Json(QueryResponse {
+            result: QueryResult::Rows(rows),
+            executed_query: sampled.sql,
+            next_cursor: None,
+            approximation: Some(approximation),
+            stats,
         })
-        .collect::<Vec<Value>>();
+        .into_response(),
+    ))
+}
+
+// Return one page of a result read from a server-side cursor
+async fn query_page(
+    state: &AppState,
+    payload: QueryRequest,
+    params: &QueryParams,
+    format: ResultFormat,
+    workload: Workload,
+) -> Result<Response, (StatusCode, String)> {
+    let (page_size, timeout_ms) = (params.page_size, params.timeout_ms);
+    if let Some(page_size) = page_size {
+        if page_size == 0 || page_size > cursor::MAX_PAGE_SIZE {
+            return Err((
+                StatusCode::BAD_REQUEST,
+                format!("page_size must be between 1 and {}", cursor::MAX_PAGE_SIZE),
+            ));
+        }
+    }
+
+    // Pages are held to the budget like any other response. Fetching no more
+    // rows than the budget allows keeps the rest for the next page.
+    let budget = state.limits.budget(params.max_rows, params.max_bytes);
+    let page = match (payload.cursor, page_size) {
+        (Some(token), page_size) => state.cursors.next(&token, page_size, budget.max_rows).await?,
+        (None, Some(page_size)) => {
+            let timeout = state.limits.timeout(timeout_ms);
+            // An open cursor keeps its connection after this request returns
+            let connection = state.pool_monitor.reserve().await?;
+            let target = state.cost_guard.target(workload, &state.replicas, &payload.query).await;
+            state
+                .cursors
+                .open(target, connection, &payload.query, page_size, budget.max_rows, timeout)
+                .await?
+        }
+        (None, None) => {
+            return Err((
+                StatusCode::BAD_REQUEST,
+                "Either page_size or cursor is required".to_string(),
+            ))
+        }
+    };
+
+    // Rows left out of a page cannot be fetched again, so a truncated page
+    // ends the result
+    let (result, stats) = shape_result(&page.rows, format, budget)?;
+    let mut next_cursor = page.next_cursor;
+    if stats.truncated {
+        if let Some(token) = next_cursor.take() {
+            state.cursors.close(&token);
+        }
+    }
 
     Ok(Json(QueryResponse {
-        result: json!(result),
-        executed_query: query,
-    }))
+        result: QueryResult::Raw(result),
+        executed_query: page.query,
+        next_cursor,
+        approximation: None,
+        stats,
+    })
+    .into_response())
+}
+
+// Serialize a page of rows in the requested shape, within the budget
+fn shape_result(
+    rows: &[PgRow],
+    format: ResultFormat,
+    budget: Budget,
+) -> Result<(Box<RawValue>, ResultStats), (StatusCode, String)> {
+    let mut writer = ResultWriter::new(format);
+    let mut stats = ResultStats::default();
+    for row in rows {
+        if stats.row_count == budget.max_rows {
+            stats.truncated = true;
+            break;
+        }
+        let room = budget.max_bytes.saturating_sub(stats.byte_count);
+        match writer.push(row, room).map_err(budget::serialization_error)? {
+            Some(size) => {
+                stats.row_count += 1;
+                stats.byte_count += size;
+            }
+            None => {
+                stats.truncated = true;
+                break;
+            }
+        }
+    }
+    let result = writer.finish().map_err(budget::serialization_error)?;
+    Ok((result, stats))
+}
+
+// Export the result of a query as CSV
+//
+// The query is wrapped in COPY ... TO STDOUT so Postgres produces the CSV
+// itself, and the bytes are streamed to the client without decoding any rows.
+// Only the query as re-printed by the parser is embedded in the COPY, and it
+// runs in a read-only transaction.
+pub async fn export(
+    State(state): State<AppState>,
+    Query(params): Query<ExportParams>,
+    RequestJson(payload): RequestJson<QueryRequest>,
+) -> Result<Response, (StatusCode, String)> {
+    let query = sql::read_only_statement(&payload.query)
+        .map_err(|e| (StatusCode::BAD_REQUEST, e))?;
+    let statement = format!("COPY ({}) TO STDOUT WITH CSV HEADER", query);
+    let timeout = state.limits.timeout(params.timeout_ms);
+
+    let csv = stream::copy_out_read_only(&state.pool, statement, timeout).await?;
+
+    Ok((
+        [
+            (header::CONTENT_TYPE, "text/csv"),
+            (header::CONTENT_DISPOSITION, "attachment; filename=\"export.csv\""),
+        ],
+        StreamBody::new(csv),
+    )
+        .into_response())
+}
+
+// Load a CSV or NDJSON upload into a table the LLM engine can query
+//
+// The body is streamed into Postgres with COPY as it arrives, so uploads can
+// be far larger than memory.
+pub async fn upload_dataset(
+    State(state): State<AppState>,
+    Path(name): Path<String>,
+    Query(params): Query<DatasetParams>,
+    headers: HeaderMap,
+    body: BodyStream,
+) -> Result<(StatusCode, Json<LoadSummary>), (StatusCode, String)> {
+    let format = match params.format {
+        Some(format) => format,
+        None => {
+            let content_type = headers
+                .get(header::CONTENT_TYPE)
+                .and_then(|value| value.to_str().ok())
+                .unwrap_or_default();
+            if content_type.starts_with("text/csv") {
+                DatasetFormat::Csv
+            } else if content_type.starts_with("application/x-ndjson")
+                || content_type.starts_with("application/jsonl")
+            {
+                DatasetFormat::Ndjson
+            } else {
+                return Err((
+                    StatusCode::UNSUPPORTED_MEDIA_TYPE,
+                    "Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson"
+                        .to_string(),
+                ));
+            }
+        }
+    };
+
+    let summary = datasets::load(
+        &state.dataset_pool,
+        &state.datasets,
+        &state.views,
+        &name,
+        format,
+        params.mode,
+        body,
+    )
+    .await?;
+    tracing::info!(
+        "Loaded {} rows into {} in {} ms",
+        summary.rows,
+        summary.table,
+        summary.elapsed_ms
+    );
+    Ok((StatusCode::CREATED, Json(summary)))
+}
+
+// Check whether the client listed `content_type` in its Accept header
+fn accepts(headers: &HeaderMap, content_type: &str) -> bool {
+    headers
+        .get_all(header::ACCEPT)
+        .iter()
+        .filter_map(|value| value.to_str().ok())
+        .any(|value| value.contains(content_type))
 }
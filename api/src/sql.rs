@@ -0,0 +1,320 @@
+use std::ops::ControlFlow;
+
+use sqlparser::ast::{
+    visit_expressions, visit_relations, Expr, Query, SelectItem, SetExpr, Statement, Visit, Visitor,
+};
+use sqlparser::dialect::PostgreSqlDialect;
+use sqlparser::parser::Parser;
+use sqlparser::tokenizer::{Token, Tokenizer};
+
+// Functions whose result can change between calls with the same arguments.
+// Queries that use them are never served from a cache.
+const VOLATILE_FUNCTIONS: &[&str] = &[
+    "now", "random", "setseed", "clock_timestamp", "statement_timestamp",
+    "transaction_timestamp", "timeofday", "current_date", "current_time", "current_timestamp",
+    "localtime", "localtimestamp", "nextval", "currval", "lastval", "gen_random_uuid", "pg_sleep",
+];
+
+// Aggregate and window functions. An expression that calls one depends on
+// more than the row it is evaluated on.
+const AGGREGATE_FUNCTIONS: &[&str] = &[
+    "count", "sum", "avg", "min", "max", "stddev", "stddev_samp", "stddev_pop", "variance",
+    "var_samp", "var_pop", "array_agg", "string_agg", "json_agg", "jsonb_agg", "bool_and",
+    "bool_or", "every", "bit_and", "bit_or", "percentile_cont", "percentile_disc", "mode",
+    "corr", "covar_pop", "covar_samp", "rank", "dense_rank", "row_number",
+];
+
+// Check that `query` is a single read-only statement and return it re-printed
+// from its syntax tree, without comments or a trailing semicolon, ready to be
+// embedded in a larger statement such as `COPY (...) TO STDOUT`
+//
+// The query is parsed with Postgres' own quoting rules, including E'' escapes
+// and dollar quoting, and must be exactly one SELECT, WITH, VALUES or TABLE
+// query. Only the re-printed statement is ever embedded, never the text the
+// client sent.
+pub fn read_only_statement(query: &str) -> Result<String, String> {
+    parse_read_only(query).map(|statement| statement.to_string())
+}
+
+// Wrap a read-only query so Postgres returns at most `limit` rows, or return
+// None if the query cannot safely be wrapped
+pub fn with_row_limit(query: &str, limit: usize) -> Option<String> {
+    let query = read_only_statement(query).ok()?;
+    Some(format!(
+        "SELECT * FROM ({}) AS lucidata_limited LIMIT {}",
+        query, limit
+    ))
+}
+
+fn parse_read_only(query: &str) -> Result<Statement, String> {
+    let mut statements = Parser::parse_sql(&PostgreSqlDialect {}, query)
+        .map_err(|e| format!("Could not parse query: {}", e))?;
+    if statements.len() != 1 {
+        return Err("Only a single statement is allowed".to_string());
+    }
+    let statement = statements.pop().expect("exactly one statement");
+    if !matches!(statement, Statement::Query(_)) {
+        return Err("Only SELECT, WITH, VALUES and TABLE queries are allowed".to_string());
+    }
+    if let ControlFlow::Break(e) = statement.visit(&mut WriteFinder) {
+        return Err(e);
+    }
+    Ok(statement)
+}
+
+// Finds the parts of a query that write to the database or lock rows: data
+// modifying statements in CTEs, SELECT INTO and FOR UPDATE/SHARE
+struct WriteFinder;
+
+impl Visitor for WriteFinder {
+    type Break = String;
+
+    fn pre_visit_statement(&mut self, statement: &Statement) -> ControlFlow<String> {
+        match statement {
+            Statement::Query(_) => ControlFlow::Continue(()),
+            other => {
+                let printed = other.to_string();
+                let keyword = printed.split_whitespace().next().unwrap_or_default();
+                ControlFlow::Break(format!(
+                    "Statements containing {} are not allowed",
+                    keyword.to_uppercase()
+                ))
+            }
+        }
+    }
+
+    fn pre_visit_query(&mut self, query: &Query) -> ControlFlow<String> {
+        if !query.locks.is_empty() {
+            return ControlFlow::Break("Locking clauses are not allowed".to_string());
+        }
+        if selects_into(&query.body) {
+            return ControlFlow::Break("SELECT INTO is not allowed".to_string());
+        }
+        ControlFlow::Continue(())
+    }
+}
+
+// Whether a query body creates a table with SELECT INTO. Nested queries are
+// visited on their own.
+fn selects_into(body: &SetExpr) -> bool {
+    match body {
+        SetExpr::Select(select) => select.into.is_some(),
+        SetExpr::SetOperation { left, right, .. } => selects_into(left) || selects_into(right),
+        _ => false,
+    }
+}
+
+// A read-only query in canonical form, with the tables it reads from
+pub struct CanonicalQuery {
+    pub sql: String,
+    // Lowercase, deduplicated and sorted table names
+    pub tables: Vec<String>,
+}
+
+// Canonical form of a read-only query, for use as a cache key
+//
+// The query is parsed and re-printed, which normalizes whitespace, keyword
+// case and optional syntax such as `AS` before aliases, and unquoted
+// identifiers are folded to lowercase as Postgres does. Returns None for
+// anything that is not a single SELECT, or that calls a volatile function.
+pub fn canonical_query(query: &str) -> Option<CanonicalQuery> {
+    let statement = parse_read_only(query).ok()?;
+
+    let dialect = PostgreSqlDialect {};
+    let printed = statement.to_string();
+    let tokens = Tokenizer::new(&dialect, &printed).tokenize().ok()?;
+    let mut parts = Vec::with_capacity(tokens.len());
+    for token in tokens {
+        match token {
+            Token::Whitespace(_) => {}
+            Token::Word(mut word) if word.quote_style.is_none() => {
+                word.value = word.value.to_lowercase();
+                if VOLATILE_FUNCTIONS.contains(&word.value.as_str()) {
+                    return None;
+                }
+                parts.push(Token::Word(word).to_string());
+            }
+            token => parts.push(token.to_string()),
+        }
+    }
+
+    let mut tables = Vec::new();
+    let _ = visit_relations(&statement, |relation| {
+        if let Some(name) = relation.0.last() {
+            let table = match name.quote_style {
+                Some(_) => name.value.clone(),
+                None => name.value.to_lowercase(),
+            };
+            if !tables.contains(&table) {
+                tables.push(table);
+            }
+        }
+        ControlFlow::<()>::Continue(())
+    });
+    tables.sort();
+
+    Some(CanonicalQuery {
+        sql: parts.join(" "),
+        tables,
+    })
+}
+
+// Whether `expr` calls an aggregate or window function
+pub fn contains_aggregate(expr: &Expr) -> bool {
+    let found = visit_expressions(expr, |expr| match expr {
+        Expr::Function(function)
+            if AGGREGATE_FUNCTIONS
+                .contains(&function.name.to_string().to_lowercase().as_str()) =>
+        {
+            ControlFlow::Break(())
+        }
+        _ => ControlFlow::Continue(()),
+    });
+    found.is_break()
+}
+
+// Whether `query` is a single SELECT that aggregates its rows, e.g. a GROUP BY
+// query or a COUNT(*)
+pub fn is_aggregate_query(query: &str) -> bool {
+    let statements = match Parser::parse_sql(&PostgreSqlDialect {}, query) {
+        Ok(statements) => statements,
+        Err(_) => return false,
+    };
+    let [Statement::Query(query)] = statements.as_slice() else {
+        return false;
+    };
+    let SetExpr::Select(select) = query.body.as_ref() else {
+        return false;
+    };
+    select.projection.iter().any(|item| match item {
+        SelectItem::UnnamedExpr(expr) | SelectItem::ExprWithAlias { expr, .. } => {
+            contains_aggregate(expr)
+        }
+        _ => false,
+    })
+}
+
+// FNV-1a hash of `text`, for names of database objects derived from queries.
+// Unlike the std hasher it is the same across runs and Rust versions.
+pub fn stable_hash(text: &str) -> u64 {
+    text.bytes().fold(0xcbf29ce484222325, |hash, byte| {
+        (hash ^ byte as u64).wrapping_mul(0x100000001b3)
+    })
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn statements(query: &str) -> usize {
+        Parser::parse_sql(&PostgreSqlDialect {}, query)
+            .map(|statements| statements.len())
+            .unwrap_or(0)
+    }
+
+    #[test]
+    fn accepts_read_only_queries() {
+        for query in [
+            "SELECT * FROM cars",
+            "select model, mpg from cars where cyl = 4 order by mpg desc limit 5;",
+            "WITH fast AS (SELECT * FROM cars WHERE hp > 200) SELECT count(*) FROM fast",
+            "VALUES (1, 'a'), (2, 'b')",
+            "SELECT model FROM cars UNION SELECT model FROM cars -- trailing comment",
+        ] {
+            assert!(read_only_statement(query).is_ok(), "{}", query);
+        }
+    }
+
+    #[test]
+    fn strips_the_semicolon_and_comments() {
+        let statement = read_only_statement("SELECT 1 /* one */ ; -- done").unwrap();
+        assert_eq!(statement, "SELECT 1");
+    }
+
+    #[test]
+    fn rejects_writes() {
+        for query in [
+            "DELETE FROM cars",
+            "INSERT INTO cars (model) VALUES ('x')",
+            "DROP TABLE cars",
+            "COPY cars TO STDOUT",
+            "EXPLAIN ANALYZE DELETE FROM cars",
+            "SELECT * INTO cars_copy FROM cars",
+            "SELECT * FROM cars FOR UPDATE",
+            "WITH changed AS (UPDATE cars SET mpg = 0 RETURNING *) SELECT * FROM changed",
+        ] {
+            assert!(read_only_statement(query).is_err(), "{}", query);
+        }
+    }
+
+    #[test]
+    fn rejects_several_statements() {
+        assert!(read_only_statement("SELECT 1; SELECT 2").is_err());
+        assert!(read_only_statement("SELECT 1; DROP TABLE cars").is_err());
+        assert!(read_only_statement("").is_err());
+    }
+
+    // Quoting that hides a closing parenthesis and further statements from a
+    // scanner that only knows plain '' strings
+    #[test]
+    fn rejects_statements_smuggled_through_quoting() {
+        for query in [
+            r"SELECT E'\'' ) TO STDOUT; DROP TABLE cars; COPY (SELECT '1'",
+            "SELECT $$'$$) TO STDOUT; DROP TABLE cars; COPY (SELECT '1'",
+            "SELECT $tag$'$tag$) TO STDOUT; DROP TABLE cars; COPY (SELECT '1'",
+            "SELECT 'it''s' ) TO STDOUT; DROP TABLE cars; COPY (SELECT '1'",
+            "SELECT \"a\"\"b\" ) TO STDOUT; DROP TABLE cars; COPY (SELECT '1'",
+        ] {
+            assert!(read_only_statement(query).is_err(), "{}", query);
+        }
+    }
+
+    #[test]
+    fn keeps_quoted_text_inside_one_statement() {
+        for query in [
+            r"SELECT E'it\'s; DROP TABLE cars'",
+            "SELECT $$ ) TO STDOUT; DROP TABLE cars; $$",
+            "SELECT 'it''s; DROP TABLE cars'",
+            "SELECT \"odd; name\" FROM cars",
+        ] {
+            let statement = read_only_statement(query).unwrap();
+            assert_eq!(statements(&statement), 1, "{}", statement);
+            let copy = format!("COPY ({}) TO STDOUT WITH CSV HEADER", statement);
+            assert_eq!(statements(&copy), 1, "{}", copy);
+        }
+    }
+
+    #[test]
+    fn wraps_read_only_queries_in_a_limit() {
+        assert_eq!(
+            with_row_limit("SELECT * FROM cars;", 11).unwrap(),
+            "SELECT * FROM (SELECT * FROM cars) AS lucidata_limited LIMIT 11"
+        );
+        assert!(with_row_limit("DELETE FROM cars", 11).is_none());
+    }
+
+    #[test]
+    fn canonical_form_ignores_layout_and_case() {
+        let a = canonical_query("select  model,mpg FROM Cars as c where c.cyl = 4").unwrap();
+        let b = canonical_query("SELECT model, mpg\nFROM cars c\nWHERE c.cyl = 4;").unwrap();
+        assert_eq!(a.sql, b.sql);
+        assert_eq!(a.tables, vec!["cars".to_string()]);
+    }
+
+    #[test]
+    fn canonical_form_keeps_literals_and_quoted_names() {
+        let lower = canonical_query("SELECT * FROM cars WHERE model = 'Fiat 128'").unwrap();
+        let upper = canonical_query("SELECT * FROM cars WHERE model = 'FIAT 128'").unwrap();
+        assert_ne!(lower.sql, upper.sql);
+
+        let quoted = canonical_query("SELECT * FROM \"Cars\"").unwrap();
+        assert_eq!(quoted.tables, vec!["Cars".to_string()]);
+    }
+
+    #[test]
+    fn volatile_and_writing_queries_have_no_canonical_form() {
+        assert!(canonical_query("SELECT now()").is_none());
+        assert!(canonical_query("SELECT random() FROM cars").is_none());
+        assert!(canonical_query("DELETE FROM cars").is_none());
+    }
+}
@@ -0,0 +1,48 @@
+use std::sync::Arc;
+
+use axum::extract::FromRef;
+use sqlx::PgPool;
+
+use crate::advisor::IndexAdvisor;
+use crate::approximate::SamplingConfig;
+use crate::cache::ResultCache;
+use crate::cursor::CursorRegistry;
+use crate::datasets::DatasetConfig;
+use crate::limits::QueryLimits;
+use crate::pool::PoolMonitor;
+use crate::replicas::ReplicaSet;
+use crate::views::ViewManager;
+use crate::workload::CostGuard;
+
+// Shared state for all handlers
+#[derive(Clone)]
+pub struct AppState {
+    pub pool: PgPool,
+    pub cursors: Arc<CursorRegistry>,
+    // None when result caching is disabled
+    pub result_cache: Option<Arc<ResultCache>>,
+    pub pool_monitor: Arc<PoolMonitor>,
+    pub limits: QueryLimits,
+    // Where read-only queries from /api/query run
+    pub replicas: Arc<ReplicaSet>,
+    // Decides from their estimated cost whether queries run on the
+    // interactive or the heavy pool
+    pub cost_guard: Arc<CostGuard>,
+    // Sample sizes for approximate queries
+    pub sampling: SamplingConfig,
+    // Materialized views for frequent, expensive aggregate queries
+    pub views: Arc<ViewManager>,
+    // How uploads to /api/datasets are loaded
+    pub datasets: DatasetConfig,
+    // Connections for loading uploads, separate from the ones queries use
+    pub dataset_pool: PgPool,
+    // Observes query shapes to recommend indexes
+    pub advisor: Arc<IndexAdvisor>,
+}
+
+// Handlers that only need the database can keep extracting `State<PgPool>`
+impl FromRef<AppState> for PgPool {
+    fn from_ref(state: &AppState) -> PgPool {
+        state.pool.clone()
+    }
+}
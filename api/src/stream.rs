@@ -0,0 +1,277 @@
+use std::time::Duration;
+
+use axum::{
+    body::{Bytes, StreamBody},
+    http::{header, StatusCode},
+    response::{IntoResponse, Response},
+};
+use futures::{stream, Stream, StreamExt};
+use serde::Serialize;
+use serde_json::json;
+use sqlx::postgres::PgRow;
+use sqlx::{PgPool, Row};
+use tokio::sync::mpsc;
+
+use crate::budget::{Budget, ResultStats};
+use crate::decode::ResultPlan;
+use crate::execute::Execution;
+use crate::models::ResultFormat;
+use crate::replicas::ReadTarget;
+use crate::sql;
+
+pub const NDJSON_CONTENT_TYPE: &str = "application/x-ndjson";
+
+pub type BoxError = Box<dyn std::error::Error + Send + Sync>;
+
+// Number of encoded chunks held between the database and the client before
+// the reader waits for the client to catch up
+const CHANNEL_CAPACITY: usize = 64;
+
+// Encodes rows into response body bytes as they arrive from the database
+//
+// Anything written to `out` is sent to the client as soon as the call returns,
+// so encoders that work in batches only write once a batch is complete.
+pub trait RowEncoder: Send + 'static {
+    // Called once with the result columns, before the first row
+    fn begin(&mut self, plan: &ResultPlan, out: &mut Vec<u8>) -> Result<(), BoxError>;
+
+    fn row(&mut self, plan: &ResultPlan, row: &PgRow, out: &mut Vec<u8>) -> Result<(), BoxError>;
+
+    // Called before `finish` when rows were left out to keep to the budget.
+    // Formats that cannot say so fail instead, so the client cannot take what
+    // it received for the whole result.
+    fn truncated(&mut self, stats: &ResultStats, out: &mut Vec<u8>) -> Result<(), BoxError>;
+
+    // Called after the last row
+    fn finish(&mut self, out: &mut Vec<u8>) -> Result<(), BoxError>;
+}
+
+// Writes each row as one line of JSON
+//
+// In the rows format every line is an object keyed by column name. In the
+// columnar format the first line is a `{"columns": [...]}` header and every
+// following line is a positional array of values. A result cut short by the
+// budget ends with a `{"truncated": true, "row_count": ..., "byte_count": ...}`
+// line.
+pub struct NdjsonEncoder {
+    format: ResultFormat,
+}
+
+impl NdjsonEncoder {
+    pub fn new(format: ResultFormat) -> Self {
+        NdjsonEncoder { format }
+    }
+}
+
+impl RowEncoder for NdjsonEncoder {
+    fn begin(&mut self, plan: &ResultPlan, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        if self.format == ResultFormat::Columnar {
+            write_line(out, &json!({ "columns": plan.column_info() }))?;
+        }
+        Ok(())
+    }
+
+    fn row(&mut self, plan: &ResultPlan, row: &PgRow, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        match self.format {
+            ResultFormat::Columnar => write_line(out, &plan.array(row)),
+            _ => write_line(out, &plan.object(row)),
+        }
+    }
+
+    fn truncated(&mut self, stats: &ResultStats, out: &mut Vec<u8>) -> Result<(), BoxError> {
+        write_line(out, stats)
+    }
+
+    fn finish(&mut self, _out: &mut Vec<u8>) -> Result<(), BoxError> {
+        Ok(())
+    }
+}
+
+fn write_line<T: Serialize>(out: &mut Vec<u8>, value: &T) -> Result<(), BoxError> {
+    serde_json::to_writer(&mut *out, value)?;
+    out.push(b'\n');
+    Ok(())
+}
+
+// Stream the rows of a query to the client through `encoder`
+//
+// A background task pulls rows from sqlx's row stream and hands the encoded
+// bytes to the response body through a bounded channel, so memory stays flat
+// regardless of the result size and a slow client applies backpressure all the
+// way back to the database.
+//
+// The rows and bytes sent are held to `budget` like a JSON response. Read-only
+// queries are wrapped in a LIMIT of one more row than the budget, and once the
+// budget is used up the rest of the statement is read and discarded.
+pub async fn stream_rows<E: RowEncoder>(
+    target: ReadTarget,
+    query: String,
+    timeout: Duration,
+    budget: Budget,
+    encoder: E,
+    content_type: &'static str,
+) -> Result<Response, (StatusCode, String)> {
+    let (tx, mut rx) = mpsc::channel::<Result<Bytes, BoxError>>(CHANNEL_CAPACITY);
+
+    tokio::spawn(async move {
+        // The target stays alive until the last row has been read
+        if let Err(e) = produce(&target.pool, query, timeout, budget, encoder, tx.clone()).await {
+            let _ = tx.send(Err(e)).await;
+        }
+    });
+
+    // Wait for the first chunk so that errors in the query itself still
+    // produce a 400 instead of a truncated 200
+    let first = match rx.recv().await {
+        Some(Err(e)) => return Err((StatusCode::BAD_REQUEST, format!("Query error: {}", e))),
+        first => first,
+    };
+
+    let body = stream::iter(first).chain(stream::unfold(rx, |mut rx| async move {
+        rx.recv().await.map(|chunk| (chunk, rx))
+    }));
+
+    Ok((
+        [(header::CONTENT_TYPE, content_type)],
+        StreamBody::new(body),
+    )
+        .into_response())
+}
+
+async fn produce<E: RowEncoder>(
+    pool: &PgPool,
+    query: String,
+    timeout: Duration,
+    budget: Budget,
+    mut encoder: E,
+    tx: mpsc::Sender<Result<Bytes, BoxError>>,
+) -> Result<(), BoxError> {
+    let mut out = Vec::new();
+    let mut plan: Option<ResultPlan> = None;
+    let mut stats = ResultStats::default();
+
+    let limited = sql::with_row_limit(&query, budget.max_rows.saturating_add(1));
+    let statement = limited.as_deref().unwrap_or(&query);
+
+    // Returning before the rows are exhausted drops the execution, which
+    // cancels the query on the server
+    let mut execution = Execution::begin(pool, timeout).await?;
+    let mut rows = execution.fetch(statement);
+    while let Some(row) = rows.next().await {
+        let row = row?;
+        if stats.row_count == budget.max_rows {
+            stats.truncated = true;
+            break;
+        }
+        if plan.is_none() {
+            let new_plan = ResultPlan::new(row.columns());
+            encoder.begin(&new_plan, &mut out)?;
+            plan = Some(new_plan);
+        }
+        let current = plan.as_ref().expect("plan is set before the first row");
+        let start = out.len();
+        encoder.row(current, &row, &mut out)?;
+        if stats.byte_count + out.len() > budget.max_bytes {
+            out.truncate(start);
+            stats.truncated = true;
+            break;
+        }
+        stats.row_count += 1;
+        stats.byte_count += out.len();
+
+        // Stop reading once the client has gone away
+        if !send(&tx, &mut out).await {
+            return Ok(());
+        }
+    }
+    // Let a truncated statement complete rather than cancel it
+    if stats.truncated {
+        while let Some(row) = rows.next().await {
+            row?;
+        }
+    }
+    drop(rows);
+
+    // An empty result still has columns, which some formats need to describe.
+    // They are asked for on the same connection, so of the same database.
+    if plan.is_none() {
+        let columns = execution.columns(&query).await?;
+        encoder.begin(&ResultPlan::new(&columns), &mut out)?;
+    }
+    execution.commit().await?;
+    if stats.truncated {
+        encoder.truncated(&stats, &mut out)?;
+    }
+    encoder.finish(&mut out)?;
+    send(&tx, &mut out).await;
+
+    Ok(())
+}
+
+// Hand the pending bytes to the response body, returning false if the client
+// has disconnected
+async fn send(tx: &mpsc::Sender<Result<Bytes, BoxError>>, out: &mut Vec<u8>) -> bool {
+    if out.is_empty() {
+        return !tx.is_closed();
+    }
+    tx.send(Ok(Bytes::from(std::mem::take(out)))).await.is_ok()
+}
+
+// Stream the output of a `COPY ... TO STDOUT` statement
+//
+// The statement runs in a READ ONLY transaction, so nothing the query calls
+// can write to the database, with `timeout` as its statement timeout. Like `stream_rows`, a background task reads the
+// output and hands it over through a bounded channel, and the first chunk is
+// awaited so that errors in the statement produce a 400.
+pub async fn copy_out_read_only(
+    pool: &PgPool,
+    statement: String,
+    timeout: Duration,
+) -> Result<impl Stream<Item = Result<Bytes, BoxError>>, (StatusCode, String)> {
+    let (tx, mut rx) = mpsc::channel::<Result<Bytes, BoxError>>(CHANNEL_CAPACITY);
+
+    let pool = pool.clone();
+    tokio::spawn(async move {
+        if let Err(e) = copy_out(&pool, &statement, timeout, &tx).await {
+            let _ = tx.send(Err(e)).await;
+        }
+    });
+
+    let first = match rx.recv().await {
+        Some(Err(e)) => return Err((StatusCode::BAD_REQUEST, format!("Query error: {}", e))),
+        first => first,
+    };
+
+    let body = stream::iter(first).chain(stream::unfold(rx, |mut rx| async move {
+        rx.recv().await.map(|chunk| (chunk, rx))
+    }));
+    Ok(body)
+}
+
+async fn copy_out(
+    pool: &PgPool,
+    statement: &str,
+    timeout: Duration,
+    tx: &mpsc::Sender<Result<Bytes, BoxError>>,
+) -> Result<(), BoxError> {
+    let mut transaction = crate::pool::begin(pool).await?;
+    sqlx::query("SET TRANSACTION READ ONLY")
+        .execute(&mut *transaction)
+        .await?;
+    sqlx::query("SELECT set_config('statement_timeout', $1, true)")
+        .bind(timeout.as_millis().to_string())
+        .execute(&mut *transaction)
+        .await?;
+
+    let mut output = transaction.copy_out_raw(statement).await?;
+    while let Some(chunk) = output.next().await {
+        // Stop reading once the client has gone away
+        if tx.send(Ok(chunk?)).await.is_err() {
+            return Ok(());
+        }
+    }
+    drop(output);
+    transaction.commit().await?;
+
+    Ok(())
+}
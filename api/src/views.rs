@@ -0,0 +1,403 @@
+use std::collections::HashMap;
+use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
+
+use serde::Serialize;
+use sqlx::postgres::{PgConnection, PgListener};
+use sqlx::PgPool;
+
+use crate::cache::TABLE_CHANGED_CHANNEL;
+use crate::sql;
+use crate::workload::PlanEstimate;
+
+// Prefix of the materialized views the manager owns. Views with this prefix
+// left over from a previous run are dropped at startup.
+const VIEW_PREFIX: &str = "lucidata_mv_";
+
+// Fingerprints tracked before the ones that never became views are forgotten
+const MAX_TRACKED: usize = 10_000;
+
+// When aggregate queries get a materialized view, read from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct ViewConfig {
+    // Most views managed at once; 0 disables the manager
+    pub max_views: usize,
+    // A query gets a view once it has been seen this many times, and the
+    // planner estimates it at least this expensive
+    pub min_hits: u64,
+    pub min_cost: f64,
+    // Every view is refreshed at least this often, even without change
+    // notifications for its tables
+    pub refresh_interval: Duration,
+}
+
+impl ViewConfig {
+    pub fn from_env() -> Self {
+        ViewConfig {
+            max_views: crate::env_var("MATVIEW_MAX_VIEWS", 16),
+            min_hits: crate::env_var("MATVIEW_MIN_HITS", 10),
+            min_cost: crate::env_var("MATVIEW_MIN_COST", 1_000.0),
+            refresh_interval: Duration::from_secs(crate::env_var("MATVIEW_REFRESH_SECS", 300)),
+        }
+    }
+}
+
+// A materialized view holding the result of one aggregate query
+pub struct ManagedView {
+    name: String,
+    query: String,
+    tables: Vec<String>,
+    // Reads the view in the order the query returned its rows
+    select: String,
+    hits: AtomicU64,
+    // Set when one of its tables changed and it has not been refreshed since;
+    // queries are not served from a stale view
+    stale: AtomicBool,
+    created: Instant,
+    refreshed: Mutex<Instant>,
+}
+
+// A managed view as listed by the admin endpoint
+#[derive(Serialize)]
+pub struct ViewInfo {
+    pub name: String,
+    pub query: String,
+    pub tables: Vec<String>,
+    pub hits: u64,
+    pub stale: bool,
+    pub age_secs: u64,
+    pub secs_since_refresh: u64,
+}
+
+enum Tracked {
+    // Seen this many times, without a view yet
+    Observed(u64),
+    Creating,
+    // Creating the view failed; the query is not tried again
+    Failed,
+    Ready(Arc<ManagedView>),
+}
+
+// Creates materialized views for aggregate queries that are run often and are
+// expensive, and answers those queries from the views
+//
+// Each view stores the query's rows numbered in their original order, with a
+// unique index on the number so it can be refreshed concurrently. Views are
+// refreshed when Postgres notifies that one of their tables changed, and on a
+// schedule for tables without change triggers.
+pub struct ViewManager {
+    config: ViewConfig,
+    pool: PgPool,
+    // By canonical query
+    tracked: Mutex<HashMap<String, Tracked>>,
+}
+
+impl ViewManager {
+    pub fn new(config: ViewConfig, pool: PgPool) -> Self {
+        ViewManager {
+            config,
+            pool,
+            tracked: Mutex::new(HashMap::new()),
+        }
+    }
+
+    // Count a run of `query`, and create a view for it in the background once
+    // it crosses the thresholds
+    pub fn record(self: &Arc<Self>, query: &str, estimate: Option<PlanEstimate>) {
+        if self.config.max_views == 0 {
+            return;
+        }
+        let canonical = match sql::canonical_query(query) {
+            Some(canonical) => canonical,
+            None => return,
+        };
+
+        let mut tracked = self.tracked.lock().unwrap();
+        let views = tracked
+            .values()
+            .filter(|entry| matches!(entry, Tracked::Creating | Tracked::Ready(_)))
+            .count();
+        if tracked.len() >= MAX_TRACKED {
+            tracked.retain(|_, entry| !matches!(entry, Tracked::Observed(_)));
+        }
+
+        let entry = tracked
+            .entry(canonical.sql.clone())
+            .or_insert(Tracked::Observed(0));
+        let Tracked::Observed(hits) = entry else {
+            return;
+        };
+        *hits += 1;
+
+        let expensive = estimate.map_or(false, |estimate| estimate.cost >= self.config.min_cost);
+        if *hits < self.config.min_hits || !expensive || views >= self.config.max_views {
+            return;
+        }
+        // Only aggregations are worth storing: their results are small
+        // compared to the rows they read
+        if !sql::is_aggregate_query(query) {
+            *entry = Tracked::Failed;
+            return;
+        }
+        *entry = Tracked::Creating;
+        drop(tracked);
+
+        let (manager, query) = (Arc::clone(self), query.to_string());
+        tokio::spawn(async move {
+            let state = match manager.create(&canonical.sql, &query, canonical.tables).await {
+                Ok(view) => {
+                    tracing::info!("Created materialized view {} for {}", view.name, view.query);
+                    Tracked::Ready(Arc::new(view))
+                }
+                Err(e) => {
+                    tracing::warn!("Failed to create a materialized view for {}: {}", query, e);
+                    Tracked::Failed
+                }
+            };
+            manager.tracked.lock().unwrap().insert(canonical.sql, state);
+        });
+    }
+
+    // The statement that reads the result of `query` from its view, if it has
+    // an up-to-date one
+    pub fn rewrite(&self, query: &str) -> Option<String> {
+        if self.config.max_views == 0 {
+            return None;
+        }
+        let canonical = sql::canonical_query(query)?;
+        let tracked = self.tracked.lock().unwrap();
+        match tracked.get(&canonical.sql) {
+            Some(Tracked::Ready(view)) if !view.stale.load(Ordering::Relaxed) => {
+                view.hits.fetch_add(1, Ordering::Relaxed);
+                Some(view.select.clone())
+            }
+            _ => None,
+        }
+    }
+
+    pub fn list(&self) -> Vec<ViewInfo> {
+        let mut views: Vec<ViewInfo> = self
+            .views()
+            .into_iter()
+            .map(|view| ViewInfo {
+                name: view.name.clone(),
+                query: view.query.clone(),
+                tables: view.tables.clone(),
+                hits: view.hits.load(Ordering::Relaxed),
+                stale: view.stale.load(Ordering::Relaxed),
+                age_secs: view.created.elapsed().as_secs(),
+                secs_since_refresh: view.refreshed.lock().unwrap().elapsed().as_secs(),
+            })
+            .collect();
+        views.sort_by(|a, b| b.hits.cmp(&a.hits));
+        views
+    }
+
+    fn views(&self) -> Vec<Arc<ManagedView>> {
+        self.tracked
+            .lock()
+            .unwrap()
+            .values()
+            .filter_map(|entry| match entry {
+                Tracked::Ready(view) => Some(Arc::clone(view)),
+                _ => None,
+            })
+            .collect()
+    }
+
+    async fn create(
+        &self,
+        canonical: &str,
+        query: &str,
+        tables: Vec<String>,
+    ) -> Result<ManagedView, sqlx::Error> {
+        let statement = sql::read_only_statement(query).map_err(sqlx::Error::Protocol)?;
+        let name = format!("{}{:016x}", VIEW_PREFIX, sql::stable_hash(canonical));
+
+        // row_number() over the query's own output keeps its ORDER BY
+        sqlx::query(&format!(
+            "CREATE MATERIALIZED VIEW {} AS \
+             SELECT row_number() OVER () AS lucidata_row, q.* FROM ({}) AS q",
+            name, statement
+        ))
+        .execute(&self.pool)
+        .await?;
+        sqlx::query(&format!(
+            "CREATE UNIQUE INDEX {0}_row ON {0} (lucidata_row)",
+            name
+        ))
+        .execute(&self.pool)
+        .await?;
+
+        let columns: Vec<String> = sqlx::query_scalar(
+            "SELECT attname::text FROM pg_attribute \
+             WHERE attrelid = to_regclass($1) AND attnum > 0 AND NOT attisdropped \
+             ORDER BY attnum",
+        )
+        .bind(&name)
+        .fetch_all(&self.pool)
+        .await?;
+        let columns: Vec<String> = columns
+            .iter()
+            .filter(|column| column.as_str() != "lucidata_row")
+            .map(|column| format!("\"{}\"", column.replace('"', "\"\"")))
+            .collect();
+
+        Ok(ManagedView {
+            select: format!(
+                "SELECT {} FROM {} ORDER BY lucidata_row",
+                columns.join(", "),
+                name
+            ),
+            name,
+            query: query.to_string(),
+            tables,
+            hits: AtomicU64::new(0),
+            stale: AtomicBool::new(false),
+            created: Instant::now(),
+            refreshed: Mutex::new(Instant::now()),
+        })
+    }
+
+    async fn refresh(&self, view: &ManagedView) {
+        let statement = format!("REFRESH MATERIALIZED VIEW CONCURRENTLY {}", view.name);
+        // Notifications that arrive while refreshing mark the view stale
+        // again, and it is refreshed once more
+        view.stale.store(false, Ordering::Relaxed);
+        match sqlx::query(&statement).execute(&self.pool).await {
+            Ok(_) => *view.refreshed.lock().unwrap() = Instant::now(),
+            Err(e) => {
+                view.stale.store(true, Ordering::Relaxed);
+                tracing::warn!("Failed to refresh materialized view {}: {}", view.name, e);
+            }
+        }
+    }
+
+    fn mark_stale(&self, table: &str) {
+        for view in self.views() {
+            if view.tables.iter().any(|t| t == table) {
+                view.stale.store(true, Ordering::Relaxed);
+            }
+        }
+    }
+
+    // Drop the views that read from `relation` in `tx`, which is about to drop
+    // the relation, and return their names to `forget` once `tx` commits
+    //
+    // The views are marked stale first, so no query is sent to them while the
+    // transaction runs. If it rolls back, they are refreshed again.
+    pub async fn drop_dependents(
+        &self,
+        tx: &mut PgConnection,
+        relation: &str,
+    ) -> Result<Vec<String>, sqlx::Error> {
+        let names: Vec<String> = sqlx::query_scalar(
+            "SELECT DISTINCT matview.relname::text FROM pg_depend \
+             JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid \
+             JOIN pg_class matview ON matview.oid = pg_rewrite.ev_class \
+             WHERE pg_depend.classid = 'pg_rewrite'::regclass \
+             AND pg_depend.refobjid = to_regclass($1) \
+             AND matview.relkind = 'm' AND matview.relname LIKE $2",
+        )
+        .bind(relation)
+        .bind(format!("{}%", VIEW_PREFIX.replace('_', "\\_")))
+        .fetch_all(&mut *tx)
+        .await?;
+
+        for view in self.views() {
+            if names.contains(&view.name) {
+                view.stale.store(true, Ordering::Relaxed);
+            }
+        }
+        for name in &names {
+            sqlx::query(&format!("DROP MATERIALIZED VIEW IF EXISTS {}", name))
+                .execute(&mut *tx)
+                .await?;
+        }
+        Ok(names)
+    }
+
+    // Forget views that were dropped with their table. Their queries start
+    // counting again, and get a view of the new table once they cross the
+    // thresholds.
+    pub fn forget(&self, names: &[String]) {
+        if names.is_empty() {
+            return;
+        }
+        self.tracked
+            .lock()
+            .unwrap()
+            .retain(|_, entry| match entry {
+                Tracked::Ready(view) => !names.contains(&view.name),
+                _ => true,
+            });
+    }
+
+    // Drop the views a previous run of the service left behind, since their
+    // queries are no longer tracked
+    pub async fn drop_orphans(&self) -> Result<(), sqlx::Error> {
+        let names: Vec<String> = sqlx::query_scalar(
+            "SELECT matviewname::text FROM pg_matviews WHERE matviewname LIKE $1",
+        )
+        .bind(format!("{}%", VIEW_PREFIX.replace('_', "\\_")))
+        .fetch_all(&self.pool)
+        .await?;
+        for name in names {
+            sqlx::query(&format!("DROP MATERIALIZED VIEW IF EXISTS {}", name))
+                .execute(&self.pool)
+                .await?;
+        }
+        Ok(())
+    }
+
+    // Refresh views in the background: stale ones as soon as possible, all
+    // of them every `refresh_interval`
+    //
+    // The change listener has a connection of its own, outside the pool, for
+    // as long as the service runs.
+    pub fn spawn_refresher(self: &Arc<Self>, database_url: String) {
+        if self.config.max_views == 0 {
+            return;
+        }
+
+        let manager = Arc::clone(self);
+        tokio::spawn(async move {
+            loop {
+                if let Err(e) = manager.listen(&database_url).await {
+                    tracing::warn!("Materialized view listener failed: {}", e);
+                }
+                // Changes may have been missed while disconnected
+                for view in manager.views() {
+                    view.stale.store(true, Ordering::Relaxed);
+                }
+                tokio::time::sleep(Duration::from_secs(1)).await;
+            }
+        });
+
+        let manager = Arc::clone(self);
+        tokio::spawn(async move {
+            let mut interval = tokio::time::interval(Duration::from_secs(1));
+            loop {
+                interval.tick().await;
+                for view in manager.views() {
+                    let due = view.refreshed.lock().unwrap().elapsed() >= manager.config.refresh_interval;
+                    if due || view.stale.load(Ordering::Relaxed) {
+                        manager.refresh(&view).await;
+                    }
+                }
+            }
+        });
+    }
+
+    async fn listen(&self, database_url: &str) -> Result<(), sqlx::Error> {
+        let mut listener = PgListener::connect(database_url).await?;
+        listener.listen(TABLE_CHANGED_CHANNEL).await?;
+
+        // try_recv returns None once the connection is lost
+        while let Some(notification) = listener.try_recv().await? {
+            self.mark_stale(notification.payload());
+        }
+        Ok(())
+    }
+}
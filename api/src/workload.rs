@@ -0,0 +1,178 @@
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::time::Duration;
+
+use axum::http::StatusCode;
+use moka::future::Cache;
+use serde_json::Value;
+use sqlx::{Executor, PgPool, Postgres};
+
+use crate::metrics;
+use crate::replicas::{ReadTarget, ReplicaSet};
+use crate::sql;
+
+// Which pool a query runs on, decided from its estimated cost
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Workload {
+    // Runs on the interactive pool, or a read replica
+    Interactive,
+    // Runs on a read replica within its heavy limit, or on the small heavy
+    // pool when no replica is usable, so it cannot take connections away from
+    // interactive queries
+    Heavy,
+}
+
+// The planner's estimates for a query, from EXPLAIN
+#[derive(Clone, Copy, Debug)]
+pub struct PlanEstimate {
+    pub cost: f64,
+    pub rows: f64,
+}
+
+// Cost thresholds, read from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct WorkloadConfig {
+    // Queries estimated above either of these are heavy
+    pub heavy_cost: f64,
+    pub heavy_rows: f64,
+    // Queries estimated above this are rejected
+    pub max_cost: f64,
+    pub plan_cache_ttl: Duration,
+}
+
+impl WorkloadConfig {
+    pub fn from_env() -> Self {
+        WorkloadConfig {
+            heavy_cost: crate::env_var("QUERY_HEAVY_COST", 100_000.0),
+            heavy_rows: crate::env_var("QUERY_HEAVY_ROWS", 1_000_000.0),
+            max_cost: crate::env_var("QUERY_MAX_COST", 10_000_000.0),
+            plan_cache_ttl: Duration::from_secs(crate::env_var("PLAN_CACHE_TTL_SECS", 300)),
+        }
+    }
+}
+
+// Classifies read-only queries by the cost the planner estimates for them,
+// before they run
+pub struct CostGuard {
+    config: WorkloadConfig,
+    // Estimates by query fingerprint
+    plans: Cache<String, PlanEstimate>,
+    heavy_pool: PgPool,
+    interactive: AtomicU64,
+    heavy: AtomicU64,
+    rejected: AtomicU64,
+}
+
+impl CostGuard {
+    pub fn new(config: WorkloadConfig, heavy_pool: PgPool) -> Self {
+        CostGuard {
+            plans: Cache::builder()
+                .max_capacity(10_000)
+                .time_to_live(config.plan_cache_ttl)
+                .build(),
+            config,
+            heavy_pool,
+            interactive: AtomicU64::new(0),
+            heavy: AtomicU64::new(0),
+            rejected: AtomicU64::new(0),
+        }
+    }
+
+    // Classify `query`, or reject it with an explanation if it is estimated to
+    // be too expensive to run at all
+    //
+    // Only read-only statements are explained; anything else is interactive.
+    pub async fn classify(&self, pool: &PgPool, query: &str) -> Result<Workload, (StatusCode, String)> {
+        let statement = match sql::read_only_statement(query) {
+            Ok(statement) => statement,
+            Err(_) => return Ok(Workload::Interactive),
+        };
+
+        let fingerprint = fingerprint(query, &statement);
+        let estimate = match self.plans.get(&fingerprint).await {
+            Some(estimate) => estimate,
+            None => {
+                let estimate = explain(pool, &statement).await?;
+                self.plans.insert(fingerprint, estimate).await;
+                estimate
+            }
+        };
+
+        if estimate.cost > self.config.max_cost {
+            self.rejected.fetch_add(1, Ordering::Relaxed);
+            return Err((
+                StatusCode::UNPROCESSABLE_ENTITY,
+                format!(
+                    "Query rejected: the planner estimates a cost of {:.0} and about {:.0} rows, \
+                     above the limit of {:.0}. Add filters, aggregate the result or add a LIMIT.",
+                    estimate.cost, estimate.rows, self.config.max_cost
+                ),
+            ));
+        }
+
+        if estimate.cost > self.config.heavy_cost || estimate.rows > self.config.heavy_rows {
+            self.heavy.fetch_add(1, Ordering::Relaxed);
+            Ok(Workload::Heavy)
+        } else {
+            self.interactive.fetch_add(1, Ordering::Relaxed);
+            Ok(Workload::Interactive)
+        }
+    }
+
+    // The planner's estimates for `query`, if it was classified recently
+    pub async fn estimate(&self, query: &str) -> Option<PlanEstimate> {
+        let statement = sql::read_only_statement(query).ok()?;
+        self.plans.get(&fingerprint(query, &statement)).await
+    }
+
+    // Where a query of the given workload runs
+    //
+    // Heavy queries go to a replica when one is healthy and within the lag
+    // bound, and to the heavy pool on the primary otherwise.
+    pub async fn target(&self, workload: Workload, replicas: &ReplicaSet, query: &str) -> ReadTarget {
+        match workload {
+            Workload::Interactive => replicas.route(query),
+            Workload::Heavy => match replicas.route_heavy(query).await {
+                Some(target) => target,
+                None => ReadTarget::from_pool(self.heavy_pool.clone()),
+            },
+        }
+    }
+
+    // Append the classification counts to a Prometheus text exposition
+    pub fn write_metrics(&self, out: &mut String) {
+        let name = "lucidata_queries_classified_total";
+        metrics::write_header(out, name, "Queries by workload class, from their estimated cost", "counter");
+        for (workload, count) in [
+            ("interactive", &self.interactive),
+            ("heavy", &self.heavy),
+            ("rejected", &self.rejected),
+        ] {
+            let labels = format!("workload=\"{}\"", workload);
+            metrics::write_sample(out, name, &labels, count.load(Ordering::Relaxed) as f64);
+        }
+    }
+}
+
+// Plans are cached by the canonical form of the query, when it has one
+fn fingerprint(query: &str, statement: &str) -> String {
+    sql::canonical_query(query)
+        .map(|canonical| canonical.sql)
+        .unwrap_or_else(|| statement.to_string())
+}
+
+// Ask the planner for its estimates for `statement`, without running it
+pub async fn explain<'c, E>(executor: E, statement: &str) -> Result<PlanEstimate, (StatusCode, String)>
+where
+    E: Executor<'c, Database = Postgres>,
+{
+    let plan: Value = sqlx::query_scalar(&format!("EXPLAIN (FORMAT JSON) {}", statement))
+        .fetch_one(executor)
+        .await
+        .map_err(|e| (StatusCode::BAD_REQUEST, format!("Query error: {}", e)))?;
+
+    let root = &plan[0]["Plan"];
+    Ok(PlanEstimate {
+        cost: root["Total Cost"].as_f64().unwrap_or(0.0),
+        rows: root["Plan Rows"].as_f64().unwrap_or(0.0),
+    })
+}
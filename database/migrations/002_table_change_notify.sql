@@ -0,0 +1,12 @@
+-- Notify listeners when a table changes, so the api can drop cached query
+-- results that read from it. The payload is the table name.
+CREATE OR REPLACE FUNCTION lucidata_notify_table_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('lucidata_table_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cars_notify_change
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cars
+    FOR EACH STATEMENT EXECUTE FUNCTION lucidata_notify_table_change();
@@ -0,0 +1,4 @@
+-- Execution statistics per normalized statement, which the api's index
+-- advisor weighs its recommendations with. The library is preloaded by the
+-- db service's command in docker-compose.yml.
+CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
@@ -0,0 +1,8 @@
+#!/bin/bash
+set -e
+
+# Allow streaming replication connections, so the db_replica service can
+# clone and follow this database
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
+
+echo "Replication connections enabled"
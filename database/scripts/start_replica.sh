@@ -0,0 +1,20 @@
+#!/bin/bash
+set -e
+
+# Start a streaming replica of the db service. On first start the data
+# directory is cloned from the primary with pg_basebackup, which also writes
+# the standby configuration.
+export PGPASSWORD="$POSTGRES_PASSWORD"
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    echo "Cloning primary into $PGDATA..."
+    mkdir -p "$PGDATA"
+    chown postgres:postgres "$PGDATA"
+    chmod 700 "$PGDATA"
+    until gosu postgres pg_basebackup -h db -U "$POSTGRES_USER" -D "$PGDATA" -X stream -R; do
+        echo "Waiting for the primary..."
+        sleep 1
+    done
+fi
+
+exec gosu postgres postgres
@@ -10,7 +10,10 @@ use axum::{
 };
 use serde::{Deserialize, Serialize};
 use serde_json::Value;
+use futures::StreamExt;
 use tower_http::cors::{CorsLayer, Any};
+use tower_http::compression::predicate::{NotForContentType, Predicate, SizeAbove};
+use tower_http::compression::{CompressionLayer, CompressionLevel};
 use tracing::{info, error};
 use tracing_subscriber::{layer::SubscriberExt, util::SubscriberInitExt};
 use anyhow::Result;
@@ -34,6 +37,13 @@ struct QueryRequest {
     model: Option<String>,
 }
 
+// Request model for translating several queries at once
+#[derive(Deserialize)]
+struct BatchQueryRequest {
+    queries: Vec<String>,
+    model: Option<String>,
+}
+
 // Request model for visualization generation
 #[derive(Deserialize)]
 struct VisualizationRequest {
@@ -50,6 +60,19 @@ struct QueryResponse {
     confidence: Option<f64>,
 }
 
+// Response model for a batch, with one entry per query in request order
+#[derive(Serialize)]
+struct BatchQueryResponse {
+    results: Vec<BatchQueryResult>,
+}
+
+#[derive(Serialize)]
+#[serde(untagged)]
+enum BatchQueryResult {
+    Ok(QueryResponse),
+    Err { error: String },
+}
+
 // Response model for visualization generation
 #[derive(Serialize)]
 struct VisualizationResponse {
@@ -127,6 +150,53 @@ async fn process_query(
     }
 }
 
+// Process several queries, sharing one schema fetch between them
+//
+// Up to LLM_BATCH_PARALLELISM queries are sent to the LLM at the same time. A
+// query that fails gets an error entry instead of failing the whole batch.
+async fn process_queries(
+    State(_state): State<Arc<AppState>>,
+    Json(request): Json<BatchQueryRequest>,
+) -> Result<impl IntoResponse, AppError> {
+    info!("Processing batch of {} queries", request.queries.len());
+    
+    let db_schema = get_database_schema().await.map_err(|e| {
+        let error_msg = format!("Error getting database schema: {}", e);
+        error!("{}", error_msg);
+        AppError::InternalError(error_msg)
+    })?;
+    
+    let parallelism = env::var("LLM_BATCH_PARALLELISM")
+        .ok()
+        .and_then(|p| p.parse::<usize>().ok())
+        .unwrap_or(4)
+        .max(1);
+    
+    let results = futures::stream::iter(request.queries)
+        .map(|query| {
+            let (model, db_schema) = (request.model.clone(), db_schema.clone());
+            async move {
+                match process_natural_language_query(query, model, Some(db_schema)).await {
+                    Ok(result) => BatchQueryResult::Ok(QueryResponse {
+                        sql_query: result.sql_query,
+                        explanation: result.explanation,
+                        confidence: result.confidence,
+                    }),
+                    Err(e) => {
+                        let error_msg = format!("Error processing query: {}", e);
+                        error!("{}", error_msg);
+                        BatchQueryResult::Err { error: error_msg }
+                    }
+                }
+            }
+        })
+        .buffered(parallelism)
+        .collect::<Vec<_>>()
+        .await;
+    
+    Ok(Json(BatchQueryResponse { results }))
+}
+
 // Process visualization request
 async fn generate_visualization(
     State(_state): State<Arc<AppState>>,
@@ -325,6 +395,37 @@ fn parse_visualization_response(response: &str) -> (String, String, f64) {
     (html_code, explanation, confidence)
 }
 
+// Response compression, negotiated with the Accept-Encoding header
+//
+// Responses smaller than COMPRESSION_MIN_BYTES are sent as they are, and so are
+// images and event streams. COMPRESSION_LEVEL is "fastest", "best" or a number
+// on each algorithm's own scale.
+fn compression_layer() -> CompressionLayer<impl Predicate> {
+    let min_bytes = env::var("COMPRESSION_MIN_BYTES")
+        .ok()
+        .and_then(|b| b.parse::<u16>().ok())
+        .unwrap_or(1024);
+    let level = match env::var("COMPRESSION_LEVEL").unwrap_or_default().trim() {
+        "fastest" => CompressionLevel::Fastest,
+        "best" => CompressionLevel::Best,
+        level => level
+            .parse()
+            .map(CompressionLevel::Precise)
+            .unwrap_or(CompressionLevel::Default),
+    };
+    
+    let predicate = SizeAbove::new(min_bytes)
+        .and(NotForContentType::IMAGES)
+        .and(NotForContentType::const_new("text/event-stream"));
+    
+    CompressionLayer::new()
+        .gzip(true)
+        .br(true)
+        .zstd(true)
+        .quality(level)
+        .compress_when(predicate)
+}
+
 #[tokio::main]
 async fn main() {
     // Load environment variables
@@ -346,6 +447,7 @@ async fn main() {
         .route("/", get(root))
         .route("/health", get(health_check))
         .route("/process-query", post(process_query))
+        .route("/process-queries", post(process_queries))
         .route("/generate", post(generate_visualization))
         .layer(
             CorsLayer::new()
@@ -353,6 +455,7 @@ async fn main() {
                 .allow_headers(Any)
                 .allow_methods(Any)
         )
+        .layer(compression_layer())
         .with_state(state);
         
     // Get the port from environment or use default
@@ -0,0 +1,694 @@
+use std::collections::VecDeque;
+use std::env;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::{Arc, RwLock};
+use std::time::{Duration, Instant};
+
+use chrono::{DateTime, Utc};
+use moka::future::Cache;
+use serde::Serialize;
+use tokio::sync::Mutex;
+use tokio_postgres::{Client, NoTls};
+use tracing::{info, warn};
+
+use crate::metrics::{self, Histogram};
+use crate::semantic::{self, Mismatch, SemanticIndex, SemanticMatch};
+
+// Semantic hits kept for review
+const AUDIT_LENGTH: usize = 100;
+
+// Whether a question was answered from the translation cache
+#[derive(Clone, Copy, Debug, PartialEq, Eq, Serialize)]
+#[serde(rename_all = "lowercase")]
+pub enum CacheStatus {
+    Hit,
+    Miss,
+}
+
+// The LLM engine's answer for a question, as kept by the cache
+#[derive(Clone, Debug)]
+pub struct CachedTranslation {
+    pub sql_query: String,
+    pub explanation: String,
+    pub confidence: f64,
+}
+
+// Size of the translation cache and how often the schema is checked, read
+// from the environment
+#[derive(Clone, Copy, Debug)]
+pub struct CacheConfig {
+    // Translations held in memory; 0 disables the cache
+    pub capacity: u64,
+    pub schema_check_interval: Duration,
+    // Least similarity at which a differently worded question reuses a
+    // cached translation; above 1 only exact matches are reused
+    pub similarity: f64,
+}
+
+impl CacheConfig {
+    pub fn from_env() -> Self {
+        CacheConfig {
+            capacity: env::var("TRANSLATION_CACHE_CAPACITY")
+                .ok()
+                .and_then(|c| c.parse().ok())
+                .unwrap_or(1000),
+            schema_check_interval: env::var("TRANSLATION_CACHE_SCHEMA_CHECK_SECS")
+                .ok()
+                .and_then(|s| s.parse().ok())
+                .map(Duration::from_secs)
+                .unwrap_or(Duration::from_secs(30)),
+            similarity: env::var("TRANSLATION_CACHE_SIMILARITY")
+                .ok()
+                .and_then(|s| s.parse().ok())
+                .unwrap_or(0.8),
+        }
+    }
+}
+
+// A translation found in the cache
+pub struct CacheHit {
+    pub translation: CachedTranslation,
+    // The cached question whose translation was reused, when it was worded
+    // differently from the one asked
+    pub semantic: Option<SemanticMatch>,
+}
+
+// A semantic hit and whether its SQL then ran, kept to review false hits
+#[derive(Clone, Debug, Serialize)]
+pub struct AuditEntry {
+    pub natural_query: String,
+    pub matched_query: String,
+    pub similarity: f64,
+    pub sql_query: String,
+    pub succeeded: bool,
+    pub at: DateTime<Utc>,
+}
+
+// Schema fingerprint, model and normalized question
+type Key = (String, String, String);
+
+// Translations are persisted outside the public schema, so the LLM engine
+// never sees the table and it does not change the fingerprint
+const CREATE_TABLE: &str = "
+    CREATE SCHEMA IF NOT EXISTS query_router;
+    CREATE TABLE IF NOT EXISTS query_router.translations (
+        schema_fingerprint TEXT NOT NULL,
+        model TEXT NOT NULL,
+        natural_query TEXT NOT NULL,
+        sql_query TEXT NOT NULL,
+        explanation TEXT NOT NULL,
+        confidence DOUBLE PRECISION NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (schema_fingerprint, model, natural_query)
+    );
+";
+
+// Caches the SQL the LLM engine generated for each question, so asking the
+// same question again skips the LLM
+//
+// Questions are normalized before lookup, so differences in case, spacing,
+// punctuation and spelled-out numbers do not matter. Questions without an
+// exact match are looked up by similarity in a semantic index, and reuse the
+// translation of a similar question that mentions the same columns and
+// numbers. Translations are kept in memory in front of a table in Postgres,
+// which survives restarts. Every entry belongs to the schema it was generated
+// for: when the tables or columns in the public schema change, the old
+// entries are dropped.
+pub struct TranslationCache {
+    config: CacheConfig,
+    db_url: String,
+    memory: Cache<Key, CachedTranslation>,
+    index: std::sync::Mutex<SemanticIndex>,
+    // Reconnected when the connection is lost
+    client: Mutex<Option<Arc<Client>>>,
+    // None until the schema could be read; nothing is cached meanwhile
+    fingerprint: RwLock<Option<String>>,
+    // Lowercase table and column names of the public schema
+    names: RwLock<Vec<String>>,
+    audit: std::sync::Mutex<VecDeque<AuditEntry>>,
+    exact_hits: AtomicU64,
+    semantic_hits: AtomicU64,
+    misses: AtomicU64,
+    column_mismatches: AtomicU64,
+    number_mismatches: AtomicU64,
+    direction_mismatches: AtomicU64,
+    semantic_failures: AtomicU64,
+    lookup_latency: Histogram,
+}
+
+impl TranslationCache {
+    pub fn new(config: CacheConfig, db_url: String) -> Self {
+        TranslationCache {
+            memory: Cache::new(config.capacity),
+            index: std::sync::Mutex::new(SemanticIndex::new(config.capacity as usize)),
+            config,
+            db_url,
+            client: Mutex::new(None),
+            fingerprint: RwLock::new(None),
+            names: RwLock::new(Vec::new()),
+            audit: std::sync::Mutex::new(VecDeque::new()),
+            exact_hits: AtomicU64::new(0),
+            semantic_hits: AtomicU64::new(0),
+            misses: AtomicU64::new(0),
+            column_mismatches: AtomicU64::new(0),
+            number_mismatches: AtomicU64::new(0),
+            direction_mismatches: AtomicU64::new(0),
+            semantic_failures: AtomicU64::new(0),
+            lookup_latency: Histogram::new(metrics::LOOKUP_BUCKETS),
+        }
+    }
+
+    // The cached translation of `question` for `model`, or of a question
+    // similar enough to it, if there is one
+    pub async fn get(&self, question: &str, model: &str) -> Option<CacheHit> {
+        let start = Instant::now();
+        let hit = self.lookup(question, model).await;
+        self.lookup_latency.observe(start.elapsed());
+
+        let counter = match &hit {
+            Some(CacheHit { semantic: None, .. }) => &self.exact_hits,
+            Some(CacheHit {
+                semantic: Some(_), ..
+            }) => &self.semantic_hits,
+            None => &self.misses,
+        };
+        counter.fetch_add(1, Ordering::Relaxed);
+        hit
+    }
+
+    async fn lookup(&self, question: &str, model: &str) -> Option<CacheHit> {
+        let key = self.key(question, model)?;
+        if let Some(translation) = self.exact(&key).await {
+            return Some(CacheHit {
+                translation,
+                semantic: None,
+            });
+        }
+
+        let candidates = self
+            .index
+            .lock()
+            .unwrap()
+            .search(model, &key.2, self.config.similarity);
+        let names = self.names.read().unwrap();
+        for (found, translation) in candidates {
+            match semantic::mismatch(&key.2, &found.natural_query, &names) {
+                Some(Mismatch::Columns) => self.column_mismatches.fetch_add(1, Ordering::Relaxed),
+                Some(Mismatch::Numbers) => self.number_mismatches.fetch_add(1, Ordering::Relaxed),
+                Some(Mismatch::Direction) => {
+                    self.direction_mismatches.fetch_add(1, Ordering::Relaxed)
+                }
+                None => {
+                    return Some(CacheHit {
+                        translation,
+                        semantic: Some(found),
+                    })
+                }
+            };
+        }
+        None
+    }
+
+    // The translation cached under exactly `key`
+    async fn exact(&self, key: &Key) -> Option<CachedTranslation> {
+        if let Some(translation) = self.memory.get(key).await {
+            return Some(translation);
+        }
+
+        let row =
+            match self.client().await {
+                Ok(client) => client
+                    .query_opt(
+                        "SELECT sql_query, explanation, confidence FROM query_router.translations \
+                     WHERE schema_fingerprint = $1 AND model = $2 AND natural_query = $3",
+                        &[&key.0, &key.1, &key.2],
+                    )
+                    .await,
+                Err(e) => Err(e),
+            };
+        let translation = match row {
+            Ok(row) => row.map(|row| CachedTranslation {
+                sql_query: row.get(0),
+                explanation: row.get(1),
+                confidence: row.get(2),
+            })?,
+            Err(e) => {
+                warn!("Failed to read the translation cache: {}", e);
+                return None;
+            }
+        };
+        self.memory.insert(key.clone(), translation.clone()).await;
+        Some(translation)
+    }
+
+    // Remember the translation of `question` for `model`
+    pub async fn insert(&self, question: &str, model: &str, translation: CachedTranslation) {
+        let key = match self.key(question, model) {
+            Some(key) => key,
+            None => return,
+        };
+
+        let stored = match self.client().await {
+            Ok(client) => client
+                .execute(
+                    "INSERT INTO query_router.translations \
+                     (schema_fingerprint, model, natural_query, sql_query, explanation, confidence) \
+                     VALUES ($1, $2, $3, $4, $5, $6) \
+                     ON CONFLICT (schema_fingerprint, model, natural_query) DO UPDATE \
+                     SET sql_query = EXCLUDED.sql_query, explanation = EXCLUDED.explanation, \
+                         confidence = EXCLUDED.confidence, created_at = now()",
+                    &[
+                        &key.0,
+                        &key.1,
+                        &key.2,
+                        &translation.sql_query,
+                        &translation.explanation,
+                        &translation.confidence,
+                    ],
+                )
+                .await,
+            Err(e) => Err(e),
+        };
+        if let Err(e) = stored {
+            warn!("Failed to store a translation: {}", e);
+        }
+        self.index
+            .lock()
+            .unwrap()
+            .insert(&key.1, &key.2, translation.clone());
+        self.memory.insert(key, translation).await;
+    }
+
+    // Record whether the SQL of a semantic hit ran; one that failed most
+    // likely did not answer the question
+    pub fn audit(&self, question: &str, found: &SemanticMatch, sql_query: &str, succeeded: bool) {
+        if !succeeded {
+            self.semantic_failures.fetch_add(1, Ordering::Relaxed);
+        }
+        let mut audit = self.audit.lock().unwrap();
+        if audit.len() == AUDIT_LENGTH {
+            audit.pop_back();
+        }
+        audit.push_front(AuditEntry {
+            natural_query: question.to_string(),
+            matched_query: found.natural_query.clone(),
+            similarity: found.similarity,
+            sql_query: sql_query.to_string(),
+            succeeded,
+            at: Utc::now(),
+        });
+    }
+
+    // The most recent semantic hits, newest first
+    pub fn recent_semantic_hits(&self) -> Vec<AuditEntry> {
+        self.audit.lock().unwrap().iter().cloned().collect()
+    }
+
+    // Append the cache's counters to a Prometheus text exposition
+    pub fn write_metrics(&self, out: &mut String) {
+        let name = "lucidata_translation_cache_lookups_total";
+        metrics::write_header(out, name, "Translation cache lookups by result", "counter");
+        for (result, count) in [
+            ("exact", &self.exact_hits),
+            ("semantic", &self.semantic_hits),
+            ("miss", &self.misses),
+        ] {
+            let labels = format!("result=\"{}\"", result);
+            metrics::write_sample(out, name, &labels, count.load(Ordering::Relaxed) as f64);
+        }
+
+        let name = "lucidata_translation_cache_semantic_rejections_total";
+        metrics::write_header(
+            out,
+            name,
+            "Similar cached questions not reused, by the check they failed",
+            "counter",
+        );
+        for (mismatch, count) in [
+            (Mismatch::Columns, &self.column_mismatches),
+            (Mismatch::Numbers, &self.number_mismatches),
+            (Mismatch::Direction, &self.direction_mismatches),
+        ] {
+            let labels = format!("check=\"{}\"", mismatch.as_str());
+            metrics::write_sample(out, name, &labels, count.load(Ordering::Relaxed) as f64);
+        }
+
+        let name = "lucidata_translation_cache_semantic_failures_total";
+        metrics::write_header(
+            out,
+            name,
+            "Semantic hits whose SQL failed to run",
+            "counter",
+        );
+        metrics::write_sample(
+            out,
+            name,
+            "",
+            self.semantic_failures.load(Ordering::Relaxed) as f64,
+        );
+
+        let name = "lucidata_translation_cache_entries";
+        metrics::write_header(out, name, "Questions in the semantic index", "gauge");
+        metrics::write_sample(out, name, "", self.index.lock().unwrap().len() as f64);
+
+        let name = "lucidata_translation_cache_lookup_seconds";
+        metrics::write_header(
+            out,
+            name,
+            "Time to look up a question in the translation cache",
+            "histogram",
+        );
+        self.lookup_latency.write_samples(out, name, "");
+    }
+
+    fn key(&self, question: &str, model: &str) -> Option<Key> {
+        let fingerprint = self.fingerprint.read().unwrap().clone()?;
+        Some((fingerprint, model.to_string(), normalize(question)))
+    }
+
+    // Fingerprint the schema every `schema_check_interval`, and drop the
+    // translations made for an older schema when it changes
+    pub fn spawn_schema_watch(self: &Arc<Self>) {
+        let cache = Arc::clone(self);
+        tokio::spawn(async move {
+            let mut interval = tokio::time::interval(cache.config.schema_check_interval);
+            loop {
+                interval.tick().await;
+                if let Err(e) = cache.check_schema().await {
+                    warn!("Failed to fingerprint the database schema: {}", e);
+                }
+            }
+        });
+    }
+
+    async fn check_schema(&self) -> Result<(), tokio_postgres::Error> {
+        let client = self.client().await?;
+        let columns = client
+            .query(
+                "SELECT table_name::text, column_name::text, data_type::text, is_nullable::text \
+                 FROM information_schema.columns WHERE table_schema = 'public' \
+                 ORDER BY table_name, ordinal_position",
+                &[],
+            )
+            .await?;
+
+        let mut hash = FNV_OFFSET;
+        for row in &columns {
+            for i in 0..4 {
+                let field: &str = row.get(i);
+                hash = fnv1a(hash, field.as_bytes());
+                hash = fnv1a(hash, &[0]);
+            }
+        }
+        let fingerprint = format!("{:016x}", hash);
+
+        if self.fingerprint.read().unwrap().as_deref() == Some(fingerprint.as_str()) {
+            return Ok(());
+        }
+        let mut names: Vec<String> = columns
+            .iter()
+            .flat_map(|row| [row.get::<_, &str>(0), row.get::<_, &str>(1)])
+            .map(str::to_lowercase)
+            .collect();
+        names.sort();
+        names.dedup();
+        let deleted = client
+            .execute(
+                "DELETE FROM query_router.translations WHERE schema_fingerprint <> $1",
+                &[&fingerprint],
+            )
+            .await?;
+        info!(
+            "Database schema fingerprint is {}, dropped {} cached translations for older schemas",
+            fingerprint, deleted
+        );
+        // Questions asked before a restart can be matched by similarity again
+        let rows = client
+            .query(
+                "SELECT model, natural_query, sql_query, explanation, confidence \
+                 FROM query_router.translations WHERE schema_fingerprint = $1 \
+                 ORDER BY created_at DESC LIMIT $2",
+                &[&fingerprint, &(self.config.capacity as i64)],
+            )
+            .await?;
+        {
+            let mut index = self.index.lock().unwrap();
+            index.clear();
+            // Oldest first, so the newest are kept if the index fills up
+            for row in rows.iter().rev() {
+                let translation = CachedTranslation {
+                    sql_query: row.get(2),
+                    explanation: row.get(3),
+                    confidence: row.get(4),
+                };
+                index.insert(row.get(0), row.get(1), translation);
+            }
+        }
+
+        *self.fingerprint.write().unwrap() = Some(fingerprint);
+        *self.names.write().unwrap() = names;
+        self.memory.invalidate_all();
+        Ok(())
+    }
+
+    async fn client(&self) -> Result<Arc<Client>, tokio_postgres::Error> {
+        let mut slot = self.client.lock().await;
+        if let Some(client) = slot.as_ref().filter(|client| !client.is_closed()) {
+            return Ok(Arc::clone(client));
+        }
+
+        let (new_client, connection) = tokio_postgres::connect(&self.db_url, NoTls).await?;
+        tokio::spawn(async move {
+            if let Err(e) = connection.await {
+                warn!("Translation cache connection error: {}", e);
+            }
+        });
+        new_client.batch_execute(CREATE_TABLE).await?;
+
+        let new_client = Arc::new(new_client);
+        *slot = Some(Arc::clone(&new_client));
+        Ok(new_client)
+    }
+}
+
+pub const FNV_OFFSET: u64 = 0xcbf29ce484222325;
+
+pub fn fnv1a(mut hash: u64, bytes: &[u8]) -> u64 {
+    for byte in bytes {
+        hash ^= *byte as u64;
+        hash = hash.wrapping_mul(0x100000001b3);
+    }
+    hash
+}
+
+// Reduce a question to the form it is cached under
+//
+// Lowercases it, drops apostrophes, turns other punctuation into spaces,
+// collapses whitespace and writes spelled-out numbers as digits, so "Show me
+// the top Five cars!" and "show me the top 5 cars" share a translation.
+// Decimal points and thousands separators inside numbers are kept apart from
+// other punctuation.
+pub fn normalize(question: &str) -> String {
+    let chars: Vec<char> = question.to_lowercase().chars().collect();
+    let digit = |i: usize| chars.get(i).map_or(false, char::is_ascii_digit);
+
+    let mut cleaned = String::with_capacity(chars.len());
+    for (i, &c) in chars.iter().enumerate() {
+        let in_number = i > 0 && digit(i - 1) && digit(i + 1);
+        match c {
+            c if c.is_alphanumeric() => cleaned.push(c),
+            '.' if in_number => cleaned.push(c),
+            // 1,000 is one thousand, but 1,2 is a list
+            ',' if in_number && (1..=3).all(|k| digit(i + k)) && !digit(i + 4) => {}
+            '\'' | '\u{2019}' => {}
+            _ => cleaned.push(' '),
+        }
+    }
+
+    let mut words: Vec<String> = Vec::new();
+    let mut number = SpelledNumber::default();
+    for word in cleaned.split_whitespace() {
+        match number_word(word) {
+            Some(NumberWord::Value(value)) => {
+                if !number.continues_with(value) {
+                    number.flush(&mut words);
+                }
+                number.add(value);
+            }
+            Some(NumberWord::Scale(scale)) if number.started => number.scale(scale),
+            _ => {
+                number.flush(&mut words);
+                words.push(word.to_string());
+            }
+        }
+    }
+    number.flush(&mut words);
+    words.join(" ")
+}
+
+enum NumberWord {
+    Value(u64),
+    Scale(u64),
+}
+
+fn number_word(word: &str) -> Option<NumberWord> {
+    let value = match word {
+        "zero" => 0,
+        "one" => 1,
+        "two" => 2,
+        "three" => 3,
+        "four" => 4,
+        "five" => 5,
+        "six" => 6,
+        "seven" => 7,
+        "eight" => 8,
+        "nine" => 9,
+        "ten" => 10,
+        "eleven" => 11,
+        "twelve" => 12,
+        "thirteen" => 13,
+        "fourteen" => 14,
+        "fifteen" => 15,
+        "sixteen" => 16,
+        "seventeen" => 17,
+        "eighteen" => 18,
+        "nineteen" => 19,
+        "twenty" => 20,
+        "thirty" => 30,
+        "forty" => 40,
+        "fifty" => 50,
+        "sixty" => 60,
+        "seventy" => 70,
+        "eighty" => 80,
+        "ninety" => 90,
+        "hundred" => return Some(NumberWord::Scale(100)),
+        "thousand" => return Some(NumberWord::Scale(1_000)),
+        "million" => return Some(NumberWord::Scale(1_000_000)),
+        _ => return None,
+    };
+    Some(NumberWord::Value(value))
+}
+
+// A number being read from consecutive number words, e.g. "two hundred
+// fifty"
+#[derive(Default)]
+struct SpelledNumber {
+    started: bool,
+    // Completed thousands and millions
+    total: u64,
+    // Below the last scale word
+    current: u64,
+    // The last word, unless it was a scale word
+    last: Option<u64>,
+}
+
+impl SpelledNumber {
+    // Whether `value` is part of this number, as in "twenty one" or "two
+    // hundred five", rather than the start of the next, as in "five six" or
+    // "twenty thirty"
+    fn continues_with(&self, value: u64) -> bool {
+        match self.last {
+            Some(last) if self.started => last >= 20 && last % 10 == 0 && (1..10).contains(&value),
+            _ => true,
+        }
+    }
+
+    fn add(&mut self, value: u64) {
+        self.started = true;
+        self.current += value;
+        self.last = Some(value);
+    }
+
+    fn scale(&mut self, scale: u64) {
+        self.last = None;
+        let current = self.current.max(1);
+        if scale == 100 {
+            self.current = current * 100;
+        } else {
+            self.total += current * scale;
+            self.current = 0;
+        }
+    }
+
+    fn flush(&mut self, words: &mut Vec<String>) {
+        if self.started {
+            words.push((self.total + self.current).to_string());
+        }
+        *self = SpelledNumber::default();
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn normalizes_case_punctuation_and_spacing() {
+        assert_eq!(
+            normalize("Show me the top Five cars!"),
+            "show me the top 5 cars"
+        );
+        assert_eq!(
+            normalize("  What's the\tavg.   MPG?\n"),
+            "whats the avg mpg"
+        );
+        assert_eq!(normalize("Porsche\u{2019}s HP"), "porsches hp");
+        assert_eq!(
+            normalize("cars (by cyl) -- \"fast\" ones"),
+            "cars by cyl fast ones"
+        );
+        assert_eq!(normalize("ÉCLAIR"), "éclair");
+        assert_eq!(normalize("?!"), "");
+    }
+
+    #[test]
+    fn keeps_numbers_together() {
+        assert_eq!(normalize("mpg > 20.5"), "mpg 20.5");
+        assert_eq!(normalize("over 1,000 hp"), "over 1000 hp");
+        assert_eq!(normalize("1,000,000 rows"), "1000000 rows");
+        // Lists and trailing punctuation are not part of the number
+        assert_eq!(normalize("cyl 4,6"), "cyl 4 6");
+        assert_eq!(normalize("ids 1,2345"), "ids 1 2345");
+        assert_eq!(normalize("top 5."), "top 5");
+        assert_eq!(normalize("version .5"), "version 5");
+    }
+
+    #[test]
+    fn writes_spelled_numbers_as_digits() {
+        assert_eq!(normalize("two hundred fifty cars"), "250 cars");
+        assert_eq!(normalize("one thousand two hundred"), "1200");
+        assert_eq!(normalize("three million rows"), "3000000 rows");
+        assert_eq!(normalize("top ten, then five"), "top 10 then 5");
+        assert_eq!(normalize("twenty-one"), "21");
+        assert_eq!(normalize("five thousand six hundred and two"), "5600 and 2");
+        assert_eq!(normalize("two thousand five"), "2005");
+        // A scale word on its own is just a word
+        assert_eq!(normalize("a hundred cars"), "a hundred cars");
+        assert_eq!(normalize("someone"), "someone");
+    }
+
+    #[test]
+    fn keeps_consecutive_numbers_apart() {
+        assert_eq!(
+            normalize("top five six cylinder cars"),
+            "top 5 6 cylinder cars"
+        );
+        assert_eq!(normalize("four six"), "4 6");
+        assert_eq!(normalize("eleven five"), "11 5");
+        assert_eq!(normalize("five twenty"), "5 20");
+        assert_eq!(normalize("twenty thirty"), "20 30");
+        assert_eq!(normalize("twenty one two"), "21 2");
+        assert_eq!(normalize("one hundred twenty three four"), "123 4");
+        assert_eq!(normalize("zero zero"), "0 0");
+    }
+
+    #[test]
+    fn fnv1a_matches_the_reference_values() {
+        assert_eq!(fnv1a(FNV_OFFSET, b""), 0xcbf29ce484222325);
+        assert_eq!(fnv1a(FNV_OFFSET, b"a"), 0xaf63dc4c8601ec8c);
+        assert_eq!(
+            fnv1a(fnv1a(FNV_OFFSET, b"foo"), b"bar"),
+            fnv1a(FNV_OFFSET, b"foobar")
+        );
+    }
+}
@@ -0,0 +1,242 @@
+use std::collections::HashMap;
+use std::future::Future;
+use std::hash::Hash;
+use std::sync::{Arc, Mutex};
+
+use futures::future::{BoxFuture, FutureExt, Shared};
+use tokio::task::AbortHandle;
+
+struct Flight<V> {
+    id: u64,
+    result: Shared<BoxFuture<'static, V>>,
+    // Callers awaiting the result
+    waiters: usize,
+    abort: AbortHandle,
+}
+
+struct Flights<K, V> {
+    next_id: u64,
+    by_key: HashMap<K, Flight<V>>,
+}
+
+// Runs one computation per key at a time, and hands its result to every
+// caller that asked for the same key while it was running
+//
+// The computation runs in its own task, so the caller that started it can go
+// away without cancelling it for the others. It is only cancelled once every
+// caller waiting for it has gone away.
+pub struct Singleflight<K, V> {
+    flights: Mutex<Flights<K, V>>,
+}
+
+impl<K, V> Singleflight<K, V>
+where
+    K: Hash + Eq + Clone + Send + Sync + 'static,
+    V: Clone + Send + Sync + 'static,
+{
+    pub fn new() -> Self {
+        Singleflight {
+            flights: Mutex::new(Flights {
+                next_id: 0,
+                by_key: HashMap::new(),
+            }),
+        }
+    }
+
+    // The result of `work`, or of the computation already running for `key`,
+    // in which case `work` is dropped without running
+    pub async fn run<F>(self: &Arc<Self>, key: K, work: F) -> V
+    where
+        F: Future<Output = V> + Send + 'static,
+    {
+        let (id, result) = {
+            let mut flights = self.flights.lock().unwrap();
+            match flights.by_key.get_mut(&key) {
+                Some(flight) => {
+                    flight.waiters += 1;
+                    (flight.id, flight.result.clone())
+                }
+                None => {
+                    let id = flights.next_id;
+                    flights.next_id += 1;
+
+                    let (group, finished_key) = (Arc::clone(self), key.clone());
+                    let task = tokio::spawn(async move {
+                        let value = work.await;
+                        // Callers arriving from now on start a new computation
+                        group.remove(&finished_key, id);
+                        value
+                    });
+                    let abort = task.abort_handle();
+                    let result = task
+                        .map(|joined| joined.expect("coalesced computation panicked"))
+                        .boxed()
+                        .shared();
+
+                    flights.by_key.insert(
+                        key.clone(),
+                        Flight {
+                            id,
+                            result: result.clone(),
+                            waiters: 1,
+                            abort,
+                        },
+                    );
+                    (id, result)
+                }
+            }
+        };
+
+        let _waiter = Waiter {
+            group: self,
+            key: &key,
+            id,
+        };
+        result.await
+    }
+
+    fn remove(&self, key: &K, id: u64) {
+        let mut flights = self.flights.lock().unwrap();
+        if flights.by_key.get(key).map(|flight| flight.id) == Some(id) {
+            flights.by_key.remove(key);
+        }
+    }
+}
+
+// Counts a caller out of a computation when it stops waiting, whether it got
+// the result or was cancelled
+struct Waiter<'a, K, V>
+where
+    K: Hash + Eq,
+{
+    group: &'a Singleflight<K, V>,
+    key: &'a K,
+    id: u64,
+}
+
+impl<K, V> Drop for Waiter<'_, K, V>
+where
+    K: Hash + Eq,
+{
+    fn drop(&mut self) {
+        let mut flights = self.group.flights.lock().unwrap();
+        let flight = match flights.by_key.get_mut(self.key) {
+            Some(flight) if flight.id == self.id => flight,
+            // Already finished
+            _ => return,
+        };
+        flight.waiters -= 1;
+        if flight.waiters == 0 {
+            // Nobody wants the result any more
+            flight.abort.abort();
+            flights.by_key.remove(self.key);
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::atomic::{AtomicBool, AtomicUsize, Ordering};
+    use std::time::Duration;
+
+    type Group = Arc<Singleflight<&'static str, Result<u32, String>>>;
+
+    // Work that counts its runs and takes a little while to produce `value`
+    fn work(
+        runs: &Arc<AtomicUsize>,
+        value: Result<u32, String>,
+    ) -> impl Future<Output = Result<u32, String>> + Send + 'static {
+        let runs = Arc::clone(runs);
+        async move {
+            runs.fetch_add(1, Ordering::SeqCst);
+            tokio::time::sleep(Duration::from_millis(50)).await;
+            value
+        }
+    }
+
+    #[tokio::test]
+    async fn shares_one_execution_between_concurrent_callers() {
+        let group: Group = Arc::new(Singleflight::new());
+        let runs = Arc::new(AtomicUsize::new(0));
+
+        let results = tokio::join!(
+            group.run("top cars", work(&runs, Ok(1))),
+            group.run("top cars", work(&runs, Ok(2))),
+            group.run("top cars", work(&runs, Ok(3))),
+        );
+        assert_eq!(results, (Ok(1), Ok(1), Ok(1)));
+        assert_eq!(runs.load(Ordering::SeqCst), 1);
+
+        // Other keys, and callers after the computation finished, run their own
+        let results = tokio::join!(
+            group.run("top cars", work(&runs, Ok(4))),
+            group.run("slow cars", work(&runs, Ok(5))),
+        );
+        assert_eq!(results, (Ok(4), Ok(5)));
+        assert_eq!(runs.load(Ordering::SeqCst), 3);
+    }
+
+    #[tokio::test]
+    async fn hands_errors_to_every_waiter() {
+        let group: Group = Arc::new(Singleflight::new());
+        let runs = Arc::new(AtomicUsize::new(0));
+
+        let error = Err("relation \"cars\" does not exist".to_string());
+        let results = tokio::join!(
+            group.run("top cars", work(&runs, error.clone())),
+            group.run("top cars", work(&runs, Ok(2))),
+        );
+        assert_eq!(results, (error.clone(), error));
+        assert_eq!(runs.load(Ordering::SeqCst), 1);
+    }
+
+    #[tokio::test]
+    async fn keeps_running_while_anyone_waits() {
+        let group: Group = Arc::new(Singleflight::new());
+        let runs = Arc::new(AtomicUsize::new(0));
+        let caller = |value| {
+            let (group, computation) = (Arc::clone(&group), work(&runs, Ok(value)));
+            tokio::spawn(async move { group.run("top cars", computation).await })
+        };
+
+        let first = caller(1);
+        tokio::time::sleep(Duration::from_millis(10)).await;
+        let second = caller(2);
+        tokio::time::sleep(Duration::from_millis(10)).await;
+
+        // The caller that started the computation goes away
+        first.abort();
+        assert_eq!(second.await.unwrap(), Ok(1));
+        assert_eq!(runs.load(Ordering::SeqCst), 1);
+    }
+
+    #[tokio::test]
+    async fn cancels_once_every_waiter_has_gone() {
+        let group: Group = Arc::new(Singleflight::new());
+        let finished = Arc::new(AtomicBool::new(false));
+
+        let slow = {
+            let finished = Arc::clone(&finished);
+            async move {
+                tokio::time::sleep(Duration::from_millis(50)).await;
+                finished.store(true, Ordering::SeqCst);
+                Ok(1)
+            }
+        };
+        let waiting = async {
+            tokio::join!(
+                group.run("top cars", slow),
+                group.run("top cars", async { Ok(2) }),
+            )
+        };
+        assert!(tokio::time::timeout(Duration::from_millis(10), waiting)
+            .await
+            .is_err());
+
+        tokio::time::sleep(Duration::from_millis(100)).await;
+        assert!(!finished.load(Ordering::SeqCst));
+        // The cancelled computation is forgotten, so the next caller starts anew
+        assert_eq!(group.run("top cars", async { Ok(3) }).await, Ok(3));
+    }
+}
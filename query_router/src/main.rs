@@ -1,25 +1,61 @@
+use std::convert::Infallible;
 use std::sync::Arc;
-use std::{env, net::SocketAddr, time::Instant};
+use std::{env, net::SocketAddr, time::{Duration, Instant}};
 use axum::{
+    body::StreamBody,
     extract::State,
-    http::StatusCode,
+    http::{header, HeaderMap, HeaderValue, StatusCode},
+    response::sse::{Event, KeepAlive, Sse},
     response::{IntoResponse, Response},
     routing::{get, post},
     Json, Router,
 };
+use futures::channel::mpsc;
+use futures::{SinkExt, Stream, StreamExt};
 use reqwest::Client;
 use serde::{Deserialize, Serialize};
+use serde_json::value::RawValue;
 use serde_json::{json, Value};
 use tower::ServiceBuilder;
 use tower_http::cors::{Any, CorsLayer};
+use tower_http::compression::predicate::{NotForContentType, Predicate, SizeAbove};
+use tower_http::compression::{CompressionLayer, CompressionLevel};
 use tracing::error;
 
+mod cache;
+mod coalesce;
+mod metrics;
+mod semantic;
+
+use cache::{CacheConfig, CacheStatus, CachedTranslation, TranslationCache};
+use coalesce::Singleflight;
+use semantic::SemanticMatch;
+
 // Models for requests and responses
 #[derive(Debug, Deserialize)]
 struct TranslateAndExecuteRequest {
     natural_query: String,
     #[serde(default = "default_model")]
     model: String,
+    // Result format passed through to the API, e.g. "columnar". The binary
+    // formats "arrow" and "parquet" are streamed back as-is instead of JSON.
+    #[serde(default)]
+    format: Option<String>,
+    // Ask the API to estimate aggregates from a sample of large tables
+    #[serde(default)]
+    approximate: bool,
+}
+
+// Request model for translating and executing several questions at once
+#[derive(Debug, Deserialize)]
+struct BatchTranslateRequest {
+    natural_queries: Vec<String>,
+    #[serde(default = "default_model")]
+    model: String,
+    // Result format passed through to the API; only the JSON formats are
+    // available for batches
+    #[serde(default)]
+    format: Option<String>,
 }
 
 // Request model for visualization generation
@@ -39,17 +75,62 @@ fn default_model() -> String {
 struct TranslateAndExecuteResponse {
     natural_query: String,
     sql_query: String,
-    results: Value,
+    // The API's result, passed through without being parsed
+    results: Box<RawValue>,
     explanation: String,
     metadata: ResponseMetadata,
 }
 
+// One entry per question, in request order
+#[derive(Debug, Serialize)]
+struct BatchTranslateResponse {
+    results: Vec<BatchTranslateResult>,
+}
+
+#[derive(Debug, Serialize)]
+#[serde(untagged)]
+enum BatchTranslateResult {
+    Ok(TranslateAndExecuteResponse),
+    Err {
+        natural_query: String,
+        // Present when translation succeeded but execution failed
+        #[serde(skip_serializing_if = "Option::is_none")]
+        sql_query: Option<String>,
+        error: String,
+    },
+}
+
 #[derive(Debug, Serialize)]
 struct ResponseMetadata {
     confidence: f64,
     execution_time_ms: u64,
     llm_processing_time_ms: u64,
     total_time_ms: u64,
+    // Size of the query result as reported by the API, when a query was run
+    #[serde(flatten)]
+    result_stats: Option<ResultStats>,
+    // Whether the SQL came from the translation cache instead of the LLM
+    #[serde(skip_serializing_if = "Option::is_none")]
+    cache: Option<CacheStatus>,
+    // The cached question whose SQL was reused, when it was worded differently
+    #[serde(skip_serializing_if = "Option::is_none")]
+    cache_match: Option<SemanticMatch>,
+}
+
+// Size of a query result, and whether the API truncated it to fit its budget
+// or estimated it from a sample
+#[derive(Clone, Debug, Default, Serialize, Deserialize)]
+struct ResultStats {
+    #[serde(default)]
+    truncated: bool,
+    #[serde(default)]
+    row_count: u64,
+    #[serde(default)]
+    byte_count: u64,
+    // Sampling method, sample fraction and confidence intervals of an
+    // approximate result
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    approximation: Option<Value>,
 }
 
 // Response model for visualization generation
@@ -60,6 +141,35 @@ struct VisualizationResponse {
     metadata: ResponseMetadata,
 }
 
+// An API query response, with the result left serialized so it can be
+// passed on as it is
+#[derive(Debug, Deserialize)]
+struct ApiQueryResponse {
+    result: Option<Box<RawValue>>,
+    #[serde(flatten)]
+    result_stats: ResultStats,
+}
+
+// The API's response to a batch of queries
+#[derive(Debug, Deserialize)]
+struct ApiBatchResponse {
+    results: Vec<ApiBatchItem>,
+}
+
+// One entry of an API batch response: a query response or an error. The
+// fields are listed here rather than flattening ApiQueryResponse, since a
+// raw value cannot be read from inside a flattened struct.
+#[derive(Debug, Deserialize)]
+struct ApiBatchItem {
+    #[serde(default)]
+    error: Option<String>,
+    #[serde(default)]
+    status: Option<u16>,
+    result: Option<Box<RawValue>>,
+    #[serde(flatten)]
+    result_stats: ResultStats,
+}
+
 // LLM Engine response structure
 #[derive(Debug, Deserialize)]
 struct LlmResponse {
@@ -68,6 +178,19 @@ struct LlmResponse {
     confidence: f64,
 }
 
+// LLM Engine batch response structure, one entry per query
+#[derive(Debug, Deserialize)]
+struct LlmBatchResponse {
+    results: Vec<LlmBatchResult>,
+}
+
+#[derive(Debug, Deserialize)]
+#[serde(untagged)]
+enum LlmBatchResult {
+    Ok(LlmResponse),
+    Err { error: String },
+}
+
 // LLM Engine visualization response structure
 #[derive(Debug, Deserialize)]
 struct LlmVisualizationResponse {
@@ -81,6 +204,12 @@ struct AppState {
     client: Client,
     llm_engine_url: String,
     api_url: String,
+    // Time allowed for a whole request, including the LLM call and the query
+    request_timeout: Duration,
+    // None when DATABASE_URL is not set or the cache is disabled
+    translations: Option<Arc<TranslationCache>>,
+    // Questions being answered, shared by identical concurrent requests
+    in_flight: Arc<Singleflight<FlightKey, SharedAnswer>>,
 }
 
 // Error types
@@ -94,16 +223,35 @@ enum AppError {
     
     #[error("Failed to execute SQL query: {0}")]
     SqlExecutionError(String),
+    
+    #[error("Request timed out: {0}")]
+    Timeout(String),
+    
+    #[error("Invalid request: {0}")]
+    BadRequest(String),
+    
+    // The error of a request this one was coalesced with
+    #[error("{0}")]
+    Shared(Arc<AppError>),
+}
+
+impl AppError {
+    fn status_and_message(&self) -> (StatusCode, String) {
+        match self {
+            AppError::LlmEngineError(e) => (StatusCode::BAD_GATEWAY, format!("LLM engine error: {}", e)),
+            AppError::LlmResponseError(msg) => (StatusCode::BAD_REQUEST, msg.clone()),
+            AppError::SqlExecutionError(msg) => (StatusCode::BAD_REQUEST, msg.clone()),
+            AppError::Timeout(msg) => (StatusCode::GATEWAY_TIMEOUT, msg.clone()),
+            AppError::BadRequest(msg) => (StatusCode::BAD_REQUEST, msg.clone()),
+            AppError::Shared(e) => e.status_and_message(),
+        }
+    }
 }
 
 // Convert AppError to Axum Response
 impl IntoResponse for AppError {
     fn into_response(self) -> Response {
-        let (status, error_message) = match self {
-            AppError::LlmEngineError(e) => (StatusCode::BAD_GATEWAY, format!("LLM engine error: {}", e)),
-            AppError::LlmResponseError(msg) => (StatusCode::BAD_REQUEST, msg),
-            AppError::SqlExecutionError(msg) => (StatusCode::BAD_REQUEST, msg),
-        };
+        let (status, error_message) = self.status_and_message();
 
         let body = Json(json!({
             "error": error_message
@@ -134,10 +282,37 @@ async fn main() -> Result<(), Box<dyn std::error::Error>> {
     let api_url = env::var("API_URL")
         .expect("API_URL must be set");
     
+    let request_timeout = env::var("QUERY_ROUTER_TIMEOUT_SECS")
+        .ok()
+        .and_then(|t| t.parse::<u64>().ok())
+        .map(Duration::from_secs)
+        .unwrap_or(Duration::from_secs(120));
+    
+    // Results from the API and the LLM engine are requested compressed and
+    // decompressed as they arrive
+    let client = Client::builder()
+        .gzip(true)
+        .brotli(true)
+        .build()?;
+    
+    // Translations are cached in the database the questions are about
+    let cache_config = CacheConfig::from_env();
+    let translations = match env::var("DATABASE_URL") {
+        Ok(db_url) if cache_config.capacity > 0 => {
+            let cache = Arc::new(TranslationCache::new(cache_config, db_url));
+            cache.spawn_schema_watch();
+            Some(cache)
+        }
+        _ => None,
+    };
+    
     let state = Arc::new(AppState {
-        client: Client::new(),
+        client,
         llm_engine_url,
         api_url,
+        request_timeout,
+        translations,
+        in_flight: Arc::new(Singleflight::new()),
     });
 
     // Create middleware stack with CORS
@@ -147,13 +322,19 @@ async fn main() -> Result<(), Box<dyn std::error::Error>> {
                 .allow_origin(Any)
                 .allow_methods(Any)
                 .allow_headers(Any)
-        );
+        )
+        .layer(compression_layer());
 
     // Create the router
     let app = Router::new()
         .route("/health", get(health_check))
         .route("/translate-and-execute", post(translate_and_execute))
+        .route("/translate-and-execute/batch", post(translate_and_execute_batch))
+        .route("/translate-and-execute/stream", post(translate_and_execute_stream))
+        .route("/translate-and-export", post(translate_and_export))
         .route("/visualize", post(generate_visualization))
+        .route("/metrics", get(metrics_handler))
+        .route("/translation-cache/semantic-hits", get(semantic_hits))
         .with_state(state)
         .layer(middleware);
 
@@ -184,51 +365,712 @@ async fn main() -> Result<(), Box<dyn std::error::Error>> {
     Ok(())
 }
 
+// Response compression, negotiated with the Accept-Encoding header
+//
+// Responses smaller than COMPRESSION_MIN_BYTES are sent as they are, and so are
+// images, event streams, NDJSON, Arrow streams and Parquet files. COMPRESSION_LEVEL is "fastest", "best" or a number
+// on each algorithm's own scale.
+fn compression_layer() -> CompressionLayer<impl Predicate> {
+    let min_bytes = env::var("COMPRESSION_MIN_BYTES")
+        .ok()
+        .and_then(|b| b.parse::<u16>().ok())
+        .unwrap_or(1024);
+    let level = match env::var("COMPRESSION_LEVEL").unwrap_or_default().trim() {
+        "fastest" => CompressionLevel::Fastest,
+        "best" => CompressionLevel::Best,
+        level => level
+            .parse()
+            .map(CompressionLevel::Precise)
+            .unwrap_or(CompressionLevel::Default),
+    };
+    
+    let predicate = SizeAbove::new(min_bytes)
+        .and(NotForContentType::IMAGES)
+        .and(NotForContentType::const_new("text/event-stream"))
+        .and(NotForContentType::const_new("application/x-ndjson"))
+        .and(NotForContentType::const_new("application/vnd.apache.arrow.stream"))
+        .and(NotForContentType::const_new("application/vnd.apache.parquet"));
+    
+    CompressionLayer::new()
+        .gzip(true)
+        .br(true)
+        .zstd(true)
+        .quality(level)
+        .compress_when(predicate)
+}
+
 // Health check endpoint
 async fn health_check() -> &'static str {
     "OK"
 }
 
+// Prometheus metrics of the translation cache
+async fn metrics_handler(State(state): State<Arc<AppState>>) -> impl IntoResponse {
+    let mut out = String::new();
+    if let Some(translations) = &state.translations {
+        translations.write_metrics(&mut out);
+    }
+    ([(header::CONTENT_TYPE, metrics::CONTENT_TYPE)], out)
+}
+
+// Recent questions answered with the SQL of a similar question, newest first,
+// to review for false hits
+async fn semantic_hits(State(state): State<Arc<AppState>>) -> Json<Vec<cache::AuditEntry>> {
+    Json(state.translations.as_ref().map(|t| t.recent_semantic_hits()).unwrap_or_default())
+}
+
 // Main endpoint for translating natural language to SQL and executing it
 async fn translate_and_execute(
     State(state): State<Arc<AppState>>,
     Json(request): Json<TranslateAndExecuteRequest>,
-) -> Result<Json<TranslateAndExecuteResponse>, AppError> {
+) -> Result<Response, AppError> {
     let start_time = Instant::now();
     
-    // Step 1: Forward the natural language query to the LLM engine
-    let llm_start_time = Instant::now();
-    let llm_response = call_llm_engine(&state, &request).await?;
-    let llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+    // Columnar binary formats skip the JSON envelope entirely
+    if let Some(format @ ("arrow" | "parquet")) = request.format.as_deref() {
+        let deadline = Deadline::new(start_time, state.request_timeout);
+        let llm_start_time = Instant::now();
+        let translation = translate(&state, &request, &deadline).await?;
+        let llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+        
+        let response = forward_binary_result(&state, &translation.llm_response, format, llm_processing_time, &deadline).await;
+        record_outcome(&state, &request, &translation, response.is_ok()).await;
+        return response;
+    }
     
-    // Step 2: Send the generated SQL to the API execution endpoint
-    let execution_start_time = Instant::now();
-    let query_result = execute_sql_query(&state, &llm_response.sql_query).await?;
-    let execution_time = execution_start_time.elapsed().as_millis() as u64;
+    // Identical questions arriving while one is being answered share its
+    // answer instead of each calling the LLM and running the SQL
+    let key = FlightKey {
+        natural_query: cache::normalize(&request.natural_query),
+        model: request.model.clone(),
+        format: request.format.clone(),
+        approximate: request.approximate,
+    };
+    let request = Arc::new(request);
+    let (flight_state, flight_request) = (Arc::clone(&state), Arc::clone(&request));
+    let answer = state
+        .in_flight
+        .run(key, async move {
+            answer_question(&flight_state, &flight_request, start_time)
+                .await
+                .map(Arc::new)
+                .map_err(Arc::new)
+        })
+        .await
+        .map_err(AppError::Shared)?;
     
     // Step 3: Combine results and return to client
     let total_time = start_time.elapsed().as_millis() as u64;
     
+    let llm_response = &answer.translation.llm_response;
     let response = TranslateAndExecuteResponse {
-        natural_query: request.natural_query,
-        sql_query: llm_response.sql_query,
-        results: query_result,
-        explanation: llm_response.explanation,
+        natural_query: request.natural_query.clone(),
+        sql_query: llm_response.sql_query.clone(),
+        results: answer.query_result.clone(),
+        explanation: llm_response.explanation.clone(),
         metadata: ResponseMetadata {
             confidence: llm_response.confidence,
-            execution_time_ms: execution_time,
-            llm_processing_time_ms: llm_processing_time,
+            execution_time_ms: answer.execution_time,
+            llm_processing_time_ms: answer.llm_processing_time,
             total_time_ms: total_time,
+            result_stats: Some(answer.result_stats.clone()),
+            cache: state.translations.as_ref().map(|_| answer.translation.cache_status),
+            cache_match: answer.translation.semantic.clone(),
         },
     };
     
-    Ok(Json(response))
+    Ok(Json(response).into_response())
+}
+
+// What makes two questions the same for coalescing
+#[derive(Clone, Debug, PartialEq, Eq, Hash)]
+struct FlightKey {
+    // Normalized like the translation cache does
+    natural_query: String,
+    model: String,
+    format: Option<String>,
+    approximate: bool,
+}
+
+// The answer to a question, shared by every request coalesced into it
+struct Answer {
+    translation: Translation,
+    query_result: Box<RawValue>,
+    result_stats: ResultStats,
+    llm_processing_time: u64,
+    execution_time: u64,
+}
+
+type SharedAnswer = Result<Arc<Answer>, Arc<AppError>>;
+
+// Translate a question and run its SQL, within the deadline of a request
+// that started at `start_time`
+async fn answer_question(
+    state: &AppState,
+    request: &TranslateAndExecuteRequest,
+    start_time: Instant,
+) -> Result<Answer, AppError> {
+    let deadline = Deadline::new(start_time, state.request_timeout);
+    
+    // Step 1: Translate the natural language query, from the cache or with
+    // the LLM engine
+    let llm_start_time = Instant::now();
+    let mut translation = translate(state, request, &deadline).await?;
+    let mut llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+    
+    // Step 2: Send the generated SQL to the API execution endpoint
+    let execution_start_time = Instant::now();
+    let mut executed = execute_sql_query(state, &translation.llm_response.sql_query, request.format.as_deref(), request.approximate, &deadline).await;
+    let mut execution_time = execution_start_time.elapsed().as_millis() as u64;
+    
+    // SQL reused from a similar question that fails to run did not fit this
+    // one after all, so the LLM gets asked
+    if translation.semantic.is_some() && matches!(executed, Err(AppError::SqlExecutionError(_))) {
+        record_outcome(state, request, &translation, false).await;
+        let llm_start_time = Instant::now();
+        translation = Translation {
+            llm_response: call_llm_engine(state, request, &deadline).await?,
+            cache_status: CacheStatus::Miss,
+            semantic: None,
+        };
+        llm_processing_time += llm_start_time.elapsed().as_millis() as u64;
+        
+        let execution_start_time = Instant::now();
+        executed = execute_sql_query(state, &translation.llm_response.sql_query, request.format.as_deref(), request.approximate, &deadline).await;
+        execution_time += execution_start_time.elapsed().as_millis() as u64;
+    }
+    
+    // Only SQL that ran is worth asking again
+    record_outcome(state, request, &translation, executed.is_ok()).await;
+    let (query_result, result_stats) = executed?;
+    
+    Ok(Answer {
+        translation,
+        query_result,
+        result_stats,
+        llm_processing_time,
+        execution_time,
+    })
+}
+
+// Translate and execute several questions in one request
+//
+// All questions go to the LLM engine in one call, so the schema is fetched
+// once for the whole batch, and all generated SQL goes to the API's batch
+// endpoint in one call. A question that fails to translate or execute gets an
+// error entry instead of failing the whole batch.
+async fn translate_and_execute_batch(
+    State(state): State<Arc<AppState>>,
+    Json(request): Json<BatchTranslateRequest>,
+) -> Result<Json<BatchTranslateResponse>, AppError> {
+    if let Some(format @ ("arrow" | "parquet")) = request.format.as_deref() {
+        return Err(AppError::BadRequest(format!("The {} format is not available for batches", format)));
+    }
+    
+    let start_time = Instant::now();
+    let deadline = Deadline::new(start_time, state.request_timeout);
+    
+    // Step 1: Translate every question
+    let llm_start_time = Instant::now();
+    let translations = call_llm_engine_batch(&state, &request, &deadline).await?;
+    let llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+    
+    // Step 2: Execute the SQL of every question that was translated
+    let sql_queries: Vec<&str> = translations
+        .iter()
+        .filter_map(|translation| match translation {
+            LlmBatchResult::Ok(llm_response) => Some(llm_response.sql_query.as_str()),
+            LlmBatchResult::Err { .. } => None,
+        })
+        .collect();
+    let execution_start_time = Instant::now();
+    let mut executions = execute_sql_batch(&state, &sql_queries, request.format.as_deref(), &deadline)
+        .await?
+        .into_iter();
+    let execution_time = execution_start_time.elapsed().as_millis() as u64;
+    
+    // Step 3: Pair every question with its translation and result
+    let total_time = start_time.elapsed().as_millis() as u64;
+    
+    let results = request.natural_queries
+        .into_iter()
+        .zip(translations)
+        .map(|(natural_query, translation)| {
+            let llm_response = match translation {
+                LlmBatchResult::Ok(llm_response) => llm_response,
+                LlmBatchResult::Err { error } => {
+                    return BatchTranslateResult::Err { natural_query, sql_query: None, error };
+                }
+            };
+            match executions.next() {
+                Some(Ok((query_result, result_stats))) => BatchTranslateResult::Ok(TranslateAndExecuteResponse {
+                    natural_query,
+                    sql_query: llm_response.sql_query,
+                    results: query_result,
+                    explanation: llm_response.explanation,
+                    metadata: ResponseMetadata {
+                        confidence: llm_response.confidence,
+                        execution_time_ms: execution_time,
+                        llm_processing_time_ms: llm_processing_time,
+                        total_time_ms: total_time,
+                        result_stats: Some(result_stats),
+                        cache: None,
+                        cache_match: None,
+                    },
+                }),
+                Some(Err(error)) => BatchTranslateResult::Err {
+                    natural_query,
+                    sql_query: Some(llm_response.sql_query),
+                    error: error.to_string(),
+                },
+                None => BatchTranslateResult::Err {
+                    natural_query,
+                    sql_query: Some(llm_response.sql_query),
+                    error: "API returned no result for the query".to_string(),
+                },
+            }
+        })
+        .collect();
+    
+    Ok(Json(BatchTranslateResponse { results }))
+}
+
+// Stream an Arrow or Parquet result from the API straight back to the client
+async fn forward_binary_result(
+    state: &AppState,
+    llm_response: &LlmResponse,
+    format: &str,
+    llm_processing_time: u64,
+    deadline: &Deadline,
+) -> Result<Response, AppError> {
+    let url = format!("{}/api/query", state.api_url);
+    let remaining = deadline.remaining()?;
+    
+    // The request timeout covers reading the body too, so a slow API cannot
+    // hold the request past its deadline. A body cut off by the deadline ends
+    // the response early.
+    let api_response = state.client
+        .post(&url)
+        .timeout(remaining)
+        .query(&[("format", format.to_string()), ("timeout_ms", remaining.as_millis().to_string())])
+        .json(&json!({ "query": llm_response.sql_query }))
+        .send()
+        .await
+        .map_err(|e| match e.is_timeout() {
+            true => AppError::Timeout("Query did not start in time".to_string()),
+            false => AppError::SqlExecutionError(e.to_string()),
+        })?;
+    
+    forward_api_response(api_response, llm_response, llm_processing_time).await
+}
+
+// Pass a non-JSON API response body through to the client as it arrives
+//
+// The generated SQL and the LLM metadata travel in response headers, since
+// the body is the result itself.
+async fn forward_api_response(
+    api_response: reqwest::Response,
+    llm_response: &LlmResponse,
+    llm_processing_time: u64,
+) -> Result<Response, AppError> {
+    if !api_response.status().is_success() {
+        let status = api_response.status();
+        let error_text = api_response.text().await.unwrap_or_else(|_| "Unknown error".to_string());
+        return Err(AppError::SqlExecutionError(format!("SQL execution failed ({}): {}", status, error_text)));
+    }
+    
+    let mut headers = HeaderMap::new();
+    for name in [header::CONTENT_TYPE, header::CONTENT_DISPOSITION] {
+        if let Some(value) = api_response.headers().get(&name) {
+            headers.insert(name, value.clone());
+        }
+    }
+    // Header values must be visible ASCII on a single line
+    if let Ok(value) = HeaderValue::from_str(&llm_response.sql_query.replace(['\r', '\n'], " ")) {
+        headers.insert("x-lucidata-sql-query", value);
+    }
+    if let Ok(value) = HeaderValue::from_str(&llm_response.confidence.to_string()) {
+        headers.insert("x-lucidata-confidence", value);
+    }
+    headers.insert("x-lucidata-llm-processing-time-ms", HeaderValue::from(llm_processing_time));
+    
+    Ok((headers, StreamBody::new(api_response.bytes_stream())).into_response())
+}
+
+// Translate a natural language query to SQL and stream its result as CSV
+async fn translate_and_export(
+    State(state): State<Arc<AppState>>,
+    Json(request): Json<TranslateAndExecuteRequest>,
+) -> Result<Response, AppError> {
+    let deadline = Deadline::new(Instant::now(), state.request_timeout);
+    
+    let llm_start_time = Instant::now();
+    let translation = translate(&state, &request, &deadline).await?;
+    let llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+    
+    let url = format!("{}/api/export", state.api_url);
+    let remaining = deadline.remaining()?;
+    
+    // The rest of the deadline is the statement timeout of the export. Only
+    // the time to the first bytes is bounded here, the CSV is streamed for as
+    // long as the client keeps reading.
+    let api_request = state.client
+        .post(&url)
+        .query(&[("timeout_ms", remaining.as_millis().to_string())])
+        .json(&json!({ "query": translation.llm_response.sql_query }));
+    let api_response = tokio::time::timeout(remaining, api_request.send())
+        .await
+        .map_err(|_| AppError::Timeout("Export did not start in time".to_string()))?
+        .map_err(|e| AppError::SqlExecutionError(e.to_string()))?;
+    
+    let response = forward_api_response(api_response, &translation.llm_response, llm_processing_time).await;
+    record_outcome(&state, &request, &translation, response.is_ok()).await;
+    response
+}
+
+// Rows carried by one `rows` event at most
+const ROWS_PER_EVENT: usize = 500;
+
+// Start of the last line of an NDJSON stream the API truncated
+const TRUNCATED_LINE: &[u8] = b"{\"truncated\":true,";
+
+// Events held for a client that is slow to read before the rows are no
+// longer read from the API
+const STREAM_EVENT_BUFFER: usize = 16;
+
+// Translate a natural language query and stream the answer as server-sent
+// events, each stage as soon as it is done
+//
+// A `sql` event carries the translation as soon as it is known. The rows
+// follow in `rows` events as the API streams them, each a JSON array of up to
+// ROWS_PER_EVENT rows; in the columnar format a `columns` event with the
+// header comes first. A final `metadata` event carries the timings and the
+// row count. A failure at any stage ends the stream with an `error` event.
+async fn translate_and_execute_stream(
+    State(state): State<Arc<AppState>>,
+    Json(request): Json<TranslateAndExecuteRequest>,
+) -> Result<Sse<impl Stream<Item = Result<Event, Infallible>>>, AppError> {
+    if let Some(format @ ("arrow" | "parquet")) = request.format.as_deref() {
+        return Err(AppError::BadRequest(format!("The {} format cannot be streamed as events", format)));
+    }
+    if request.approximate {
+        return Err(AppError::BadRequest("Approximate results cannot be streamed".to_string()));
+    }
+    
+    let start_time = Instant::now();
+    let (tx, rx) = mpsc::channel(STREAM_EVENT_BUFFER);
+    
+    // The answer is worked out in its own task, which stops once the client
+    // has gone away and the events can no longer be sent
+    tokio::spawn(async move {
+        let mut events = EventSender(tx);
+        if let Err(StreamStop::Failed(e)) = stream_answer(&state, &request, start_time, &mut events).await {
+            let (_, message) = e.status_and_message();
+            let _ = events.send("error", &json!({ "error": message })).await;
+        }
+    });
+    
+    // Comments keep the connection open while the LLM is thinking
+    Ok(Sse::new(rx.map(Ok::<_, Infallible>)).keep_alive(KeepAlive::default()))
+}
+
+// Why a streamed answer ended early
+enum StreamStop {
+    Failed(AppError),
+    Disconnected,
+}
+
+impl From<AppError> for StreamStop {
+    fn from(e: AppError) -> Self {
+        StreamStop::Failed(e)
+    }
+}
+
+// The events of a streamed answer, on their way to the client
+struct EventSender(mpsc::Sender<Event>);
+
+impl EventSender {
+    async fn send<T: Serialize>(&mut self, name: &str, data: &T) -> Result<(), StreamStop> {
+        let data = serde_json::to_string(data).expect("event data serializes");
+        self.send_raw(name, data).await
+    }
+    
+    // Send an event whose data is already JSON
+    async fn send_raw(&mut self, name: &str, data: String) -> Result<(), StreamStop> {
+        let event = Event::default().event(name).data(data);
+        self.0.send(event).await.map_err(|_| StreamStop::Disconnected)
+    }
+}
+
+// Translate a question and stream its rows, as events
+//
+// Reused SQL of a similar question that fails to run is replaced with the
+// LLM's like it is for /translate-and-execute, in which case a second `sql`
+// event replaces the first.
+async fn stream_answer(
+    state: &AppState,
+    request: &TranslateAndExecuteRequest,
+    start_time: Instant,
+    events: &mut EventSender,
+) -> Result<(), StreamStop> {
+    let deadline = Deadline::new(start_time, state.request_timeout);
+    
+    // Step 1: Translate the natural language query and tell the client the SQL
+    let llm_start_time = Instant::now();
+    let mut translation = translate(state, request, &deadline).await?;
+    let mut llm_processing_time = llm_start_time.elapsed().as_millis() as u64;
+    events.send("sql", &sql_event(request, &translation.llm_response)).await?;
+    
+    // Step 2: Start the SQL on the API, up to its first rows
+    let execution_start_time = Instant::now();
+    let mut started = start_streamed_query(state, &translation.llm_response.sql_query, request.format.as_deref(), &deadline).await;
+    let mut execution_time = execution_start_time.elapsed().as_millis() as u64;
+    
+    if translation.semantic.is_some() && matches!(started, Err(AppError::SqlExecutionError(_))) {
+        record_outcome(state, request, &translation, false).await;
+        let llm_start_time = Instant::now();
+        translation = Translation {
+            llm_response: call_llm_engine(state, request, &deadline).await?,
+            cache_status: CacheStatus::Miss,
+            semantic: None,
+        };
+        llm_processing_time += llm_start_time.elapsed().as_millis() as u64;
+        events.send("sql", &sql_event(request, &translation.llm_response)).await?;
+        
+        let execution_start_time = Instant::now();
+        started = start_streamed_query(state, &translation.llm_response.sql_query, request.format.as_deref(), &deadline).await;
+        execution_time += execution_start_time.elapsed().as_millis() as u64;
+    }
+    
+    record_outcome(state, request, &translation, started.is_ok()).await;
+    let api_response = started?;
+    
+    // Step 3: Relay the rows as they arrive, then the timings
+    let relay_start_time = Instant::now();
+    let columnar = request.format.as_deref() == Some("columnar");
+    let result_stats = relay_rows(api_response, columnar, events).await?;
+    execution_time += relay_start_time.elapsed().as_millis() as u64;
+    
+    let llm_response = &translation.llm_response;
+    let metadata = ResponseMetadata {
+        confidence: llm_response.confidence,
+        execution_time_ms: execution_time,
+        llm_processing_time_ms: llm_processing_time,
+        total_time_ms: start_time.elapsed().as_millis() as u64,
+        result_stats: Some(result_stats),
+        cache: state.translations.as_ref().map(|_| translation.cache_status),
+        cache_match: translation.semantic.clone(),
+    };
+    events.send("metadata", &metadata).await
+}
+
+fn sql_event(request: &TranslateAndExecuteRequest, llm_response: &LlmResponse) -> Value {
+    json!({
+        "natural_query": request.natural_query,
+        "sql_query": llm_response.sql_query,
+        "explanation": llm_response.explanation,
+        "confidence": llm_response.confidence,
+    })
+}
+
+// Start a query on the API as a stream of NDJSON rows, returning once its
+// first rows or its error are back
+async fn start_streamed_query(
+    state: &AppState,
+    sql_query: &str,
+    format: Option<&str>,
+    deadline: &Deadline,
+) -> Result<reqwest::Response, AppError> {
+    let url = format!("{}/api/query", state.api_url);
+    let remaining = deadline.remaining()?;
+    
+    let mut request = state.client
+        .post(&url)
+        // Compressed NDJSON arrives in blocks rather than as rows are written
+        .header(header::ACCEPT_ENCODING, "identity")
+        .query(&[("stream", "true".to_string()), ("timeout_ms", remaining.as_millis().to_string())]);
+    if let Some(format) = format {
+        request = request.query(&[("format", format)]);
+    }
+    
+    // Only the time to the first rows is bounded here, the rest is streamed
+    // for as long as the client keeps reading
+    let response = tokio::time::timeout(remaining, request.json(&json!({ "query": sql_query })).send())
+        .await
+        .map_err(|_| AppError::Timeout("Query did not start in time".to_string()))?
+        .map_err(|e| AppError::SqlExecutionError(e.to_string()))?;
+    
+    if !response.status().is_success() {
+        let status = response.status();
+        let error_text = response.text().await.unwrap_or_else(|_| "Unknown error".to_string());
+        return Err(AppError::SqlExecutionError(format!("SQL execution failed ({}): {}", status, error_text)));
+    }
+    
+    Ok(response)
+}
+
+// Relay the NDJSON rows of an API response as `rows` events, and count them
+//
+// Every complete line received is sent on without waiting for more, and the
+// lines are spliced into the events' arrays as they are rather than parsed.
+async fn relay_rows(
+    api_response: reqwest::Response,
+    columnar: bool,
+    events: &mut EventSender,
+) -> Result<ResultStats, StreamStop> {
+    let mut body = api_response.bytes_stream();
+    let mut pending: Vec<u8> = Vec::new();
+    let mut header = columnar;
+    let mut result_stats = ResultStats::default();
+    
+    while let Some(chunk) = body.next().await {
+        let chunk = chunk
+            .map_err(|e| AppError::SqlExecutionError(format!("Query failed while streaming rows: {}", e)))?;
+        pending.extend_from_slice(&chunk);
+        
+        // Hold back a partial last line until the rest of it arrives
+        if let Some(end) = pending.iter().rposition(|b| *b == b'\n') {
+            let rest = pending.split_off(end + 1);
+            let lines = std::mem::replace(&mut pending, rest);
+            relay_lines(&lines, &mut header, &mut result_stats, events).await?;
+        }
+    }
+    relay_lines(&pending, &mut header, &mut result_stats, events).await?;
+    
+    Ok(result_stats)
+}
+
+async fn relay_lines(
+    lines: &[u8],
+    header: &mut bool,
+    result_stats: &mut ResultStats,
+    events: &mut EventSender,
+) -> Result<(), StreamStop> {
+    let mut rows: Vec<&[u8]> = lines.split(|b| *b == b'\n').filter(|line| !line.is_empty()).collect();
+    if *header && !rows.is_empty() {
+        *header = false;
+        events.send_raw("columns", utf8(rows.remove(0))?).await?;
+    }
+    
+    // A stream the API cut short at its row or byte budget ends with a line
+    // of stats rather than a row
+    rows.retain(|row| {
+        let marker = row.starts_with(TRUNCATED_LINE);
+        result_stats.truncated |= marker;
+        !marker
+    });
+    
+    for batch in rows.chunks(ROWS_PER_EVENT) {
+        let byte_count: usize = batch.iter().map(|row| row.len()).sum();
+        let mut data = Vec::with_capacity(byte_count + batch.len() + 1);
+        data.push(b'[');
+        for (i, row) in batch.iter().enumerate() {
+            if i > 0 {
+                data.push(b',');
+            }
+            data.extend_from_slice(row);
+        }
+        data.push(b']');
+        
+        result_stats.row_count += batch.len() as u64;
+        result_stats.byte_count += byte_count as u64;
+        events.send_raw("rows", utf8(&data)?).await?;
+    }
+    
+    Ok(())
+}
+
+// Lines are split at newlines only, so they stay valid UTF-8
+fn utf8(bytes: &[u8]) -> Result<String, AppError> {
+    String::from_utf8(bytes.to_vec())
+        .map_err(|e| AppError::SqlExecutionError(format!("API sent invalid UTF-8: {}", e)))
+}
+
+// The point by which a request must be answered
+struct Deadline(Instant);
+
+impl Deadline {
+    fn new(start: Instant, timeout: Duration) -> Self {
+        Deadline(start + timeout)
+    }
+    
+    // Time left before the deadline, or a timeout error once it has passed
+    fn remaining(&self) -> Result<Duration, AppError> {
+        match self.0.checked_duration_since(Instant::now()) {
+            Some(remaining) if !remaining.is_zero() => Ok(remaining),
+            _ => Err(AppError::Timeout("Request deadline exceeded".to_string())),
+        }
+    }
+}
+
+// A translation of a natural language query, and where it came from
+struct Translation {
+    llm_response: LlmResponse,
+    cache_status: CacheStatus,
+    // The cached question whose SQL was reused, when it was worded differently
+    semantic: Option<SemanticMatch>,
+}
+
+// Translate a natural language query to SQL, from the translation cache when
+// the same or a similar question was answered before for the same model and
+// schema
+async fn translate(
+    state: &AppState,
+    request: &TranslateAndExecuteRequest,
+    deadline: &Deadline,
+) -> Result<Translation, AppError> {
+    if let Some(translations) = &state.translations {
+        if let Some(hit) = translations.get(&request.natural_query, &request.model).await {
+            return Ok(Translation {
+                llm_response: LlmResponse {
+                    sql_query: hit.translation.sql_query,
+                    explanation: hit.translation.explanation,
+                    confidence: hit.translation.confidence,
+                },
+                cache_status: CacheStatus::Hit,
+                semantic: hit.semantic,
+            });
+        }
+    }
+    
+    Ok(Translation {
+        llm_response: call_llm_engine(state, request, deadline).await?,
+        cache_status: CacheStatus::Miss,
+        semantic: None,
+    })
+}
+
+// Tell the translation cache whether a translation's SQL ran: new ones that
+// did are cached, and semantic hits are audited either way
+async fn record_outcome(
+    state: &AppState,
+    request: &TranslateAndExecuteRequest,
+    translation: &Translation,
+    succeeded: bool,
+) {
+    let translations = match &state.translations {
+        Some(translations) => translations,
+        None => return,
+    };
+    let llm_response = &translation.llm_response;
+    if let Some(found) = &translation.semantic {
+        translations.audit(&request.natural_query, found, &llm_response.sql_query, succeeded);
+    }
+    if succeeded && translation.cache_status == CacheStatus::Miss {
+        let cached = CachedTranslation {
+            sql_query: llm_response.sql_query.clone(),
+            explanation: llm_response.explanation.clone(),
+            confidence: llm_response.confidence,
+        };
+        translations.insert(&request.natural_query, &request.model, cached).await;
+    }
 }
 
 // Call LLM engine to convert natural language to SQL
 async fn call_llm_engine(
     state: &AppState, 
-    request: &TranslateAndExecuteRequest
+    request: &TranslateAndExecuteRequest,
+    deadline: &Deadline,
 ) -> Result<LlmResponse, AppError> {
     let url = format!("{}/process-query", state.llm_engine_url);
     
@@ -239,10 +1081,14 @@ async fn call_llm_engine(
     
     let response = state.client
         .post(&url)
+        .timeout(deadline.remaining()?)
         .json(&llm_request)
         .send()
         .await
-        .map_err(AppError::LlmEngineError)?;
+        .map_err(|e| match e.is_timeout() {
+            true => AppError::Timeout("LLM engine did not respond in time".to_string()),
+            false => AppError::LlmEngineError(e),
+        })?;
     
     if !response.status().is_success() {
         let status = response.status();
@@ -256,20 +1102,144 @@ async fn call_llm_engine(
     Ok(llm_response)
 }
 
+// Call LLM engine to convert several natural language queries to SQL
+async fn call_llm_engine_batch(
+    state: &AppState,
+    request: &BatchTranslateRequest,
+    deadline: &Deadline,
+) -> Result<Vec<LlmBatchResult>, AppError> {
+    let url = format!("{}/process-queries", state.llm_engine_url);
+    
+    let llm_request = json!({
+        "queries": request.natural_queries,
+        "model": request.model
+    });
+    
+    let response = state.client
+        .post(&url)
+        .timeout(deadline.remaining()?)
+        .json(&llm_request)
+        .send()
+        .await
+        .map_err(|e| match e.is_timeout() {
+            true => AppError::Timeout("LLM engine did not respond in time".to_string()),
+            false => AppError::LlmEngineError(e),
+        })?;
+    
+    if !response.status().is_success() {
+        let status = response.status();
+        let error_text = response.text().await.unwrap_or_else(|_| "Unknown error".to_string());
+        return Err(AppError::LlmResponseError(format!("LLM engine returned error ({}): {}", status, error_text)));
+    }
+    
+    let llm_response = response.json::<LlmBatchResponse>().await
+        .map_err(|e| AppError::LlmResponseError(format!("Failed to parse LLM response: {}", e)))?;
+    
+    if llm_response.results.len() != request.natural_queries.len() {
+        return Err(AppError::LlmResponseError("LLM engine returned the wrong number of results".to_string()));
+    }
+    
+    Ok(llm_response.results)
+}
+
+// Execute several SQL queries with one call to the API's batch endpoint
+//
+// Results come back in the order of `sql_queries`, each with its own error.
+async fn execute_sql_batch(
+    state: &AppState,
+    sql_queries: &[&str],
+    format: Option<&str>,
+    deadline: &Deadline,
+) -> Result<Vec<Result<(Box<RawValue>, ResultStats), AppError>>, AppError> {
+    if sql_queries.is_empty() {
+        return Ok(Vec::new());
+    }
+    
+    let url = format!("{}/api/query/batch", state.api_url);
+    let remaining = deadline.remaining()?;
+    
+    let mut request = state.client
+        .post(&url)
+        .timeout(remaining)
+        .query(&[("timeout_ms", remaining.as_millis().to_string())]);
+    if let Some(format) = format {
+        request = request.query(&[("format", format)]);
+    }
+    
+    let response = request
+        .json(&json!({ "queries": sql_queries }))
+        .send()
+        .await
+        .map_err(|e| match e.is_timeout() {
+            true => AppError::Timeout("Queries did not finish in time".to_string()),
+            false => AppError::SqlExecutionError(e.to_string()),
+        })?;
+    
+    if !response.status().is_success() {
+        let status = response.status();
+        let error_text = response.text().await.unwrap_or_else(|_| "Unknown error".to_string());
+        return Err(AppError::SqlExecutionError(format!("SQL execution failed ({}): {}", status, error_text)));
+    }
+    
+    let batch_response: ApiBatchResponse = response.json().await
+        .map_err(|e| AppError::SqlExecutionError(format!("Failed to parse API response: {}", e)))?;
+    
+    Ok(batch_response.results
+        .into_iter()
+        .map(|item| match item.error {
+            Some(error) => Err(AppError::SqlExecutionError(format!(
+                "SQL execution failed ({}): {}",
+                item.status.unwrap_or_default(), error
+            ))),
+            None => query_result(item.result, item.result_stats),
+        })
+        .collect())
+}
+
 // Execute SQL using the API service
-async fn execute_sql_query(state: &AppState, sql_query: &str) -> Result<Value, AppError> {
+//
+// The API shapes the result according to `format`: an array of row objects by
+// default, or `{"columns": [...], "data": [...]}` for the columnar format. Either
+// way it is returned under `result` and passed through unchanged, together with
+// the row and byte counts the API reports for it. The result is kept as raw
+// JSON, so the router's work does not grow with its size.
+//
+// The API is given whatever is left of the request deadline as its statement
+// timeout, and the call is abandoned when the deadline passes, which makes the
+// API cancel the query.
+async fn execute_sql_query(
+    state: &AppState,
+    sql_query: &str,
+    format: Option<&str>,
+    approximate: bool,
+    deadline: &Deadline,
+) -> Result<(Box<RawValue>, ResultStats), AppError> {
     let url = format!("{}/api/query", state.api_url);
+    let remaining = deadline.remaining()?;
     
     let query_request = json!({
         "query": sql_query
     });
     
-    let response = state.client
+    let mut request = state.client
         .post(&url)
+        .timeout(remaining)
+        .query(&[("timeout_ms", remaining.as_millis().to_string())]);
+    if let Some(format) = format {
+        request = request.query(&[("format", format)]);
+    }
+    if approximate {
+        request = request.query(&[("approximate", "true")]);
+    }
+    
+    let response = request
         .json(&query_request)
         .send()
         .await
-        .map_err(|e| AppError::SqlExecutionError(e.to_string()))?;
+        .map_err(|e| match e.is_timeout() {
+            true => AppError::Timeout("Query did not finish in time".to_string()),
+            false => AppError::SqlExecutionError(e.to_string()),
+        })?;
     
     if !response.status().is_success() {
         let status = response.status();
@@ -277,16 +1247,21 @@ async fn execute_sql_query(state: &AppState, sql_query: &str) -> Result<Value, A
         return Err(AppError::SqlExecutionError(format!("SQL execution failed ({}): {}", status, error_text)));
     }
     
-    let json_response: serde_json::Value = response.json().await
+    let api_response: ApiQueryResponse = response.json().await
         .map_err(|e| AppError::SqlExecutionError(format!("Failed to parse API response: {}", e)))?;
     
-    // Extract the results field from the API response
-    let result = json_response["result"].clone();
-    if result.is_null() {
-        return Err(AppError::SqlExecutionError("API returned null result".to_string()));
-    }
+    query_result(api_response.result, api_response.result_stats)
+}
+
+// Pair a result from the API with its size fields, rejecting a missing one
+fn query_result(
+    result: Option<Box<RawValue>>,
+    result_stats: ResultStats,
+) -> Result<(Box<RawValue>, ResultStats), AppError> {
+    let result = result
+        .ok_or_else(|| AppError::SqlExecutionError("API returned null result".to_string()))?;
     
-    Ok(result)
+    Ok((result, result_stats))
 }
 
 // Endpoint for generating visualizations from natural language and data
@@ -312,6 +1287,9 @@ async fn generate_visualization(
             execution_time_ms: 0, // No SQL execution in this flow
             llm_processing_time_ms: llm_processing_time,
             total_time_ms: total_time,
+            result_stats: None,
+            cache: None,
+            cache_match: None,
         },
     };
     
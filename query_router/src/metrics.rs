@@ -0,0 +1,76 @@
+use std::fmt::Write;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::time::Duration;
+
+pub const CONTENT_TYPE: &str = "text/plain; version=0.0.4";
+
+// Upper bounds, in seconds, of the buckets of cache lookup histograms
+pub const LOOKUP_BUCKETS: &[f64] = &[
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+];
+
+// Write the HELP and TYPE lines that precede the samples of a metric
+pub fn write_header(out: &mut String, name: &str, help: &str, kind: &str) {
+    let _ = writeln!(out, "# HELP {} {}", name, help);
+    let _ = writeln!(out, "# TYPE {} {}", name, kind);
+}
+
+// Write one sample, with labels given as `key="value"` pairs, e.g. `result="miss"`
+pub fn write_sample(out: &mut String, name: &str, labels: &str, value: f64) {
+    if labels.is_empty() {
+        let _ = writeln!(out, "{} {}", name, value);
+    } else {
+        let _ = writeln!(out, "{}{{{}}} {}", name, labels, value);
+    }
+}
+
+// A histogram of durations in the Prometheus text format
+pub struct Histogram {
+    bounds: &'static [f64],
+    buckets: Vec<AtomicU64>,
+    count: AtomicU64,
+    sum_micros: AtomicU64,
+}
+
+impl Histogram {
+    pub fn new(bounds: &'static [f64]) -> Self {
+        Histogram {
+            bounds,
+            buckets: bounds.iter().map(|_| AtomicU64::new(0)).collect(),
+            count: AtomicU64::new(0),
+            sum_micros: AtomicU64::new(0),
+        }
+    }
+
+    pub fn observe(&self, duration: Duration) {
+        let seconds = duration.as_secs_f64();
+        if let Some(i) = self.bounds.iter().position(|&bound| seconds <= bound) {
+            self.buckets[i].fetch_add(1, Ordering::Relaxed);
+        }
+        self.count.fetch_add(1, Ordering::Relaxed);
+        self.sum_micros
+            .fetch_add(duration.as_micros() as u64, Ordering::Relaxed);
+    }
+
+    // Write the bucket, sum and count samples of the histogram
+    pub fn write_samples(&self, out: &mut String, name: &str, labels: &str) {
+        let separator = if labels.is_empty() { "" } else { "," };
+        let mut cumulative = 0;
+        for (bound, bucket) in self.bounds.iter().zip(&self.buckets) {
+            cumulative += bucket.load(Ordering::Relaxed);
+            let bucket_labels = format!("{}{}le=\"{}\"", labels, separator, bound);
+            write_sample(
+                out,
+                &format!("{}_bucket", name),
+                &bucket_labels,
+                cumulative as f64,
+            );
+        }
+        let count = self.count.load(Ordering::Relaxed);
+        let inf_labels = format!("{}{}le=\"+Inf\"", labels, separator);
+        write_sample(out, &format!("{}_bucket", name), &inf_labels, count as f64);
+        let sum = self.sum_micros.load(Ordering::Relaxed) as f64 / 1_000_000.0;
+        write_sample(out, &format!("{}_sum", name), labels, sum);
+        write_sample(out, &format!("{}_count", name), labels, count as f64);
+    }
+}
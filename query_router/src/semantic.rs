@@ -0,0 +1,493 @@
+use std::collections::{HashMap, VecDeque};
+
+use serde::Serialize;
+
+use crate::cache::{fnv1a, CachedTranslation, FNV_OFFSET};
+
+// Candidates compared in full for one lookup, best shared trigrams first
+const MAX_CANDIDATES: usize = 64;
+
+// A cached question worded differently from the one asked, but similar
+// enough that its SQL is reused
+#[derive(Clone, Debug, Serialize)]
+pub struct SemanticMatch {
+    pub natural_query: String,
+    pub similarity: f64,
+}
+
+// Why a similar question's SQL was not reused
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Mismatch {
+    // The questions mention different columns or tables
+    Columns,
+    // The questions mention different numbers
+    Numbers,
+    // The questions order, compare or negate in different directions, e.g.
+    // top and bottom, above and below
+    Direction,
+}
+
+impl Mismatch {
+    pub fn as_str(self) -> &'static str {
+        match self {
+            Mismatch::Columns => "columns",
+            Mismatch::Numbers => "numbers",
+            Mismatch::Direction => "direction",
+        }
+    }
+}
+
+struct Entry {
+    model: String,
+    // Normalized
+    question: String,
+    // Occurrences of each character trigram, by its hash
+    trigrams: HashMap<u64, f64>,
+    translation: CachedTranslation,
+}
+
+// Finds cached questions that are worded differently but ask the same thing
+//
+// Questions are compared by the cosine similarity of the TF-IDF vectors of
+// their character trigrams, which tolerates reordered words, inflections and
+// small spelling differences. An inverted index from each trigram to the
+// questions containing it narrows a lookup down to the questions sharing the
+// most trigrams with the new one, and only those are scored in full.
+pub struct SemanticIndex {
+    capacity: usize,
+    next_id: u64,
+    entries: HashMap<u64, Entry>,
+    // Entry ids by model and question, and in the order they were added
+    ids: HashMap<(String, String), u64>,
+    order: VecDeque<u64>,
+    postings: HashMap<u64, Vec<u64>>,
+}
+
+impl SemanticIndex {
+    pub fn new(capacity: usize) -> Self {
+        SemanticIndex {
+            capacity,
+            next_id: 0,
+            entries: HashMap::new(),
+            ids: HashMap::new(),
+            order: VecDeque::new(),
+            postings: HashMap::new(),
+        }
+    }
+
+    // Add the translation of a normalized question, replacing the one
+    // already there, and forget the oldest question when full
+    pub fn insert(&mut self, model: &str, question: &str, translation: CachedTranslation) {
+        if self.capacity == 0 {
+            return;
+        }
+        let key = (model.to_string(), question.to_string());
+        if let Some(id) = self.ids.get(&key) {
+            if let Some(entry) = self.entries.get_mut(id) {
+                entry.translation = translation;
+            }
+            return;
+        }
+        while self.entries.len() >= self.capacity {
+            match self.order.pop_front() {
+                Some(id) => self.remove(id),
+                None => break,
+            }
+        }
+
+        let id = self.next_id;
+        self.next_id += 1;
+        let trigrams = trigrams(question);
+        for trigram in trigrams.keys() {
+            self.postings.entry(*trigram).or_default().push(id);
+        }
+        self.entries.insert(
+            id,
+            Entry {
+                model: key.0.clone(),
+                question: key.1.clone(),
+                trigrams,
+                translation,
+            },
+        );
+        self.ids.insert(key, id);
+        self.order.push_back(id);
+    }
+
+    fn remove(&mut self, id: u64) {
+        let entry = match self.entries.remove(&id) {
+            Some(entry) => entry,
+            None => return,
+        };
+        for trigram in entry.trigrams.keys() {
+            if let Some(ids) = self.postings.get_mut(trigram) {
+                ids.retain(|other| *other != id);
+                if ids.is_empty() {
+                    self.postings.remove(trigram);
+                }
+            }
+        }
+        self.ids.remove(&(entry.model, entry.question));
+    }
+
+    pub fn clear(&mut self) {
+        *self = SemanticIndex::new(self.capacity);
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    // Questions for `model` at least `threshold` similar to the normalized
+    // `question`, most similar first
+    pub fn search(
+        &self,
+        model: &str,
+        question: &str,
+        threshold: f64,
+    ) -> Vec<(SemanticMatch, CachedTranslation)> {
+        let query = trigrams(question);
+        let total = self.entries.len() as f64;
+        let idf = |trigram: &u64| {
+            let frequency = self.postings.get(trigram).map_or(0, Vec::len) as f64;
+            ((total + 1.0) / (frequency + 1.0)).ln() + 1.0
+        };
+
+        // Shortlist by the IDF weight of the trigrams each question shares
+        // with the new one
+        let mut shared: HashMap<u64, f64> = HashMap::new();
+        for trigram in query.keys() {
+            let weight = idf(trigram);
+            for id in self.postings.get(trigram).into_iter().flatten() {
+                *shared.entry(*id).or_default() += weight;
+            }
+        }
+        let mut shortlist: Vec<(u64, f64)> = shared
+            .into_iter()
+            .filter(|(id, _)| {
+                self.entries
+                    .get(id)
+                    .map_or(false, |entry| entry.model == model)
+            })
+            .collect();
+        shortlist.sort_by(|a, b| b.1.total_cmp(&a.1));
+        shortlist.truncate(MAX_CANDIDATES);
+
+        let vector = |trigrams: &HashMap<u64, f64>| -> HashMap<u64, f64> {
+            trigrams
+                .iter()
+                .map(|(trigram, count)| (*trigram, count * idf(trigram)))
+                .collect()
+        };
+        let query = vector(&query);
+        let query_norm = norm(&query);
+
+        let mut matches: Vec<(SemanticMatch, CachedTranslation)> = shortlist
+            .into_iter()
+            .filter_map(|(id, _)| self.entries.get(&id))
+            .filter_map(|entry| {
+                let candidate = vector(&entry.trigrams);
+                let dot: f64 = query
+                    .iter()
+                    .filter_map(|(trigram, weight)| candidate.get(trigram).map(|w| w * weight))
+                    .sum();
+                let similarity = dot / (query_norm * norm(&candidate)).max(f64::MIN_POSITIVE);
+                (similarity >= threshold).then(|| {
+                    let found = SemanticMatch {
+                        natural_query: entry.question.clone(),
+                        similarity,
+                    };
+                    (found, entry.translation.clone())
+                })
+            })
+            .collect();
+        matches.sort_by(|a, b| b.0.similarity.total_cmp(&a.0.similarity));
+        matches
+    }
+}
+
+// Occurrences of each character trigram of a normalized question, padded
+// with a space at both ends so word boundaries count
+fn trigrams(question: &str) -> HashMap<u64, f64> {
+    let chars: Vec<char> = format!(" {} ", question).chars().collect();
+    let mut trigrams = HashMap::new();
+    let mut buf = [0u8; 4];
+    for window in chars.windows(3) {
+        let mut hash = FNV_OFFSET;
+        for c in window {
+            hash = fnv1a(hash, c.encode_utf8(&mut buf).as_bytes());
+        }
+        *trigrams.entry(hash).or_insert(0.0) += 1.0;
+    }
+    trigrams
+}
+
+fn norm(vector: &HashMap<u64, f64>) -> f64 {
+    vector.values().map(|w| w * w).sum::<f64>().sqrt()
+}
+
+// Check that two normalized questions refer to the same columns and tables
+// and the same numbers, in the same direction, which similar wording alone
+// does not guarantee: "top 5 cars by mpg" and "top 10 cars by hp" are close in
+// trigrams, and so are "cars with the highest mpg" and "cars with the lowest
+// mpg"
+pub fn mismatch(question: &str, other: &str, names: &[String]) -> Option<Mismatch> {
+    if mentioned(question, names) != mentioned(other, names) {
+        return Some(Mismatch::Columns);
+    }
+    if numbers(question) != numbers(other) {
+        return Some(Mismatch::Numbers);
+    }
+    if directions(question) != directions(other) {
+        return Some(Mismatch::Direction);
+    }
+    None
+}
+
+// The names of `names` that appear as whole words in a normalized question.
+// Normalization turns underscores into spaces, so names are matched the same
+// way.
+fn mentioned<'a>(question: &str, names: &'a [String]) -> Vec<&'a str> {
+    let padded = format!(" {} ", question);
+    names
+        .iter()
+        .filter(|name| padded.contains(&format!(" {} ", name.replace('_', " "))))
+        .map(String::as_str)
+        .collect()
+}
+
+// The directions a normalized question orders, compares or negates in. Words
+// with the same meaning count as one, so "top" and "highest" agree.
+fn directions(question: &str) -> Vec<&'static str> {
+    let mut directions: Vec<&str> = question.split(' ').filter_map(direction).collect();
+    directions.sort_unstable();
+    directions.dedup();
+    directions
+}
+
+fn direction(word: &str) -> Option<&'static str> {
+    let direction = match word {
+        "top" | "highest" | "most" | "max" | "maximum" | "largest" | "biggest" | "greatest"
+        | "best" | "desc" | "descending" => "high",
+        "bottom" | "lowest" | "least" | "min" | "minimum" | "smallest" | "fewest" | "worst"
+        | "asc" | "ascending" => "low",
+        "above" | "over" | "more" | "greater" | "higher" | "larger" | "bigger" | "exceeding"
+        | "after" => "more",
+        "below" | "under" | "less" | "fewer" | "lower" | "smaller" | "before" => "less",
+        "not" | "no" | "without" | "excluding" | "except" | "never" | "isnt" | "arent"
+        | "doesnt" | "dont" => "not",
+        _ => return None,
+    };
+    Some(direction)
+}
+
+fn numbers(question: &str) -> Vec<&str> {
+    let mut numbers: Vec<&str> = question
+        .split(' ')
+        .filter(|word| {
+            word.starts_with(|c: char| c.is_ascii_digit()) && word.parse::<f64>().is_ok()
+        })
+        .collect();
+    numbers.sort_unstable();
+    numbers
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn translation(sql_query: &str) -> CachedTranslation {
+        CachedTranslation {
+            sql_query: sql_query.to_string(),
+            explanation: String::new(),
+            confidence: 1.0,
+        }
+    }
+
+    fn index(questions: &[&str]) -> SemanticIndex {
+        let mut index = SemanticIndex::new(16);
+        for (i, question) in questions.iter().enumerate() {
+            index.insert("model", question, translation(&format!("SELECT {}", i)));
+        }
+        index
+    }
+
+    fn cosine(a: &str, b: &str) -> f64 {
+        let (a, b) = (trigrams(a), trigrams(b));
+        let dot: f64 = a
+            .iter()
+            .filter_map(|(trigram, count)| b.get(trigram).map(|other| count * other))
+            .sum();
+        dot / (norm(&a) * norm(&b))
+    }
+
+    fn names(names: &[&str]) -> Vec<String> {
+        names.iter().map(|name| name.to_string()).collect()
+    }
+
+    #[test]
+    fn counts_padded_trigrams() {
+        let trigrams = trigrams("aa aa");
+        // " aa", "aa ", "a a" and " aa" again, "aa "
+        assert_eq!(trigrams.len(), 3);
+        assert_eq!(trigrams.values().sum::<f64>(), 5.0);
+        assert_eq!(super::trigrams("é").values().sum::<f64>(), 1.0);
+    }
+
+    #[test]
+    fn similarity_tolerates_rewording() {
+        assert!((cosine("average mpg by cyl", "average mpg by cyl") - 1.0).abs() < 1e-9);
+        let reordered = cosine("average mpg by cyl", "by cyl average mpg");
+        let inflected = cosine("show the fastest cars", "show the fastest car");
+        let unrelated = cosine("average mpg by cyl", "list every model name");
+        assert!(reordered > 0.7, "{}", reordered);
+        assert!(inflected > 0.8, "{}", inflected);
+        assert!(unrelated < 0.2, "{}", unrelated);
+    }
+
+    #[test]
+    fn finds_the_most_similar_question_of_the_model() {
+        let mut index = index(&[
+            "average mpg by cyl",
+            "list every model name",
+            "average hp by gear",
+        ]);
+        index.insert("other", "average mpg per cyl", translation("SELECT other"));
+
+        let found = index.search("model", "average mpg per cyl", 0.5);
+        assert_eq!(found[0].0.natural_query, "average mpg by cyl");
+        assert_eq!(found[0].1.sql_query, "SELECT 0");
+        assert!(found
+            .windows(2)
+            .all(|w| w[0].0.similarity >= w[1].0.similarity));
+        assert!(found
+            .iter()
+            .all(|(m, _)| m.natural_query != "list every model name"));
+
+        assert!(index.search("model", "horsepower", 0.5).is_empty());
+        assert!(index.search("none", "average mpg by cyl", 0.0).is_empty());
+    }
+
+    #[test]
+    fn forgets_the_oldest_question_when_full() {
+        let mut index = SemanticIndex::new(2);
+        index.insert("model", "first question", translation("SELECT 1"));
+        index.insert("model", "second question", translation("SELECT 2"));
+        // Replacing does not count as a new question
+        index.insert("model", "first question", translation("SELECT 3"));
+        assert_eq!(index.len(), 2);
+        assert_eq!(
+            index.search("model", "first question", 0.99)[0].1.sql_query,
+            "SELECT 3"
+        );
+
+        index.insert("model", "third question", translation("SELECT 4"));
+        assert_eq!(index.len(), 2);
+        assert!(index.search("model", "first question", 0.99).is_empty());
+        assert!(index.postings.values().all(|ids| !ids.contains(&0)));
+
+        index.clear();
+        assert_eq!(index.len(), 0);
+        assert!(index.postings.is_empty());
+    }
+
+    #[test]
+    fn ignores_inserts_without_capacity() {
+        let mut index = SemanticIndex::new(0);
+        index.insert("model", "question", translation("SELECT 1"));
+        assert_eq!(index.len(), 0);
+    }
+
+    #[test]
+    fn detects_different_columns_and_numbers() {
+        let names = names(&["cars", "mpg", "hp", "gear_ratio"]);
+        assert_eq!(
+            mismatch("top 5 cars by mpg", "top 5 cars by mpg", &names),
+            None
+        );
+        assert_eq!(
+            mismatch("top 5 cars by mpg", "top 5 cars by hp", &names),
+            Some(Mismatch::Columns)
+        );
+        assert_eq!(
+            mismatch("top 5 cars by mpg", "top 10 cars by mpg", &names),
+            Some(Mismatch::Numbers)
+        );
+        assert_eq!(
+            mismatch("mpg over 20.5", "mpg over 20", &names),
+            Some(Mismatch::Numbers)
+        );
+        // Numbers in any order, and names as whole words only
+        assert_eq!(
+            mismatch("mpg between 10 and 20", "mpg between 20 and 10", &names),
+            None
+        );
+        assert_eq!(
+            mismatch("mpg of cars", "mpg of carsharing", &names),
+            Some(Mismatch::Columns)
+        );
+        assert_eq!(mismatch("by gear ratio", "by gear ratio", &names), None);
+        assert_eq!(
+            mismatch("by gear ratio", "by gear", &names),
+            Some(Mismatch::Columns)
+        );
+        assert_eq!(mismatch("top cars 2x", "top cars", &names), None);
+    }
+
+    #[test]
+    fn detects_opposite_directions() {
+        let names = names(&["cars", "mpg", "hp"]);
+        for (question, other) in [
+            (
+                "show the top 5 cars by mpg",
+                "show the bottom 5 cars by mpg",
+            ),
+            (
+                "which cars have the highest mpg",
+                "which cars have the lowest mpg",
+            ),
+            ("cars with the most hp", "cars with the least hp"),
+            ("cars with mpg above 20", "cars with mpg below 20"),
+            ("cars with hp over 100", "cars with hp under 100"),
+            ("cars ordered by mpg asc", "cars ordered by mpg desc"),
+            (
+                "cars with a manual gearbox",
+                "cars without a manual gearbox",
+            ),
+            ("cars that are not automatic", "cars that are automatic"),
+        ] {
+            assert_eq!(
+                mismatch(question, other, &names),
+                Some(Mismatch::Direction),
+                "{} / {}",
+                question,
+                other
+            );
+        }
+    }
+
+    #[test]
+    fn accepts_synonymous_directions() {
+        let names = names(&["cars", "mpg", "hp"]);
+        assert_eq!(
+            mismatch(
+                "what are the 5 most powerful cars",
+                "top 5 most powerful cars",
+                &names
+            ),
+            None
+        );
+        assert_eq!(
+            mismatch(
+                "cars with the highest mpg",
+                "cars with the biggest mpg",
+                &names
+            ),
+            None
+        );
+        assert_eq!(
+            mismatch("hp above 100", "hp greater than 100", &names),
+            None
+        );
+    }
+}